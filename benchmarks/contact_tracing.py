@@ -0,0 +1,284 @@
+"""
+Benchmark of the contact tracing of a positive customer.
+
+It seeds a new database with 100k reservations and it measures the latency of
+ContactTracing.search_contacts against the implementation that it replaced,
+with a loop of queries for each past reservation of the positive customer.
+Both must return the same contacts in the same order.
+
+Run it from the root of the repository:
+python benchmarks/contact_tracing.py --reservations 100000
+"""
+import argparse
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+## the restaurants are open every day at lunch and dinner
+_HOURS = [12, 13, 14, 19, 20, 21]
+
+
+def old_search_contacts(user_id):
+    """
+    The contact tracing before ContactTracing, without its log file.
+    Its queries had no ORDER BY and on the schema of that time SQLite read
+    the reservations by id, the order by id keeps that order with the new indexes.
+    """
+    from sqlalchemy import extract
+
+    from monolith.database import (
+        db,
+        OpeningHours,
+        Reservation,
+        Restaurant,
+        RestaurantTable,
+        User,
+    )
+    from monolith.services import UserService
+
+    result = []
+    all_reservations = (
+        db.session.query(Reservation)
+        .filter(
+            Reservation.reservation_date >= (datetime.today() - timedelta(days=14)),
+            Reservation.reservation_date < datetime.now(),
+            Reservation.customer_id == user_id,
+        )
+        .order_by(Reservation.id)
+        .all()
+    )
+    for reservation in all_reservations:
+        this_table = (
+            db.session.query(RestaurantTable).filter_by(id=reservation.table_id).first()
+        )
+        restaurant = (
+            db.session.query(Restaurant).filter_by(id=this_table.restaurant_id).first()
+        )
+        opening = (
+            db.session.query(OpeningHours)
+            .filter(
+                OpeningHours.restaurant_id == restaurant.id,
+                OpeningHours.week_day == reservation.reservation_date.weekday(),
+            )
+            .first()
+        )
+        period = (
+            [opening.open_dinner, opening.close_dinner]
+            if (opening.open_dinner <= reservation.reservation_date.time())
+            else [opening.open_lunch, opening.close_lunch]
+        )
+        query = db.session.query(RestaurantTable.id).filter_by(
+            restaurant_id=this_table.restaurant_id
+        )
+        restaurant_tables = [r.id for r in query]
+        all_contacts = (
+            db.session.query(Reservation)
+            .filter(
+                extract("day", Reservation.reservation_date)
+                == extract("day", reservation.reservation_date),
+                extract("month", Reservation.reservation_date)
+                == extract("month", reservation.reservation_date),
+                extract("year", Reservation.reservation_date)
+                == extract("year", reservation.reservation_date),
+                extract("hour", Reservation.reservation_date)
+                >= extract("hour", period[0]),
+                extract("hour", Reservation.reservation_date)
+                <= extract("hour", period[1]),
+                Reservation.table_id.in_(restaurant_tables),
+            )
+            .order_by(Reservation.id)
+            .all()
+        )
+        for contact in all_contacts:
+            db.session.query(User).filter_by(id=contact.customer_id).first()
+            if contact.customer_id not in result:
+                result.append(contact.customer_id)
+
+    contact_users = []
+    for contact_id in result:
+        user = db.session.query(User).filter_by(id=contact_id).first()
+        if not UserService.is_positive(user.id):
+            contact_users.append(
+                [
+                    user.id,
+                    user.firstname + " " + user.lastname,
+                    str(user.dateofbirth).split()[0],
+                    user.email,
+                    user.phone,
+                ]
+            )
+    return contact_users
+
+
+def seed(args):
+    """
+    Write the restaurants, the customers and the reservations, the positive
+    customer has a reservation at lunch in each of the last days
+    :return: the id of the positive customer
+    """
+    from datetime import time as only_time
+
+    from monolith.database import (
+        db,
+        OpeningHours,
+        Positive,
+        Reservation,
+        Restaurant,
+        RestaurantTable,
+        User,
+    )
+    from monolith.services.availability_index import OpeningSlot
+    from monolith import time_windows
+
+    random.seed(args.seed)
+    db.session.bulk_insert_mappings(
+        User,
+        [
+            {
+                "email": "customer{}@bench.com".format(number),
+                "phone": str(number),
+                "firstname": "Customer{}".format(number),
+                "lastname": "Bench",
+                "dateofbirth": datetime(1990, 1, 1),
+                "role_id": 3,
+                "is_active": True,
+                "is_admin": False,
+                "password": "bench",
+            }
+            for number in range(args.customers)
+        ],
+    )
+    customers = [
+        user.id
+        for user in db.session.query(User.id).filter(User.email.like("%@bench.com"))
+    ]
+    opening = OpeningSlot(only_time(12), only_time(15), only_time(19), only_time(22))
+    tables = {}
+    for number in range(args.restaurants):
+        restaurant = Restaurant(
+            name="Bench {}".format(number), phone="1", lat=1, lon=1, avg_time=30
+        )
+        db.session.add(restaurant)
+        db.session.flush()
+        for week_day in range(7):
+            db.session.add(
+                OpeningHours(
+                    restaurant_id=restaurant.id, week_day=week_day, **opening._asdict()
+                )
+            )
+        restaurant_tables = [
+            RestaurantTable(restaurant_id=restaurant.id, name=str(table), max_seats=4)
+            for table in range(args.tables)
+        ]
+        db.session.add_all(restaurant_tables)
+        db.session.flush()
+        tables[restaurant.id] = [table.id for table in restaurant_tables]
+
+    positive = customers[0]
+    today = datetime.combine(datetime.today(), only_time())
+    reservations = []
+    for number in range(args.reservations):
+        restaurant_id = random.choice(list(tables))
+        if number < args.positive_reservations:
+            customer = positive
+            moment = today - timedelta(days=number + 1, hours=-13)
+        else:
+            customer = random.choice(customers[1:])
+            moment = today - timedelta(
+                days=random.randrange(1, args.days),
+                hours=-random.choice(_HOURS),
+                minutes=-random.choice([0, 15, 30]),
+            )
+        # the mapper events are not called by the bulk insert
+        reservations.append(
+            {
+                "reservation_date": moment,
+                "reservation_end": moment + timedelta(minutes=30),
+                "customer_id": customer,
+                "table_id": random.choice(tables[restaurant_id]),
+                "people_number": 2,
+                "checkin": False,
+                "service_slot": time_windows.service_slot(
+                    restaurant_id, opening, moment
+                ),
+            }
+        )
+    db.session.execute(Reservation.__table__.insert(), reservations)
+    db.session.add(Positive(user_id=positive, marked=True, from_date=datetime.now()))
+    db.session.commit()
+    return positive
+
+
+def measure(search, user_id, runs):
+    """
+    :return: (median seconds of the runs, contacts)
+    """
+    from monolith.database import db
+
+    timings = []
+    contacts = None
+    for _ in range(runs):
+        db.session.expire_all()
+        start = time.perf_counter()
+        contacts = search(user_id)
+        timings.append(time.perf_counter() - start)
+        db.session.rollback()
+    return statistics.median(timings), contacts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--reservations", type=int, default=100000)
+    parser.add_argument("--restaurants", type=int, default=50)
+    parser.add_argument("--tables", type=int, default=20)
+    parser.add_argument("--customers", type=int, default=5000)
+    parser.add_argument("--days", type=int, default=60)
+    parser.add_argument("--positive-reservations", type=int, default=14)
+    parser.add_argument("--old-runs", type=int, default=3)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="gooutsafe-bench-")
+    os.environ["GOOUTSAFE_DATABASE_URI"] = "sqlite:///" + os.path.join(
+        directory, "bench.db"
+    )
+    os.environ.setdefault("GOOUTSAFE_DISPATCHER", "sync")
+    from monolith.app import create_app
+    from monolith.services.contact_tracing import ContactTracing
+
+    app = create_app()
+    try:
+        with app.app_context():
+            positive = seed(args)
+            old_time, old_contacts = measure(
+                old_search_contacts, positive, args.old_runs
+            )
+            new_time, new_contacts = measure(
+                ContactTracing.search_contacts, positive, args.runs
+            )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    print("reservations: {}".format(args.reservations))
+    print(
+        "before: {:.1f} ms, {} contacts (median of {} runs)".format(
+            old_time * 1000, len(old_contacts), args.old_runs
+        )
+    )
+    print(
+        "after:  {:.1f} ms, {} contacts (median of {} runs)".format(
+            new_time * 1000, len(new_contacts), args.runs
+        )
+    )
+    print("same contacts in the same order: {}".format(old_contacts == new_contacts))
+
+
+if __name__ == "__main__":
+    main()
@@ -12,11 +12,19 @@ from monolith.database import (
 import decimal
 from monolith.views import blueprints
 from monolith.auth import login_manager
+from monolith.migrations import migrate
+from monolith.engine import configure_engine, setup_engine
+from monolith.commands import import_restaurants_command
+from monolith.principals import principal_cache
+from monolith.roles import role_registry
+from monolith.services.outbox import outbox_worker
 from monolith.utils.dispaccer_events import (
     DispatcherMessage,
     CALCULATE_RATING_RESTAURANTS,
 )
+from monolith.utils.send_mail import suppress_emails
 import datetime
+import os
 
 
 def create_app(tests=False):
@@ -24,10 +32,20 @@ def create_app(tests=False):
     app.config["WTF_CSRF_SECRET_KEY"] = "A SECRET KEY"
     app.config["SECRET_KEY"] = "ANOTHER ONE"
     if tests is False:
-        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///gooutsafe.db"
+        # the environment can move the app on another database
+        configure_engine(app, "sqlite:///gooutsafe.db")
+        # the principals of the logged users are shared by the workers with redis
+        principal_cache.configure(os.environ.get("GOOUTSAFE_REDIS_URL"))
+        DispatcherMessage.configure()
     else:
-        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///tests/gooutsafe.db"
+        configure_engine(app, "sqlite:///tests/gooutsafe.db", use_env=False)
+        principal_cache.configure()
+        # the messages run inside the requests, and the emails are not sent
+        DispatcherMessage.configure("sync")
+        suppress_emails()
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    # render the long pages (e.g. the restaurants list) as a stream
+    app.config["STREAM_TEMPLATES"] = False
 
     for bp in blueprints:
         app.register_blueprint(bp)
@@ -35,10 +53,15 @@ def create_app(tests=False):
 
     db.init_app(app)
     login_manager.init_app(app)
+    app.cli.add_command(import_restaurants_command)
+    with app.app_context():
+        setup_engine(db.engine, app.config["SQLITE_PRAGMAS"])
     db.create_all(app=app)
 
     # create a first admin user
     with app.app_context():
+        # apply the changes on the tables that already exist
+        migrate()
 
         # create the user roles
         q = db.session.query(Role).filter(Role.id == 1)
@@ -61,6 +84,7 @@ def create_app(tests=False):
             role.label = "Health role"
             db.session.add(role)
             db.session.commit()
+        role_registry.load()
 
         # an Admin user
         q = db.session.query(User).filter(User.email == "admin@gooutsafe.com")
@@ -285,6 +309,9 @@ def create_app(tests=False):
             db.session.add(review)
             db.session.commit()
     # CALCULATE_RATING_RESTAURANTS
+    if tests is False:
+        # the confirmations of the bookings are relayed outside the requests
+        outbox_worker.start(app)
     return app
 
 
@@ -1,7 +1,8 @@
 import functools
 from flask_login import current_user, LoginManager
 from flask import session
-from monolith.database import User
+from monolith.principals import principal_cache
+from monolith.roles import allowed_roles
 
 login_manager = LoginManager()
 
@@ -17,11 +18,12 @@ def roles_allowed(func=None, roles=None):
     """
     if not func:
         return functools.partial(roles_allowed, roles=roles)
+    # the roles are checked once, when the view is decorated
+    allowed = allowed_roles(roles)
 
     @functools.wraps(func)
     def f(*args, **kwargs):
-        role = session.get("ROLE")
-        if not any(role in s for s in roles):
+        if session.get("ROLE") not in allowed:
             return login_manager.unauthorized()
         return func(*args, **kwargs)
 
@@ -30,7 +32,5 @@ def roles_allowed(func=None, roles=None):
 
 @login_manager.user_loader
 def load_user(user_id):
-    user = User.query.get(user_id)
-    if user is not None:
-        user._authenticated = True
-    return user
+    # the user, the role and the restaurant are inside the cache of the principals
+    return principal_cache.get(user_id)
@@ -1,5 +1,6 @@
 from celery import Celery
 from monolith.utils import *
+from monolith.app_constant import *
 from monolith.services import RestaurantServices
 
 ## redis inside the http is the name of network that is called like the containser
@@ -104,6 +105,68 @@ def send_booking_confirmation_to_friends_celery(
     )
 
 
+## message type -> function that compose and send the email, used by the batch task
+_BATCH_SENDERS = {
+    NEW_COVID_TO_RESTAURANT_BOOKING: send_positive_booking_in_restaurant,
+    NEW_POSITIVE_WAS_IN_RESTAURANT: send_positive_in_restaurant,
+    EMAIL_TO_FRIEND: send_possible_positive_contact_to_friend,
+    NEW_POSITIVE_CONTACT: send_possible_positive_contact,
+    CONFIRMATION_BOOKING: send_booking_confirmation_to_friends,
+}
+
+
+@celery.task()
+def send_notification_batch_celery(type_message: str, batch_params: []):
+    """
+    Perform the send email with celery async task of a batch of messages with the same type,
+    used to notify all the people involved by a new positive case with few tasks.
+    :param type_message: the message type, defined inside the app_constant.py
+    :param batch_params: list of params, one for each email
+    :return: the number of emails sent
+    """
+    sender = _BATCH_SENDERS[type_message]
+    for params in batch_params:
+        sender(*params)
+    return len(batch_params)
+
+
+## flask app used by the periodic tasks to access to the database
+_app = None
+
+
+def _get_app():
+    global _app
+    if _app is None:
+        from monolith.app import create_app
+
+        _app = create_app()
+    return _app
+
+
+@celery.task()
+def calculate_rating_for_all_celery():
+    """
+    Perform the reconciliation of the restaurants rating with celery async task,
+    only the restaurants with new reviews are recalculated.
+    :return: the number of restaurants updated
+    """
+    with _get_app().app_context():
+        return RestaurantServices.calculate_rating_for_all()
+
+
+@celery.task()
+def relay_outbox_celery():
+    """
+    Send the messages of the outbox that are not sent by the apps,
+    e.g. because the app is stopped after the commit of a booking.
+    :return: the number of messages sent
+    """
+    from monolith.services.outbox import NotificationOutbox
+
+    with _get_app().app_context():
+        return NotificationOutbox.relay_all()
+
+
 @celery.on_after_configure.connect
 def calculate_rating_on_background(sender, **kwargs):
     """
@@ -111,6 +174,6 @@ def calculate_rating_on_background(sender, **kwargs):
     this task take the db code and call the RestaurantServices for each restaurants
     """
     # Calls RestaurantServices.calculate_rating_for_all() every 30 seconds
-    sender.add_periodic_task(
-        30.0, RestaurantServices.calculate_rating_for_all(), expires=10
-    )
+    sender.add_periodic_task(30.0, calculate_rating_for_all_celery.s(), expires=10)
+    # Relay the messages left inside the outbox every 60 seconds
+    sender.add_periodic_task(60.0, relay_outbox_celery.s(), expires=30)
@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class VersionedCache:
+    """
+    Read-through cache in memory, with a LRU policy and an optional TTL.
+
+    Each key has a version that is incremented by invalidate(), the value
+    loaded is stored only if the version of the key is not changed during the load,
+    so a reader that started before an update can't put inside the cache
+    the old value.
+
+    The cache lives inside the process, for this reason the TTL is the upper bound
+    of a stale value when the database is changed by another worker.
+    """
+
+    def __init__(self, ttl: float = None, max_size: int = 1024) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        ## key -> (version, value, expire time)
+        self._entries = OrderedDict()
+        ## key -> version of the key
+        self._versions = {}
+        ## incremented when all the cache is invalidated
+        self._generation = 0
+
+    def get(self, key, loader):
+        """
+        Return the value of the key, if it is not inside the cache
+        the value is loaded with the loader and stored.
+        :param key: the key of the value
+        :param loader: function without params that load the value, a None value is not stored
+        :return: the value
+        """
+        with self._lock:
+            version = (self._generation, self._versions.get(key, 0))
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] == version and (
+                    entry[2] is None or entry[2] > time.monotonic()
+                ):
+                    self._entries.move_to_end(key)
+                    return entry[1]
+                del self._entries[key]
+
+        value = loader()
+        if value is None:
+            return value
+
+        with self._lock:
+            if (self._generation, self._versions.get(key, 0)) == version:
+                expire = None if self.ttl is None else time.monotonic() + self.ttl
+                self._entries[key] = (version, value, expire)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key=None):
+        """
+        Remove the value of the key from the cache, without key all the values are removed.
+        """
+        with self._lock:
+            if key is None:
+                self._generation += 1
+                self._entries.clear()
+                return
+            self._versions[key] = self._versions.get(key, 0) + 1
+            self._entries.pop(key, None)
@@ -0,0 +1,61 @@
+"""
+Commands of the flask cli, e.g.
+FLASK_APP=monolith/app.py flask import-restaurants restaurants.csv --owner ham.burger@email.com
+"""
+import os
+
+import click
+from flask.cli import with_appcontext
+
+from monolith.database import db, User
+from monolith.services.restaurant_import import RestaurantImport, BATCH_SIZE
+
+
+@click.command("import-restaurants")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--format",
+    "file_format",
+    type=click.Choice(["csv", "json"]),
+    default=None,
+    help="Format of the file, by default the extension of the file.",
+)
+@click.option(
+    "--owner",
+    "owner_email",
+    default=None,
+    help="Email of the owner of the restaurants without owner_email.",
+)
+@click.option(
+    "--batch-size",
+    default=BATCH_SIZE,
+    show_default=True,
+    help="Restaurants written inside a transaction.",
+)
+@with_appcontext
+def import_restaurants_command(path, file_format, owner_email, batch_size):
+    """
+    Onboard the restaurants inside a CSV or JSON file
+    """
+    if file_format is None:
+        extension = os.path.splitext(path)[1].lower()
+        file_format = "csv" if extension == ".csv" else "json"
+    owner_id = None
+    if owner_email is not None:
+        owner = db.session.query(User.id).filter_by(email=owner_email).first()
+        if owner is None:
+            raise click.BadParameter(
+                "The user {} is not registered".format(owner_email),
+                param_hint="--owner",
+            )
+        owner_id = owner.id
+
+    with open(path, newline="", encoding="utf-8") as stream:
+        imported, errors = RestaurantImport.import_rows(
+            RestaurantImport.read_rows(stream, file_format), owner_id, batch_size
+        )
+    for number, error in errors:
+        click.echo("Row {}: {}".format(number, error), err=True)
+    click.echo(
+        "Imported {} restaurants, {} rows with errors".format(imported, len(errors))
+    )
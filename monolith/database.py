@@ -1,9 +1,12 @@
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy.orm import relationship
+from sqlalchemy import and_, event, inspect, select
+from sqlalchemy.orm import relationship, validates
 from flask_sqlalchemy import SQLAlchemy
 from decimal import Decimal as D
 import sqlalchemy.types as types
+from monolith.geo import cell_of
+from monolith import time_windows
 
 
 db = SQLAlchemy()
@@ -78,11 +81,13 @@ class Restaurant(db.Model):
 
     lat = db.Column(db.Float)  # restaurant latitude
     lon = db.Column(db.Float)  # restaurant longitude
+    # cell of the grid that contains the restaurant, see monolith/geo.py
+    geo_cell = db.Column(db.Integer, index=True)
 
     # menu = db.Column(db.Text(255)) #we keep a text field? or we create a menu table?
 
     # resturant owner
-    owner_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    owner_id = db.Column(db.Integer, db.ForeignKey("user.id"), index=True)
     owner = relationship("User", foreign_keys="Restaurant.owner_id")
 
     phone = db.Column(db.Integer)
@@ -95,10 +100,21 @@ class Restaurant(db.Model):
     avg_time = db.Column(db.Integer, default=30)
 
     rating = db.Column(db.Float, default=0.0)
+    # running aggregates of the reviews, updated with each new review
+    review_count = db.Column(db.Integer, default=0)
+    stars_sum = db.Column(db.Float, default=0.0)
 
     def __init__(self, *args, **kw):
         super(Restaurant, self).__init__(*args, **kw)
 
+    @validates("lat", "lon")
+    def validate_position(self, key, value):
+        # keep the cell aligned with the position
+        lat = value if key == "lat" else self.lat
+        lon = value if key == "lon" else self.lon
+        self.geo_cell = cell_of(lat, lon)
+        return value
+
 
 class Like(db.Model):
     __tablename__ = "like"
@@ -120,7 +136,7 @@ class RestaurantTable(db.Model):
     __tablename__ = "restaurant_table"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
 
-    restaurant_id = db.Column(db.Integer, db.ForeignKey("restaurant.id"))
+    restaurant_id = db.Column(db.Integer, db.ForeignKey("restaurant.id"), index=True)
     restaurant = relationship(
         "Restaurant", foreign_keys="RestaurantTable.restaurant_id"
     )
@@ -133,6 +149,9 @@ class RestaurantTable(db.Model):
         db.Boolean, default=False
     )  # I don't understand the purpose of this field..
 
+    # moved by each booking of the table, to claim the table with a compare and swap
+    booking_version = db.Column(db.Integer, default=0, nullable=False)
+
 
 class Role(db.Model):
     # this is the role of a user (like operator, customer....)
@@ -146,6 +165,7 @@ class Role(db.Model):
 class Positive(db.Model):
     # all covid positives
     __tablename__ = "positive"
+    __table_args__ = (db.Index("ix_positive_user_marked", "user_id", "marked"),)
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     from_date = db.Column(db.Date)
@@ -157,6 +177,12 @@ class Positive(db.Model):
 class Reservation(db.Model):
     # reservations
     __tablename__ = "reservation"
+    __table_args__ = (
+        # overlap check of the booking, reservations of the restaurant, contact tracing
+        db.Index("ix_reservation_table_date", "table_id", "reservation_date"),
+        # reservations of the customer
+        db.Index("ix_reservation_customer_date", "customer_id", "reservation_date"),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     reservation_date = db.Column(db.DateTime)
@@ -171,6 +197,61 @@ class Reservation(db.Model):
     #
     people_number = db.Column(db.Integer)  # number of people in this reservation
     checkin = db.Column(db.Boolean, default=False)
+    # service of the restaurant (restaurant, day, lunch or dinner), see time_windows
+    service_slot = db.Column(db.String(32), index=True)
+
+
+@event.listens_for(Reservation, "before_insert")
+@event.listens_for(Reservation, "before_update")
+def _set_service_slot(mapper, connection, target):
+    """
+    Compute the service slot of the reservation when it is written, so all the
+    writers set it, also the ones that don't use the BookingServices.
+    The slot set with the reservation (e.g. by the BookingServices, that has the
+    opening hours in memory) is kept, and an update computes it again only if
+    the date or the table is changed.
+    """
+    state = inspect(target)
+    if state.attrs.service_slot.history.has_changes():
+        return
+    if state.persistent and not (
+        state.attrs.reservation_date.history.has_changes()
+        or state.attrs.table_id.history.has_changes()
+    ):
+        return
+    if target.reservation_date is None or target.table_id is None:
+        target.service_slot = None
+        return
+    table = RestaurantTable.__table__
+    opening = OpeningHours.__table__
+    row = connection.execute(
+        select(
+            [
+                table.c.restaurant_id,
+                opening.c.open_lunch,
+                opening.c.close_lunch,
+                opening.c.open_dinner,
+                opening.c.close_dinner,
+            ]
+        )
+        .select_from(
+            table.outerjoin(
+                opening,
+                and_(
+                    opening.c.restaurant_id == table.c.restaurant_id,
+                    opening.c.week_day == target.reservation_date.weekday(),
+                ),
+            )
+        )
+        .where(table.c.id == target.table_id)
+    ).first()
+    if row is None:
+        target.service_slot = None
+        return
+    # without opening hours of the week day all the hours are None
+    target.service_slot = time_windows.service_slot(
+        row.restaurant_id, row, target.reservation_date
+    )
 
 
 class PhotoGallery(db.Model):
@@ -179,7 +260,7 @@ class PhotoGallery(db.Model):
     url = db.Column(db.Text(255))
     caption = db.Column(db.Text(200))
     # restaurant
-    restaurant_id = db.Column(db.Integer, db.ForeignKey("restaurant.id"))
+    restaurant_id = db.Column(db.Integer, db.ForeignKey("restaurant.id"), index=True)
     restaurant = relationship("Restaurant", foreign_keys="PhotoGallery.restaurant_id")
 
 
@@ -205,7 +286,7 @@ class Menu(db.Model):
     __tablename__ = "menu"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     # restaurant
-    restaurant_id = db.Column(db.Integer, db.ForeignKey("restaurant.id"))
+    restaurant_id = db.Column(db.Integer, db.ForeignKey("restaurant.id"), index=True)
     restaurant = relationship("Restaurant", foreign_keys="Menu.restaurant_id")
     #
     cusine = db.Column(db.Text(100))
@@ -217,7 +298,7 @@ class MenuDish(db.Model):
     __tablename__ = "menu_dish"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     # restaurant
-    restaurant_id = db.Column(db.Integer, db.ForeignKey("restaurant.id"))
+    restaurant_id = db.Column(db.Integer, db.ForeignKey("restaurant.id"), index=True)
     restaurant = relationship("Restaurant", foreign_keys="MenuDish.restaurant_id")
     #
     name = db.Column(db.Text(100))
@@ -236,23 +317,59 @@ class MenuPhotoGallery(db.Model):
 
 
 class Review(db.Model):
+    ## the ids are never reused, they are the watermark of the rating reconciliation
+    __table_args__ = {"sqlite_autoincrement": True}
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     # review, reletion with user table
     reviewer_id = db.Column(db.Integer, db.ForeignKey("user.id"))
     reviewer = relationship("User", foreign_keys="Review.reviewer_id")
     # restaurant
-    restaurant_id = db.Column(db.Integer, db.ForeignKey("restaurant.id"))
+    restaurant_id = db.Column(db.Integer, db.ForeignKey("restaurant.id"), index=True)
     restaurant = relationship("Restaurant", foreign_keys="Review.restaurant_id")
 
     stars = db.Column(SqliteNumeric())
     review = db.Column(db.Text())
-    data = db.Column(db.DateTime(), default=datetime.now())
+    data = db.Column(db.DateTime(), default=datetime.now)
 
 
 class Friend(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     # reservation
-    reservation_id = db.Column(db.Integer, db.ForeignKey("reservation.id"))
+    reservation_id = db.Column(db.Integer, db.ForeignKey("reservation.id"), index=True)
     reservation = relationship("Reservation", foreign_keys="Friend.reservation_id")
     # email
     email = db.Column(db.Text())
+
+
+class SchemaVersion(db.Model):
+    # the migrations applied on the database, see monolith/migrations.py
+    __tablename__ = "schema_version"
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.Text(255))
+    applied_at = db.Column(db.DateTime, default=datetime.now)
+
+
+class ReconcileWatermark(db.Model):
+    # the last row processed by a periodic reconciliation, kept on the database
+    # so it survives the restarts and it is shared by the workers
+    __tablename__ = "reconcile_watermark"
+    name = db.Column(db.String(32), primary_key=True)
+    last_id = db.Column(db.Integer, default=0, nullable=False)
+
+
+class Outbox(db.Model):
+    # the messages written inside the transaction of the change that generates
+    # them, and relayed to celery later, see services/outbox.py
+    __tablename__ = "outbox"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    type_message = db.Column(db.String(64), nullable=False)
+    # the params of the message as json
+    params = db.Column(db.Text(), nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    # the message is relayed after this moment, it is moved on by each attempt
+    next_attempt = db.Column(
+        db.DateTime, default=datetime.utcnow, nullable=False, index=True
+    )
+    # the message failed MAX_ATTEMPTS times, the relay doesn't send it anymore
+    dead = db.Column(db.Boolean, default=False, nullable=False)
@@ -0,0 +1,111 @@
+"""
+Configuration of the database engine.
+
+The database URI and the size of the pool are read from the environment, so
+the same code runs on the SQLite file (the default) or on a database server,
+e.g. GOOUTSAFE_DATABASE_URI=postgresql://user:password@db/gooutsafe.
+On SQLite each new connection is tuned with the pragmas below: the WAL journal
+lets the readers go on while a booking is committed, and the busy timeout makes
+the concurrent writers wait for the lock instead of failing with
+"database is locked".
+"""
+import os
+
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+## prefix of the environment variables of the engine
+ENV_PREFIX = "GOOUTSAFE_"
+
+## pragmas of the SQLite connections, each one can be changed with the
+## environment variable GOOUTSAFE_SQLITE_<NAME>, e.g. GOOUTSAFE_SQLITE_SYNCHRONOUS=FULL
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    # milliseconds that a writer waits for the lock
+    "busy_timeout": 5000,
+    # with WAL the commits are durable at the checkpoint, and still consistent
+    "synchronous": "NORMAL",
+    # bytes of the database read with the memory mapping
+    "mmap_size": 268435456,
+}
+
+## size of the pool of connections and connections created over the pool
+POOL_SIZE = 5
+MAX_OVERFLOW = 10
+## seconds that a request waits for a connection of the pool
+POOL_TIMEOUT = 30
+## seconds after that the connections to a server are opened again
+POOL_RECYCLE = 3600
+
+
+def _env(name: str, default):
+    """
+    Return the value of the environment variable GOOUTSAFE_<name>, converted
+    to the type of the default value
+    """
+    value = os.environ.get(ENV_PREFIX + name)
+    if value is None or value == "":
+        return default
+    if isinstance(default, int):
+        return int(value)
+    return value
+
+
+def configure_engine(app, database_uri: str, use_env: bool = True):
+    """
+    Set inside the app config the database URI, the options of the engine and
+    the pragmas of the SQLite connections.
+    It must be called before db.init_app(app).
+    :param app: the flask app
+    :param database_uri: the default database URI
+    :param use_env: if False the environment is ignored (e.g. for the tests)
+    """
+    setting = _env if use_env else (lambda name, default: default)
+    database_uri = setting("DATABASE_URI", database_uri)
+    pragmas = {
+        name: setting("SQLITE_" + name.upper(), value)
+        for name, value in SQLITE_PRAGMAS.items()
+    }
+    pool = {
+        "pool_size": setting("DATABASE_POOL_SIZE", POOL_SIZE),
+        "max_overflow": setting("DATABASE_MAX_OVERFLOW", MAX_OVERFLOW),
+        "pool_timeout": POOL_TIMEOUT,
+    }
+
+    url = make_url(database_uri)
+    if url.drivername.startswith("sqlite"):
+        options = {
+            "connect_args": {
+                # the connections of the pool are used by the threads of the server
+                "check_same_thread": False,
+                "timeout": pragmas["busy_timeout"] / 1000,
+            }
+        }
+        if url.database not in (None, "", ":memory:"):
+            # flask-sqlalchemy uses a new connection for each session without pool
+            options.update(pool, poolclass=QueuePool)
+    else:
+        options = dict(pool, pool_recycle=POOL_RECYCLE, pool_pre_ping=True)
+
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_uri
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+    app.config["SQLITE_PRAGMAS"] = pragmas
+
+
+def setup_engine(engine, pragmas):
+    """
+    Apply the pragmas to each new connection of the engine, only on SQLite
+    :param engine: the engine of the app (db.engine)
+    :param pragmas: dictionary pragma -> value, e.g. app.config["SQLITE_PRAGMAS"]
+    """
+    if engine.dialect.name != "sqlite" or not pragmas:
+        return
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA {} = {}".format(name, value))
+        cursor.close()
+
+    event.listen(engine, "connect", set_pragmas)
@@ -0,0 +1,121 @@
+"""
+Grid used to index the position of the restaurants.
+
+The world is divided in cells of CELL_SIZE degrees, each cell has an integer id
+(row * COLUMNS + column) stored with the restaurant, so the restaurants near a
+point are found with few range scans on the index of the cells, instead of
+checking all the restaurants.
+"""
+import math
+
+## size of a cell in degrees, about 5.5 km of latitude
+CELL_SIZE = 0.05
+## number of cells inside a row of the grid
+COLUMNS = int(round(360 / CELL_SIZE))
+## mean radius of the earth in km
+EARTH_RADIUS = 6371.0
+## km inside a degree of latitude
+KM_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+
+def _row_of(lat: float) -> int:
+    return int((min(max(lat, -90.0), 90.0) + 90.0) / CELL_SIZE)
+
+
+def _column_of(lon: float) -> int:
+    return min(int((min(max(lon, -180.0), 180.0) + 180.0) / CELL_SIZE), COLUMNS - 1)
+
+
+def cell_of(lat, lon):
+    """
+    Return the id of the cell that contains the point
+    :param lat: latitude in degrees, also as string
+    :param lon: longitude in degrees, also as string
+    :return: the cell id or None if the position is not valid
+    """
+    try:
+        lat = float(lat)
+        lon = float(lon)
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(lat) or math.isnan(lon):
+        return None
+    return _row_of(lat) * COLUMNS + _column_of(lon)
+
+
+def distance_km(lat_one: float, lon_one: float, lat_two: float, lon_two: float):
+    """
+    Return the great circle distance between two points (haversine formula)
+    """
+    phi_one = math.radians(lat_one)
+    phi_two = math.radians(lat_two)
+    delta_phi = phi_two - phi_one
+    delta_lambda = math.radians(lon_two - lon_one)
+    a = (
+        math.sin(delta_phi / 2) ** 2
+        + math.cos(phi_one) * math.cos(phi_two) * math.sin(delta_lambda / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def cell_ranges(lat: float, lon: float, radius_km: float):
+    """
+    Return the cells that cover the circle, one range of cells for each row of the grid.
+    The longitude is not wrapped around the 180th meridian.
+    :return: list of (first cell, last cell)
+    """
+    delta_lat = radius_km / KM_PER_DEGREE
+    # the degrees of longitude are shorter far from the equator
+    cos_lat = math.cos(math.radians(min(abs(lat) + delta_lat, 90.0)))
+    delta_lon = 360.0 if cos_lat < 1e-6 else radius_km / (KM_PER_DEGREE * cos_lat)
+
+    first_column = _column_of(lon - delta_lon)
+    last_column = _column_of(lon + delta_lon)
+    return [
+        (row * COLUMNS + first_column, row * COLUMNS + last_column)
+        for row in range(_row_of(lat - delta_lat), _row_of(lat + delta_lat) + 1)
+    ]
+
+
+def ring_ranges(lat: float, lon: float, ring: int):
+    """
+    Return the cells at distance ring (in cells) from the cell of the point,
+    as ranges of cells. The ring 0 is the cell of the point.
+    :return: list of (first cell, last cell)
+    """
+    row = _row_of(lat)
+    column = _column_of(lon)
+    rows = _row_of(90.0)
+    first_column = max(column - ring, 0)
+    last_column = min(column + ring, COLUMNS - 1)
+
+    ranges = []
+    for current in range(max(row - ring, 0), min(row + ring, rows) + 1):
+        if abs(current - row) == ring:
+            # the top and the bottom rows of the ring
+            ranges.append(
+                (current * COLUMNS + first_column, current * COLUMNS + last_column)
+            )
+            continue
+        for side in (column - ring, column + ring):
+            if 0 <= side < COLUMNS:
+                ranges.append((current * COLUMNS + side, current * COLUMNS + side))
+    return ranges
+
+
+def ring_distance_km(lat: float, ring: int):
+    """
+    Return a lower bound of the distance of the points outside the first ring cells
+    around a point at latitude lat.
+    """
+    if ring <= 0:
+        return 0.0
+    by_lat = ring * CELL_SIZE * KM_PER_DEGREE
+    # the cells are narrower far from the equator
+    cos_lat = math.cos(math.radians(min(abs(lat) + (ring + 1) * CELL_SIZE, 90.0)))
+    by_lon = (
+        2
+        * EARTH_RADIUS
+        * math.asin(min(1.0, cos_lat * math.sin(math.radians(ring * CELL_SIZE) / 2)))
+    )
+    return min(by_lat, by_lon)
@@ -0,0 +1,254 @@
+"""
+Versioned migrations of the database schema.
+
+The db.create_all() creates only the missing tables, so the changes on the tables
+that already exist (new columns, indexes) are applied here. Each migration has
+a version number and it is applied only once, the applied versions are stored
+inside the schema_version table.
+The operations are idempotent, so on a new database (where create_all already
+created the last version of the schema) the migrations are only recorded.
+"""
+from datetime import datetime
+
+from sqlalchemy import inspect, select, text
+from sqlalchemy.exc import OperationalError
+
+from monolith.database import (
+    db,
+    SchemaVersion,
+    ReconcileWatermark,
+    Reservation,
+    RestaurantTable,
+    OpeningHours,
+)
+from monolith.geo import cell_of
+from monolith import time_windows
+
+
+def _add_column(connection, table: str, column: str, ddl: str):
+    """
+    Add the column to the table if it is not present
+    :param connection: the connection used by the migration
+    :param table: the table name
+    :param column: the column name
+    :param ddl: the type of column with the default value
+    """
+    columns = [info["name"] for info in inspect(connection).get_columns(table)]
+    if column not in columns:
+        connection.execute(
+            'ALTER TABLE "{}" ADD COLUMN {} {}'.format(table, column, ddl)
+        )
+
+
+def _restaurant_rating_aggregates(connection):
+    _add_column(connection, "restaurant", "review_count", "INTEGER DEFAULT 0")
+    _add_column(connection, "restaurant", "stars_sum", "FLOAT DEFAULT 0.0")
+    # the aggregates of the reviews already inside the database
+    connection.execute(
+        "UPDATE restaurant SET "
+        "review_count = (SELECT count(*) FROM review "
+        "WHERE review.restaurant_id = restaurant.id), "
+        "stars_sum = (SELECT coalesce(sum(CAST(stars AS FLOAT)), 0.0) FROM review "
+        "WHERE review.restaurant_id = restaurant.id)"
+    )
+
+
+def _review_restaurant_index(connection):
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS ix_review_restaurant_id ON review (restaurant_id)"
+    )
+
+
+## the search documents of the restaurants: name, cuisine types and dish names
+_SEARCH_DOCUMENTS = (
+    "INSERT INTO restaurant_search (rowid, name, cuisine, dishes) "
+    "SELECT restaurant.id, restaurant.name, "
+    "(SELECT group_concat(cusine, ' ') FROM menu "
+    "WHERE menu.restaurant_id = restaurant.id), "
+    "(SELECT group_concat(name, ' ') FROM menu_dish "
+    "WHERE menu_dish.restaurant_id = restaurant.id) "
+    "FROM restaurant"
+)
+
+## (trigger name, event, table, reference to the restaurant id)
+_SEARCH_TRIGGERS = [
+    ("restaurant_search_ai", "AFTER INSERT", "restaurant", "NEW.id"),
+    ("restaurant_search_au", "AFTER UPDATE OF name", "restaurant", "NEW.id"),
+    ("menu_search_ai", "AFTER INSERT", "menu", "NEW.restaurant_id"),
+    ("menu_search_au", "AFTER UPDATE", "menu", "NEW.restaurant_id"),
+    ("menu_search_ad", "AFTER DELETE", "menu", "OLD.restaurant_id"),
+    ("menu_dish_search_ai", "AFTER INSERT", "menu_dish", "NEW.restaurant_id"),
+    ("menu_dish_search_au", "AFTER UPDATE", "menu_dish", "NEW.restaurant_id"),
+    ("menu_dish_search_ad", "AFTER DELETE", "menu_dish", "OLD.restaurant_id"),
+]
+
+
+def _restaurant_search_index(connection):
+    """
+    Create the full text index of the restaurants (name, cuisine types and dishes)
+    with a FTS5 table, it is kept in sync by the triggers on the tables.
+    If the SQLite doesn't have the FTS5 module the search use the old LIKE.
+    """
+    if connection.dialect.name != "sqlite":
+        return
+    try:
+        connection.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS restaurant_search USING fts5("
+            "name, cuisine, dishes, prefix='2 3')"
+        )
+    except OperationalError:
+        # sqlite without the fts5 module
+        return
+    for name, event, table, ref in _SEARCH_TRIGGERS:
+        # rebuild the search document of the restaurant
+        connection.execute(
+            "CREATE TRIGGER IF NOT EXISTS {0} {1} ON {2} BEGIN "
+            "DELETE FROM restaurant_search WHERE rowid = {3}; "
+            "{4} WHERE restaurant.id = {3}; END".format(
+                name, event, table, ref, _SEARCH_DOCUMENTS
+            )
+        )
+    connection.execute(
+        "CREATE TRIGGER IF NOT EXISTS restaurant_search_ad AFTER DELETE ON restaurant "
+        "BEGIN DELETE FROM restaurant_search WHERE rowid = OLD.id; END"
+    )
+    # the restaurants already inside the database
+    connection.execute("DELETE FROM restaurant_search")
+    connection.execute(_SEARCH_DOCUMENTS)
+
+
+def _restaurant_geo_cell(connection):
+    _add_column(connection, "restaurant", "geo_cell", "INTEGER")
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS ix_restaurant_geo_cell ON restaurant (geo_cell)"
+    )
+    # the restaurants already inside the database
+    restaurants = connection.execute("SELECT id, lat, lon FROM restaurant").fetchall()
+    if len(restaurants) > 0:
+        connection.execute(
+            text("UPDATE restaurant SET geo_cell = :cell WHERE id = :id"),
+            [
+                {"cell": cell_of(restaurant.lat, restaurant.lon), "id": restaurant.id}
+                for restaurant in restaurants
+            ],
+        )
+
+
+def _model_indexes(connection):
+    """
+    Create all the indexes declared on the models, that create_all creates
+    only with the new tables. It can be used by each migration that adds an index.
+    """
+    inspector = inspect(connection)
+    for table in db.metadata.sorted_tables:
+        columns = [info["name"] for info in inspector.get_columns(table.name)]
+        for index in table.indexes:
+            if any(column.name not in columns for column in index.columns):
+                # the column is added by a next migration, that creates the index
+                continue
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS {} ON "{}" ({})'.format(
+                    index.name,
+                    table.name,
+                    ", ".join(column.name for column in index.columns),
+                )
+            )
+
+
+def _reservation_service_slot(connection):
+    _add_column(connection, "reservation", "service_slot", "VARCHAR(32)")
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS ix_reservation_service_slot "
+        "ON reservation (service_slot)"
+    )
+    # the reservations already inside the database, the weekday is computed
+    # in python because it is not portable between the databases
+    reservation = Reservation.__table__
+    table = RestaurantTable.__table__
+    reservations = connection.execute(
+        select(
+            [reservation.c.id, reservation.c.reservation_date, table.c.restaurant_id]
+        )
+        .select_from(reservation.join(table, table.c.id == reservation.c.table_id))
+        .where(reservation.c.reservation_date.isnot(None))
+    ).fetchall()
+    if len(reservations) == 0:
+        return
+    openings = {
+        (opening.restaurant_id, opening.week_day): opening
+        for opening in connection.execute(select([OpeningHours.__table__]))
+    }
+    connection.execute(
+        text("UPDATE reservation SET service_slot = :slot WHERE id = :id"),
+        [
+            {
+                "slot": time_windows.service_slot(
+                    row.restaurant_id,
+                    openings.get((row.restaurant_id, row.reservation_date.weekday())),
+                    row.reservation_date,
+                ),
+                "id": row.id,
+            }
+            for row in reservations
+        ],
+    )
+
+
+def _table_booking_version(connection):
+    _add_column(
+        connection, "restaurant_table", "booking_version", "INTEGER NOT NULL DEFAULT 0"
+    )
+
+
+def _rating_watermark(connection):
+    watermark = ReconcileWatermark.__table__
+    exists = connection.execute(
+        select([watermark.c.name]).where(watermark.c.name == "rating")
+    ).first()
+    if exists is None:
+        # the aggregates are aligned by the first migration, the reviews
+        # written after it are reconciled by the next run
+        connection.execute(watermark.insert().values(name="rating", last_id=0))
+
+
+def _outbox_dead_letter(connection):
+    _add_column(connection, "outbox", "dead", "BOOLEAN NOT NULL DEFAULT 0")
+
+
+## (version, description, function that apply the migration)
+MIGRATIONS = [
+    (1, "restaurant rating aggregates", _restaurant_rating_aggregates),
+    (2, "index of the reviews by restaurant", _review_restaurant_index),
+    (3, "full text search of the restaurants", _restaurant_search_index),
+    (4, "grid cell of the restaurants position", _restaurant_geo_cell),
+    (5, "indexes of the reservations hot paths", _model_indexes),
+    (6, "service slot of the reservations", _reservation_service_slot),
+    (7, "booking version of the tables", _table_booking_version),
+    (8, "watermark of the rating reconciliation", _rating_watermark),
+    (9, "dead letters of the outbox", _outbox_dead_letter),
+]
+
+
+def migrate():
+    """
+    Apply all the migrations not applied yet on the database.
+    It must be called inside the app context, after db.create_all()
+    :return: the list of versions applied
+    """
+    applied = {row.version for row in db.session.query(SchemaVersion.version)}
+    db.session.commit()
+    new_versions = []
+    for version, description, upgrade in MIGRATIONS:
+        if version in applied:
+            continue
+        with db.engine.begin() as connection:
+            upgrade(connection)
+            connection.execute(
+                SchemaVersion.__table__.insert().values(
+                    version=version,
+                    description=description,
+                    applied_at=datetime.now(),
+                )
+            )
+        new_versions.append(version)
+    return new_versions
@@ -1 +1,6 @@
-from .restaurant_model import RestaurantModel
+from .restaurant_model import (
+    RestaurantModel,
+    PhotoItem,
+    DishItem,
+    OpeningHoursItem,
+)
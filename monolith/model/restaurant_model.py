@@ -1,5 +1,15 @@
+from collections import namedtuple
+
 from monolith.database import Restaurant, Menu, PhotoGallery, MenuDish, OpeningHours
 
+## Read only copies of the rows, detached from the db session so the model can be cached
+PhotoItem = namedtuple("PhotoItem", ["id", "url", "caption"])
+DishItem = namedtuple("DishItem", ["id", "name", "price"])
+OpeningHoursItem = namedtuple(
+    "OpeningHoursItem",
+    ["week_day", "open_lunch", "close_lunch", "open_dinner", "close_dinner"],
+)
+
 
 class RestaurantModel:
     """
@@ -0,0 +1,131 @@
+"""
+Keyset pagination.
+
+The pages are not read with OFFSET, that reads and discards all the rows
+before the page, but starting after the key of the last row of the previous page,
+so each page is a range scan on the index of the key.
+The key is sent to the client inside an opaque cursor token.
+"""
+import base64
+import json
+from datetime import date, datetime
+
+from sqlalchemy import and_, not_, or_
+from sqlalchemy.types import Date, DateTime
+
+## default number of rows inside a page
+PAGE_SIZE = 30
+
+
+def encode_cursor(*key) -> str:
+    """
+    Return the cursor token with the key of the last row of the page
+    :param key: the values of the key, e.g. (id,) or (date, id)
+    :return: the token, safe to be used inside the urls
+    """
+    data = json.dumps(list(key), default=str, separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token: str):
+    """
+    Return the key inside the cursor token
+    :param token: the token created by encode_cursor
+    :return: the list of values of the key, None if the token is missing or not valid
+    """
+    if token is None or token == "":
+        return None
+    try:
+        data = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        key = json.loads(data.decode("utf-8"))
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if not isinstance(key, list):
+        return None
+    return key
+
+
+def paginate(
+    query,
+    key_columns,
+    cursor: str = None,
+    page_size: int = PAGE_SIZE,
+    descending: bool = False,
+):
+    """
+    Return a page of the query, ordered by the key columns.
+    The key must be unique (usually it ends with the id) and the values are
+    compared as a tuple, so the page starts after the last row of the previous one.
+    :param query: the query without order
+    :param key_columns: the columns of the key, e.g. (Restaurant.id,)
+    :param cursor: the token of the previous page, None for the first page
+    :param page_size: number of rows inside a page
+    :param descending: if True the rows are ordered from the biggest key
+    :return: (rows, token of the next page or None if this is the last page)
+    """
+    key = decode_cursor(cursor)
+    if key is not None and len(key) == len(key_columns):
+        try:
+            key = [_restore(column, value) for column, value in zip(key_columns, key)]
+        except ValueError:
+            key = None
+    if key is not None and len(key) == len(key_columns):
+        query = query.filter(_after(key_columns, key, descending))
+    if descending:
+        order = [column.desc() for column in key_columns]
+    else:
+        order = list(key_columns)
+    # one more row to know if there is a next page
+    rows = query.order_by(*order).limit(page_size + 1).all()
+    if len(rows) <= page_size:
+        return rows, None
+    rows = rows[:page_size]
+    last = rows[-1]
+    next_cursor = encode_cursor(*[getattr(last, column.key) for column in key_columns])
+    return rows, next_cursor
+
+
+def key_range(key_columns, low, high):
+    """
+    Return the condition low <= (c1, c2, ...) <= high, e.g. to read the other
+    columns of the rows of a page with a range scan instead of a list of ids
+    :param key_columns: the columns of the key
+    :param low: the values of the smallest key
+    :param high: the values of the biggest key
+    """
+    first = key_columns[0]
+    return and_(
+        first >= low[0],
+        first <= high[0],
+        not_(_after(key_columns, low, descending=True)),
+        not_(_after(key_columns, high)),
+    )
+
+
+def _after(key_columns, key, descending: bool = False):
+    """
+    Return the condition (c1, c2, ...) > (v1, v2, ...) expanded as
+    c1 > v1 OR (c1 = v1 AND c2 > v2) OR ..., that all the databases support.
+    With descending the condition is (c1, c2, ...) < (v1, v2, ...).
+    """
+    conditions = []
+    for index, column in enumerate(key_columns):
+        equals = [key_columns[i] == key[i] for i in range(index)]
+        if descending:
+            conditions.append(and_(*equals, column < key[index]))
+        else:
+            conditions.append(and_(*equals, column > key[index]))
+    return or_(*conditions)
+
+
+def _restore(column, value):
+    """
+    Return the value of the key with the python type of the column,
+    the dates are strings inside the token.
+    """
+    if isinstance(value, str):
+        if isinstance(column.type, DateTime):
+            return datetime.fromisoformat(value)
+        if isinstance(column.type, Date):
+            return date.fromisoformat(value)
+    return value
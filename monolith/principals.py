@@ -0,0 +1,172 @@
+"""
+Cache of the principals of the logged users.
+
+flask-login loads the user of the session at each request, and the login loads
+also the role and the restaurant of the operator. The principal keeps all of them,
+it is loaded with one query and kept inside a LRU cache of the process with a TTL,
+and optionally inside redis, shared by all the workers, so the authenticated pages
+don't read the user from the database.
+The principal must be invalidated when the user is changed or deleted, see
+UserService.modify_user and UserService.delete_user.
+"""
+import json
+import logging
+from datetime import datetime
+
+from monolith.cache import VersionedCache
+from monolith.database import db, User, Restaurant
+from monolith.roles import role_registry
+
+## seconds of life of a principal inside the cache of the process
+LOCAL_TTL = 60
+## seconds of life of a principal inside redis
+REDIS_TTL = 600
+## prefix of the keys inside redis
+REDIS_PREFIX = "gooutsafe:principal:"
+
+## the columns of the user copied inside the principal
+_USER_FIELDS = [
+    "id",
+    "email",
+    "phone",
+    "firstname",
+    "lastname",
+    "dateofbirth",
+    "is_active",
+    "is_admin",
+    "role_id",
+]
+
+logger = logging.getLogger(__name__)
+
+
+class Principal:
+    """
+    The logged user with the role and the restaurant of the operator,
+    detached from the database session.
+    It is the current_user of flask-login.
+    """
+
+    is_anonymous = False
+    is_authenticated = True
+
+    def __init__(self, values: dict) -> None:
+        for field in _USER_FIELDS:
+            setattr(self, field, values.get(field))
+        ## the value of the role, e.g. "OPERATOR"
+        self.role = values.get("role")
+        ## the restaurant of the operator
+        self.restaurant_id = values.get("restaurant_id")
+        self.restaurant_name = values.get("restaurant_name")
+
+    def get_id(self):
+        return self.id
+
+
+class PrincipalCache:
+    """
+    Two levels cache of the principals: a VersionedCache inside the process and,
+    if it is configured, redis.
+    The cache of the process is invalidated only inside the process, so the
+    LOCAL_TTL is the upper bound of a stale principal in the other workers.
+    """
+
+    def __init__(self) -> None:
+        self._local = VersionedCache(ttl=LOCAL_TTL, max_size=4096)
+        self._redis = None
+
+    def configure(self, redis_url: str = None):
+        """
+        Use redis as second level, without url only the cache of the process is used
+        :param redis_url: e.g. redis://rd01:6379/1
+        """
+        self._local.invalidate()
+        if redis_url is None or redis_url == "":
+            self._redis = None
+            return
+        import redis
+
+        self._redis = redis.Redis.from_url(redis_url, socket_timeout=0.5)
+
+    def get(self, user_id: int):
+        """
+        Return the principal of the user
+        :param user_id: the user id
+        :return: Principal or None if the user doesn't exist
+        """
+        # flask-login gives the id of the session as a string
+        return self._local.get(str(user_id), lambda: self._load(int(user_id)))
+
+    def invalidate(self, user_id: int):
+        """
+        Remove the principal of the user, after a change of the user
+        """
+        self._local.invalidate(str(user_id))
+        if self._redis is not None:
+            try:
+                self._redis.delete(REDIS_PREFIX + str(user_id))
+            except Exception as error:
+                logger.warning("Principal cache: redis not available %s", error)
+
+    def _load(self, user_id: int):
+        values = self._redis_get(user_id)
+        if values is None:
+            values = load_principal_values(user_id)
+            if values is None:
+                return None
+            self._redis_set(user_id, values)
+        return Principal(values)
+
+    def _redis_get(self, user_id: int):
+        if self._redis is None:
+            return None
+        try:
+            data = self._redis.get(REDIS_PREFIX + str(user_id))
+        except Exception as error:
+            logger.warning("Principal cache: redis not available %s", error)
+            return None
+        if data is None:
+            return None
+        values = json.loads(data)
+        if values.get("dateofbirth") is not None:
+            values["dateofbirth"] = datetime.fromisoformat(values["dateofbirth"])
+        return values
+
+    def _redis_set(self, user_id: int, values: dict):
+        if self._redis is None:
+            return
+        try:
+            self._redis.setex(
+                REDIS_PREFIX + str(user_id),
+                REDIS_TTL,
+                json.dumps(values, default=lambda value: value.isoformat()),
+            )
+        except Exception as error:
+            logger.warning("Principal cache: redis not available %s", error)
+
+
+def load_principal_values(user_id: int):
+    """
+    Load the user and the restaurant of the operator with one query,
+    the role is read from the registry
+    :param user_id: the user id
+    :return: the dictionary of the values of the principal or None
+    """
+    row = (
+        db.session.query(User, Restaurant.id, Restaurant.name)
+        .outerjoin(Restaurant, Restaurant.owner_id == User.id)
+        .filter(User.id == user_id)
+        .order_by(Restaurant.id)
+        .first()
+    )
+    if row is None:
+        return None
+    user, restaurant_id, restaurant_name = row
+    values = {field: getattr(user, field) for field in _USER_FIELDS}
+    values["role"] = role_registry.value_of(user.role_id)
+    values["restaurant_id"] = restaurant_id
+    values["restaurant_name"] = restaurant_name
+    return values
+
+
+principal_cache = PrincipalCache()
@@ -0,0 +1,88 @@
+"""
+Registry of the roles of the users.
+
+The Role table has only the static rows created with the app (admin, operator,
+customer and health authority), so they are read once at the start of the app
+inside immutable maps, and the checks of the roles are lookups on these maps
+instead of queries at each request.
+"""
+from collections import namedtuple
+from types import MappingProxyType
+
+from monolith.database import db, Role
+
+## the values of the roles, the same of the Role table
+ADMIN = "ADMIN"
+OPERATOR = "OPERATOR"
+CUSTOMER = "CUSTOMER"
+HEALTH = "HEALTH"
+ROLES = frozenset([ADMIN, OPERATOR, CUSTOMER, HEALTH])
+
+## a row of the Role table, detached from the database session
+RoleEntry = namedtuple("RoleEntry", ["id", "value", "label"])
+
+
+class RoleRegistry:
+    """
+    The roles by id and by value, loaded from the Role table with load()
+    """
+
+    def __init__(self) -> None:
+        self._by_id = MappingProxyType({})
+        self._by_value = MappingProxyType({})
+
+    def load(self):
+        """
+        Read the roles from the database, it must be called after the roles
+        are created, e.g. inside create_app
+        """
+        roles = [
+            RoleEntry(row.id, row.value, row.label)
+            for row in db.session.query(Role.id, Role.value, Role.label)
+        ]
+        # the maps are replaced together, the readers never see a half registry
+        self._by_id = MappingProxyType({role.id: role for role in roles})
+        self._by_value = MappingProxyType({role.value: role for role in roles})
+
+    def by_id(self, role_id: int):
+        """
+        Return the role with the id
+        :param role_id: the role id, e.g. User.role_id
+        :return: RoleEntry or None if the role doesn't exist
+        """
+        if len(self._by_id) == 0:
+            self.load()
+        return self._by_id.get(role_id)
+
+    def by_value(self, value: str):
+        """
+        Return the role with the value
+        :param value: the role value, e.g. "OPERATOR"
+        :return: RoleEntry or None if the role doesn't exist
+        """
+        if len(self._by_value) == 0:
+            self.load()
+        return self._by_value.get(value)
+
+    def value_of(self, role_id: int):
+        """
+        Return the value of the role with the id, or None
+        """
+        role = self.by_id(role_id)
+        return None if role is None else role.value
+
+
+def allowed_roles(roles) -> frozenset:
+    """
+    Return the set of the roles, checked against the known roles
+    :param roles: iterable of role values, e.g. ["OPERATOR"]
+    :raise ValueError: if a role is unknown
+    """
+    allowed = frozenset(roles)
+    unknown = allowed - ROLES
+    if len(unknown) > 0:
+        raise ValueError("Unknown roles {}".format(sorted(unknown)))
+    return allowed
+
+
+role_registry = RoleRegistry()
@@ -1,4 +1,6 @@
-from .user_service import *
+from .user_service import UserService
 from .restaurant_services import RestaurantServices
-from .healthy_services import *
-from .booking_services import *
+from .nearby_restaurants import NearbyRestaurants
+from .restaurant_import import RestaurantImport
+from .healthy_services import HealthyServices
+from .booking_services import BookingServices
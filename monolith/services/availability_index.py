@@ -0,0 +1,378 @@
+import bisect
+import datetime
+import math
+import random
+import threading
+from collections import namedtuple
+
+from monolith.database import (
+    db,
+    RestaurantTable,
+    Reservation,
+    Restaurant,
+    OpeningHours,
+)
+
+## Opening hours of a week day, detached from the db session
+OpeningSlot = namedtuple(
+    "OpeningSlot", ["open_lunch", "close_lunch", "open_dinner", "close_dinner"]
+)
+
+
+def is_open(opening, only_time) -> bool:
+    """
+    Check if the restaurant takes the bookings at the time, the time can be
+    the close of the lunch or of the dinner
+    :param opening: the OpeningSlot of the week day, None if the restaurant
+    is closed in the week day
+    :param only_time: the time of the booking
+    """
+    if opening is None:
+        return False
+
+    # strange situation.. but it could be happen
+    # opening hour is in db but the resturant is closed both lunch and dinner
+    if opening.open_lunch is None and opening.open_dinner is None:
+        return False
+
+    # if the resturant is open only at lunch or at dinner do some checks..
+    if (opening.open_lunch is None or opening.close_lunch is None) and (
+        only_time < opening.open_dinner or only_time > opening.close_dinner
+    ):
+        return False
+
+    if (opening.open_dinner is None or opening.close_dinner is None) and (
+        only_time < opening.open_lunch or only_time > opening.close_lunch
+    ):
+        return False
+
+    # if the resturant is opened both at dinner and lunch
+    if opening.open_lunch is not None and opening.open_dinner is not None:
+        # asked for some hours outside the opening hours
+        if opening.open_lunch > only_time:
+            return False
+
+        if opening.open_dinner > only_time and opening.close_lunch < only_time:
+            return False
+
+        if opening.close_dinner < only_time:
+            return False
+    return True
+
+
+class RestaurantAvailability:
+    """
+    This object contains the in memory picture of one restaurant used
+    to book a table without scanning all the reservations on the database.
+
+    The tables are kept sorted by (max_seats, id), so the smallest table that fits
+    a party is found with a bisect, and each table has the list of the booked slots
+    sorted by start date with the max end of the slots up to each one, so the
+    overlap check is a bisect too, also with slots of different durations.
+    """
+
+    def __init__(self, restaurant_id: int, name: str, avg_time: int) -> None:
+        self.restaurant_id = restaurant_id
+        self.name = name
+        self.avg_time = avg_time
+        ## week_day -> OpeningSlot
+        self.opening_hours = {}
+        ## sorted array of (max_seats, table_id)
+        self.tables = []
+        ## table_id -> table name
+        self.table_names = {}
+        ## table_id -> sorted array of the start of each booked slot
+        self.starts = {}
+        ## table_id -> array of (start, end, reservation_id), same order of starts
+        self.slots = {}
+        ## table_id -> array of the max end of the slots up to each index
+        self.max_ends = {}
+
+    def add_table(self, table_id: int, name: str, max_seats: int):
+        bisect.insort(self.tables, (max_seats, table_id))
+        self.table_names[table_id] = name
+        self.starts[table_id] = []
+        self.slots[table_id] = []
+        self.max_ends[table_id] = []
+
+    def add_slot(self, table_id: int, reservation_id: int, start, end):
+        """
+        Register a booked slot on the table
+        """
+        if table_id not in self.slots:
+            return
+        index = bisect.bisect_right(self.starts[table_id], start)
+        self.starts[table_id].insert(index, start)
+        self.slots[table_id].insert(index, (start, end, reservation_id))
+        self.max_ends[table_id].insert(index, end)
+        self._update_max_ends(table_id, index)
+
+    def remove_slot(self, table_id: int, reservation_id: int, start):
+        """
+        Remove the booked slot of the reservation from the table
+        """
+        if table_id not in self.slots:
+            return
+        starts = self.starts[table_id]
+        slots = self.slots[table_id]
+        index = bisect.bisect_left(starts, start)
+        while index < len(starts) and starts[index] == start:
+            if slots[index][2] == reservation_id:
+                del starts[index]
+                del slots[index]
+                del self.max_ends[table_id][index]
+                self._update_max_ends(table_id, index)
+                return
+            index += 1
+
+    def remove_table(self, table_id: int):
+        """
+        Remove the table with all its booked slots
+        :return: the ids of the reservations of the table
+        """
+        if table_id not in self.slots:
+            return []
+        self.tables = [table for table in self.tables if table[1] != table_id]
+        self.table_names.pop(table_id, None)
+        del self.starts[table_id]
+        del self.max_ends[table_id]
+        return [slot[2] for slot in self.slots.pop(table_id)]
+
+    def is_free(self, table_id: int, start, end) -> bool:
+        """
+        Check if the table has no booked slot that overlaps [start, end].
+        The bounds are inclusive, as the previous query with the between.
+        """
+        starts = self.starts[table_id]
+        # all the slots that start before the end of the new one
+        index = bisect.bisect_right(starts, end)
+        if index == 0:
+            return True
+        # a slot that starts earlier can end later than the last one
+        return self.max_ends[table_id][index - 1] < start
+
+    def _update_max_ends(self, table_id: int, index: int):
+        """
+        Compute again the max ends of the table from the index to the last slot
+        """
+        slots = self.slots[table_id]
+        max_ends = self.max_ends[table_id]
+        for position in range(index, len(slots)):
+            end = slots[position][1]
+            if position > 0 and max_ends[position - 1] > end:
+                end = max_ends[position - 1]
+            max_ends[position] = end
+
+    def find_table(self, people_number: int, start, end, spread: bool = False):
+        """
+        Return the id of the smallest free table with at least people_number seats
+        :param people_number: number of people of the reservation
+        :param start: start of the reservation
+        :param end: end of the reservation
+        :param spread: if True the search starts from a random table among the
+        tables with the same seats, so the bookings that run in parallel don't
+        try all the same table
+        :return: the table id or None if there aren't free tables
+        """
+        index = bisect.bisect_left(self.tables, (people_number, -1))
+        while index < len(self.tables):
+            # the tables with the same seats
+            seats = self.tables[index][0]
+            last = bisect.bisect_right(self.tables, (seats, math.inf), index)
+            group = self.tables[index:last]
+            offset = random.randrange(len(group)) if spread else 0
+            for _, table_id in group[offset:] + group[:offset]:
+                if self.is_free(table_id, start, end):
+                    return table_id
+            index = last
+        return None
+
+
+class TableAvailabilityIndex:
+    """
+    This class keep for each restaurant a RestaurantAvailability loaded lazily
+    from the database, and it is kept up to date by the BookingServices
+    on book, update and delete.
+
+    The index lives inside the process, so it can be stale if the database is
+    changed from outside (e.g another worker), for this reason the BookingServices
+    confirm on the database the table chosen and reload the restaurant when the index
+    is not aligned.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.RLock()
+        ## restaurant_id -> RestaurantAvailability
+        self._restaurants = {}
+        ## reservation_id -> (restaurant_id, table_id, start)
+        self._reservations = {}
+
+    def get(self, restaurant_id: int, reload: bool = False):
+        """
+        Return the RestaurantAvailability of the restaurant, loading it from the
+        database if it is not inside the index.
+        :param restaurant_id: the restaurant id
+        :param reload: if True the restaurant is loaded again from the database
+        :return: RestaurantAvailability or None if the restaurant doesn't exist
+        """
+        with self._lock:
+            if reload:
+                self.invalidate(restaurant_id)
+            availability = self._restaurants.get(restaurant_id)
+            if availability is None:
+                availability = self._load(restaurant_id)
+                if availability is not None:
+                    self._restaurants[restaurant_id] = availability
+            return availability
+
+    def add_reservation(self, restaurant_id: int, reservation: Reservation):
+        """
+        Register a new reservation inside the index
+        """
+        with self._lock:
+            availability = self._restaurants.get(restaurant_id)
+            if availability is None:
+                return
+            availability.add_slot(
+                reservation.table_id,
+                reservation.id,
+                reservation.reservation_date,
+                reservation.reservation_end,
+            )
+            self._reservations[reservation.id] = (
+                restaurant_id,
+                reservation.table_id,
+                reservation.reservation_date,
+            )
+
+    def remove_reservation(self, reservation_id: int):
+        """
+        Remove the reservation from the index, if it is present
+        """
+        with self._lock:
+            position = self._reservations.pop(reservation_id, None)
+            if position is None:
+                return
+            restaurant_id, table_id, start = position
+            availability = self._restaurants.get(restaurant_id)
+            if availability is not None:
+                availability.remove_slot(table_id, reservation_id, start)
+
+    def refresh_table(self, restaurant_id: int, table_id: int):
+        """
+        Load again from the database only one table of the restaurant with its
+        booked slots, e.g. when the table was booked by another worker.
+        It is cheaper than reload all the restaurant.
+        :return: the RestaurantAvailability or None if the restaurant doesn't exist
+        """
+        with self._lock:
+            availability = self._restaurants.get(restaurant_id)
+            if availability is None:
+                return self.get(restaurant_id)
+            for reservation_id in availability.remove_table(table_id):
+                self._reservations.pop(reservation_id, None)
+            table = (
+                db.session.query(RestaurantTable.name, RestaurantTable.max_seats)
+                .filter_by(id=table_id, restaurant_id=restaurant_id)
+                .first()
+            )
+            if table is None:
+                # the table was deleted
+                return availability
+            availability.add_table(table_id, table.name, table.max_seats)
+            reservations = db.session.query(
+                Reservation.id,
+                Reservation.table_id,
+                Reservation.reservation_date,
+                Reservation.reservation_end,
+            ).filter(
+                Reservation.table_id == table_id,
+                Reservation.reservation_end >= datetime.datetime.now(),
+            )
+            self._add_reservations(availability, reservations)
+            return availability
+
+    def invalidate(self, restaurant_id: int = None):
+        """
+        Drop the restaurant from the index, it will be loaded again from the database
+        at the next request. Without restaurant_id all the index is dropped.
+        """
+        with self._lock:
+            if restaurant_id is None:
+                self._restaurants.clear()
+                self._reservations.clear()
+                return
+            self._restaurants.pop(restaurant_id, None)
+            for reservation_id, position in list(self._reservations.items()):
+                if position[0] == restaurant_id:
+                    del self._reservations[reservation_id]
+
+    def _load(self, restaurant_id: int):
+        """
+        Load the restaurant with tables, opening hours and the reservations
+        not ended yet from the database.
+        """
+        restaurant = (
+            db.session.query(Restaurant.name, Restaurant.avg_time)
+            .filter_by(id=restaurant_id)
+            .first()
+        )
+        if restaurant is None:
+            return None
+        availability = RestaurantAvailability(
+            restaurant_id, restaurant.name, restaurant.avg_time
+        )
+
+        openings = db.session.query(OpeningHours).filter_by(restaurant_id=restaurant_id)
+        for opening in openings:
+            availability.opening_hours[opening.week_day] = OpeningSlot(
+                opening.open_lunch,
+                opening.close_lunch,
+                opening.open_dinner,
+                opening.close_dinner,
+            )
+
+        tables = db.session.query(
+            RestaurantTable.id, RestaurantTable.name, RestaurantTable.max_seats
+        ).filter_by(restaurant_id=restaurant_id)
+        for table in tables:
+            availability.add_table(table.id, table.name, table.max_seats)
+
+        # the past reservations are not useful, we can't book in the past
+        reservations = (
+            db.session.query(
+                Reservation.id,
+                Reservation.table_id,
+                Reservation.reservation_date,
+                Reservation.reservation_end,
+            )
+            .join(RestaurantTable, RestaurantTable.id == Reservation.table_id)
+            .filter(
+                RestaurantTable.restaurant_id == restaurant_id,
+                Reservation.reservation_end >= datetime.datetime.now(),
+            )
+        )
+        self._add_reservations(availability, reservations)
+        return availability
+
+    def _add_reservations(self, availability, reservations):
+        """
+        Register the reservations loaded from the database inside the index
+        :param availability: the RestaurantAvailability of the restaurant
+        :param reservations: rows (id, table_id, reservation_date, reservation_end)
+        """
+        for reservation in reservations:
+            availability.add_slot(
+                reservation.table_id,
+                reservation.id,
+                reservation.reservation_date,
+                reservation.reservation_end,
+            )
+            self._reservations[reservation.id] = (
+                availability.restaurant_id,
+                reservation.table_id,
+                reservation.reservation_date,
+            )
+
+
+availability_index = TableAvailabilityIndex()
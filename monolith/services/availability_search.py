@@ -0,0 +1,188 @@
+"""
+Search of the free slots of a restaurant.
+
+The customers see all the moments of a day where a party can book, instead of
+trying the bookings one by one. The slots of a day are computed with the same
+rules of the BookingServices: the opening hours of the availability index and
+the free tables with enough seats, where the reservations of the day are read
+with one query.
+The slots are kept inside a cache by (restaurant, day, people), all the slots
+of a restaurant are invalidated with a new generation of the restaurant by the
+bookings, the updates and the deletes of its reservations, and by the changes
+of its tables.
+"""
+import itertools
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+from monolith.cache import VersionedCache
+from monolith.database import db, Reservation, RestaurantTable
+from monolith.services.availability_index import (
+    RestaurantAvailability,
+    availability_index,
+    is_open,
+)
+from monolith import time_windows
+
+## minutes between two slots of a day
+SLOT_STEP = 15
+## max people of a search, the biggest party of the cache
+MAX_PARTY_SIZE = 20
+## max days of a search
+MAX_SEARCH_DAYS = 14
+## seconds of life of the slots inside the cache, it is the upper bound of
+## stale slots when the reservations are changed by another worker
+SLOTS_TTL = 60
+
+## a moment where the party can book, with the number of free tables
+FreeSlot = namedtuple("FreeSlot", ["start", "free_tables"])
+
+## (restaurant id, generation, day, people) -> tuple of FreeSlot
+_slots_cache = VersionedCache(ttl=SLOTS_TTL, max_size=4096)
+## restaurant id -> generation of the slots of the restaurant, a new one is taken
+## after an invalidation. The generations are never used again, so a generation
+## removed by the LRU policy is replaced by a new one without old slots
+_generations = VersionedCache(max_size=4096)
+_next_generation = itertools.count(1)
+
+
+class AvailabilitySearch:
+    """
+    This service finds the free slots of a restaurant in a range of days
+    """
+
+    @staticmethod
+    def search(restaurant_id: int, people_number: int, from_day, to_day=None):
+        """
+        Return the slots where the party can book, from now
+        :param restaurant_id: the restaurant id
+        :param people_number: the people of the party
+        :param from_day: the first day, a date or an iso string e.g. "2020-10-07"
+        :param to_day: the last day, a date or an iso string, None for only from_day
+        :return: list of FreeSlot ordered by start, None if the restaurant
+        doesn't exist
+        :raise ValueError: if the days or the people are not valid
+        """
+        from_day = _as_day(from_day)
+        to_day = from_day if to_day is None else _as_day(to_day)
+        if not 0 < people_number <= MAX_PARTY_SIZE:
+            raise ValueError(
+                "The people must be between 1 and {}".format(MAX_PARTY_SIZE)
+            )
+        days = (to_day - from_day).days + 1
+        if not 0 < days <= MAX_SEARCH_DAYS:
+            raise ValueError(
+                "The days must be between 1 and {}".format(MAX_SEARCH_DAYS)
+            )
+
+        now = datetime.now()
+        slots = []
+        for day in range(days):
+            day_slots = AvailabilitySearch.day_slots(
+                restaurant_id, from_day + timedelta(days=day), people_number
+            )
+            if day_slots is None:
+                return None
+            # we can't book in the past
+            slots.extend(slot for slot in day_slots if slot.start >= now)
+        return slots
+
+    @staticmethod
+    def day_slots(restaurant_id: int, day: date, people_number: int):
+        """
+        Return all the slots of the day where the party can book, from the cache
+        :return: tuple of FreeSlot, None if the restaurant doesn't exist
+        """
+        restaurant_id = int(restaurant_id)
+        return _slots_cache.get(
+            _key(restaurant_id, day, people_number),
+            lambda: AvailabilitySearch._load_day(restaurant_id, day, people_number),
+        )
+
+    @staticmethod
+    def invalidate(restaurant_id: int):
+        """
+        Remove all the slots of the restaurant, it must be called after each
+        booking, update or delete of a reservation of the restaurant, after a
+        change of the tables or of the opening hours, and after a new restaurant
+        because the id could be used before by a deleted restaurant
+        :param restaurant_id: the restaurant id
+        """
+        _generations.invalidate(int(restaurant_id))
+
+    @staticmethod
+    def _load_day(restaurant_id: int, day: date, people_number: int):
+        """
+        Compute the slots of the day, the tables and the opening hours are read
+        from the availability index and the reservations of the day with one query
+        """
+        availability = availability_index.get(restaurant_id)
+        if availability is None:
+            return None
+        opening = availability.opening_hours.get(day.weekday())
+        duration = timedelta(minutes=availability.avg_time)
+        start, end = time_windows.day_window(day)
+
+        # a picture of the day with only the tables that fit the party
+        picture = RestaurantAvailability(
+            restaurant_id, availability.name, availability.avg_time
+        )
+        for max_seats, table_id in availability.tables:
+            if max_seats >= people_number:
+                picture.add_table(
+                    table_id, availability.table_names[table_id], max_seats
+                )
+        if len(picture.tables) == 0 or opening is None:
+            return ()
+        reservations = (
+            db.session.query(
+                Reservation.id,
+                Reservation.table_id,
+                Reservation.reservation_date,
+                Reservation.reservation_end,
+            )
+            .join(RestaurantTable, RestaurantTable.id == Reservation.table_id)
+            .filter(
+                RestaurantTable.restaurant_id == restaurant_id,
+                Reservation.reservation_date <= end + duration,
+                Reservation.reservation_end >= start,
+            )
+        )
+        for reservation in reservations:
+            picture.add_slot(
+                reservation.table_id,
+                reservation.id,
+                reservation.reservation_date,
+                reservation.reservation_end,
+            )
+
+        slots = []
+        moment = start
+        while moment < end:
+            if is_open(opening, moment.time()):
+                free_tables = sum(
+                    1
+                    for _, table_id in picture.tables
+                    if picture.is_free(table_id, moment, moment + duration)
+                )
+                if free_tables > 0:
+                    slots.append(FreeSlot(moment, free_tables))
+            moment += timedelta(minutes=SLOT_STEP)
+        return tuple(slots)
+
+
+def _key(restaurant_id: int, day: date, people_number: int):
+    generation = _generations.get(restaurant_id, lambda: next(_next_generation))
+    return (restaurant_id, generation, day, people_number)
+
+
+def _as_day(day) -> date:
+    """
+    Return the day as a date
+    :raise ValueError: if the day is not a valid iso date
+    """
+    if isinstance(day, datetime):
+        return day.date()
+    if isinstance(day, date):
+        return day
+    return date.fromisoformat(day)
@@ -1,6 +1,11 @@
 import datetime
-from sqlalchemy import or_
-from monolith.utils.dispaccer_events import DispatcherMessage, CONFIRMATION_BOOKING
+from flask import current_app
+from monolith.app_constant import CONFIRMATION_BOOKING
+from monolith.services.availability_index import availability_index, is_open
+from monolith.services.availability_search import AvailabilitySearch
+from monolith.services.outbox import NotificationOutbox, outbox_worker
+from monolith.services.restaurant_services import RestaurantServices
+from monolith import time_windows
 
 from monolith.database import (
     db,
@@ -12,6 +17,14 @@ from monolith.database import (
     Friend,
 )
 
+## how many times the index is reloaded from the database before giving up
+_MAX_INDEX_ATTEMPTS = 3
+## how many stale tables are loaded again before reload all the restaurant
+_MAX_STALE_TABLES = 10
+## how many times a table is claimed before giving up, when the tables are
+## taken by the bookings that run in parallel
+_MAX_CLAIM_ATTEMPTS = 5
+
 
 class BookingServices:
     @staticmethod
@@ -23,11 +36,71 @@ class BookingServices:
             return (None, "You need to specify ONE mail for each person")
 
         restaurant_id = int(restaurant_id)
-        #
+        availability, opening_hour, error = BookingServices._check_request(
+            restaurant_id, current_user, py_datetime
+        )
+        if availability is None:
+            return (None, error)
+
+        # now let's see if there is a table, and claim it before another booking
+        end_datetime = py_datetime + datetime.timedelta(minutes=availability.avg_time)
+        availability, table_id, error = BookingServices._take_free_table(
+            availability, people_number, py_datetime, end_datetime
+        )
+        if table_id is None:
+            return (None, error)
+
+        restaurant_name = availability.name
+        table_name = availability.table_names[table_id]
+
+        # register on db the reservation
+        new_reservation = Reservation()
+        new_reservation.reservation_date = py_datetime
+        new_reservation.reservation_end = end_datetime
+        new_reservation.customer_id = current_user.id
+        new_reservation.table_id = table_id
+        new_reservation.people_number = people_number
+        new_reservation.service_slot = time_windows.service_slot(
+            restaurant_id, opening_hour, py_datetime
+        )
+        db.session.add(new_reservation)
+        db.session.flush()
+
+        # register friends
+        for friend_mail in splitted_friends:
+            new_friend = Friend()
+            new_friend.reservation_id = new_reservation.id
+            new_friend.email = friend_mail.strip()
+            db.session.add(new_friend)
+        # the confirmation is committed with the reservation, and sent by the relay
+        NotificationOutbox.add(
+            CONFIRMATION_BOOKING,
+            [
+                current_user.email,
+                current_user.email,
+                restaurant_name,
+                splitted_friends,
+                new_reservation.reservation_date,
+            ],
+        )
+        db.session.commit()
+        availability_index.add_reservation(restaurant_id, new_reservation)
+        AvailabilitySearch.invalidate(restaurant_id)
+        RestaurantServices.invalidate_restaurant_people(restaurant_id)
+        outbox_worker.wake()
+        return (new_reservation, restaurant_name, table_name)
 
+    @staticmethod
+    def _check_request(restaurant_id: int, current_user, py_datetime):
+        """
+        Check that the user can book in the restaurant at the date, the same
+        checks of a new booking and of a change of a booking
+        :return: (RestaurantAvailability, opening hours of the day, None) or
+        (None, None, the error message)
+        """
         # if user wants to book in the past..
         if py_datetime < datetime.datetime.now():
-            return (None, "You can not book in the past!")
+            return (None, None, "You can not book in the past!")
         # check if the user is positive
         is_positive = (
             db.session.query(Positive)
@@ -36,163 +109,156 @@ class BookingServices:
             .first()
         )
         if is_positive:
-            return (None, "You are marked as positive!")
+            return (None, None, "You are marked as positive!")
 
         week_day = py_datetime.weekday()
         only_time = py_datetime.time()
 
+        # the restaurant with tables, opening hours and booked slots are inside the index
+        availability = availability_index.get(restaurant_id)
+        if availability is None:
+            current_app.logger.warning(
+                "Booking: restaurant %s not found", restaurant_id
+            )
+            return (None, None, "The restaurant is closed")
+
         # check if the restaurant is open. 12 in open_lunch means open at lunch. 20 in open_dinner means open at dinner.
-        opening_hour = (
-            db.session.query(OpeningHours)
-            .filter_by(restaurant_id=restaurant_id)
-            .filter_by(week_day=week_day)
-            .first()
-        )
+        opening_hour = availability.opening_hours.get(week_day)
 
         # the restaurant is closed
         if opening_hour is None:
             print("No Opening hour")
-            return (None, "The restaurant is closed")
-
-        # strange situation.. but it could be happen
-        # opening hour is in db but the resturant is closed both lunch and dinner
-        if opening_hour.open_lunch is None and opening_hour.open_dinner is None:
-            return (None, "The restaurant is closed")
-
-        # if the resturant is open only at lunch or at dinner do some checks..
-        if (opening_hour.open_lunch is None or opening_hour.close_lunch is None) and (
-            only_time < opening_hour.open_dinner
-            or only_time > opening_hour.close_dinner
-        ):
-            return (None, "The restaurant is closed")
-
-        if (opening_hour.open_dinner is None or opening_hour.close_dinner is None) and (
-            only_time < opening_hour.open_lunch or only_time > opening_hour.close_lunch
-        ):
-            return (None, "The restaurant is closed")
-        #
-
-        # if the resturant is opened both at dinner and lunch
-        if opening_hour.open_lunch is not None and opening_hour.open_dinner is not None:
-            # asked for some hours outside the opening hours
-            if opening_hour.open_lunch > only_time:
-                return (None, "The restaurant is closed")
-
-            if (
-                opening_hour.open_dinner > only_time
-                and opening_hour.close_lunch < only_time
-            ):
-                return (None, "The restaurant is closed")
-
-            if opening_hour.close_dinner < only_time:
-                return (None, "The restaurant is closed")
-            #
-
-        # now let's see if there is a table
+            return (None, None, "The restaurant is closed")
+
+        if not is_open(opening_hour, only_time):
+            return (None, None, "The restaurant is closed")
+        return (availability, opening_hour, None)
 
+    @staticmethod
+    def _take_free_table(availability, people_number, start, end):
         """
-        get the time delta (avg_time) from the restaurant table
+        Find a free table and claim it inside the current transaction
+        :return: (RestaurantAvailability, table id, None) or
+        (RestaurantAvailability, None, the error message)
         """
-        avg_time = (
-            db.session.query(Restaurant).filter_by(id=restaurant_id).first().avg_time
-        )
+        restaurant_id = availability.restaurant_id
+        for attempt in range(_MAX_CLAIM_ATTEMPTS):
+            table = BookingServices._find_free_table(
+                availability, people_number, start, end
+            )
+            if table is None:
+                return (availability, None, "no tables available")
+            table_id, version = table
+            if BookingServices._claim_table(table_id, version):
+                return (availability, table_id, None)
+            # the table was booked in parallel, look again on the new picture
+            db.session.rollback()
+            availability = availability_index.refresh_table(restaurant_id, table_id)
+            if availability is None:
+                return (None, None, "The restaurant is closed")
+        return (availability, None, "no tables available")
 
+    @staticmethod
+    def _find_free_table(availability, people_number, start, end):
         """
-        get all the reservation (with the reservation_date between the dates in which I want to book)
-        or (or the reservation_end between the dates in which I want to book)
-        the dates in which I want to book are:
-        start = py_datetime  
-        end = py_datetime + avg_time
+        Look for the smallest free table inside the index and confirm it on the database.
+        If the index is not aligned with the database (e.g. a reservation made by
+        another worker) the table is loaded again and the search goes on with the
+        next table, and when the index has no free tables all the restaurant is
+        loaded again from the database and the search is repeated.
+        :return: (table id, booking version of the table) or None if there aren't free tables
+        """
+        restaurant_id = availability.restaurant_id
+        for attempt in range(_MAX_INDEX_ATTEMPTS):
+            for _ in range(_MAX_STALE_TABLES):
+                table_id = availability.find_table(
+                    people_number, start, end, spread=True
+                )
+                if table_id is None:
+                    break
+                version = BookingServices._free_table_version(
+                    restaurant_id, table_id, people_number, start, end
+                )
+                if version is not None:
+                    return table_id, version
+                availability = availability_index.refresh_table(restaurant_id, table_id)
+                if availability is None:
+                    return None
+            if attempt + 1 < _MAX_INDEX_ATTEMPTS:
+                availability = availability_index.get(restaurant_id, reload=True)
+                if availability is None:
+                    return None
+        return None
 
-        always filtered by the people_number  
+    @staticmethod
+    def _free_table_version(
+        restaurant_id,
+        table_id,
+        people_number,
+        start,
+        end,
+        exclude_reservation_id: int = None,
+    ):
+        """
+        Confirm on the database that the table exists and that there are no
+        reservation that overlaps [start, end] on it.
+        The check and the version are read by the same query, so the version is
+        the one of the reservations checked.
+        :param exclude_reservation_id: a reservation that doesn't take the table,
+        e.g. the reservation that is moved
+        :return: the booking version of the table, None if the table is not free
         """
-        reservations = (
-            db.session.query(RestaurantTable.id)
-            .join(Reservation, RestaurantTable.id == Reservation.table_id)
-            .filter(RestaurantTable.restaurant_id == restaurant_id)
+        overlap = db.session.query(Reservation.id).filter(
+            Reservation.table_id == RestaurantTable.id,
+            Reservation.reservation_date <= end,
+            Reservation.reservation_end >= start,
+        )
+        if exclude_reservation_id is not None:
+            overlap = overlap.filter(Reservation.id != exclude_reservation_id)
+        overlap = overlap.exists()
+        table = (
+            db.session.query(RestaurantTable.booking_version)
             .filter(
-                or_(
-                    Reservation.reservation_date.between(
-                        py_datetime, py_datetime + datetime.timedelta(minutes=avg_time)
-                    ),
-                    Reservation.reservation_end.between(
-                        py_datetime, py_datetime + datetime.timedelta(minutes=avg_time)
-                    ),
-                )
+                RestaurantTable.id == table_id,
+                RestaurantTable.restaurant_id == restaurant_id,
+                RestaurantTable.max_seats >= people_number,
+                ~overlap,
             )
-            .filter(RestaurantTable.max_seats >= people_number)
+            .first()
         )
+        return None if table is None else table.booking_version
 
-        # from the list of all tables in the restaurant (the ones in which max_seats < number of people requested) drop the reserved ones
-        all_restaurant_tables = (
+    @staticmethod
+    def _claim_table(table_id, version) -> bool:
+        """
+        Compare and swap the booking version of the table, inside the transaction
+        of the new reservation.
+        Each booking of the table moves the version, so if another booking took
+        the table after the check of the free table the version is changed and
+        the claim fails, also when the two bookings run in different processes.
+        :return: True if the table is claimed, False if the version is changed
+        """
+        claimed = (
             db.session.query(RestaurantTable)
-            .filter(RestaurantTable.max_seats >= people_number)
-            .filter_by(restaurant_id=restaurant_id)
-            .filter(~RestaurantTable.id.in_(reservations))
-            .all()
-        )
-
-        # if there are tables available.. get the one with minimum max_seats
-        print("OK, Ther are {} tables available".format(len(all_restaurant_tables)))
-        if len(all_restaurant_tables) > 0:
-            min_value = (
-                all_restaurant_tables[0].id,
-                all_restaurant_tables[0].max_seats,
-            )
-            for i in range(1, len(all_restaurant_tables)):
-                if all_restaurant_tables[i].max_seats < min_value[1]:
-                    min_value = (
-                        all_restaurant_tables[i].id,
-                        all_restaurant_tables[i].max_seats,
-                    )
-
-            # get restaurant and table name
-            restaurant_name = (
-                db.session.query(Restaurant.name).filter_by(id=restaurant_id).first()[0]
-            )
-            table_name = (
-                db.session.query(RestaurantTable.name)
-                .filter_by(id=min_value[0])
-                .first()[0]
-            )
-
-            # register on db the reservation
-            new_reservation = Reservation()
-            new_reservation.reservation_date = py_datetime
-            new_reservation.reservation_end = py_datetime + datetime.timedelta(
-                minutes=avg_time
+            .filter(
+                RestaurantTable.id == table_id,
+                RestaurantTable.booking_version == version,
             )
-            new_reservation.customer_id = current_user.id
-            new_reservation.table_id = min_value[0]
-            new_reservation.people_number = people_number
-            db.session.add(new_reservation)
-            db.session.flush()
-
-            # register friends
-            ## TODO added celery task to send the email
-            # all the friends to celery.
-            for friend_mail in splitted_friends:
-                new_friend = Friend()
-                new_friend.reservation_id = new_reservation.id
-                new_friend.email = friend_mail.strip()
-                db.session.add(new_friend)
-            db.session.commit()
-            DispatcherMessage.send_message(
-                CONFIRMATION_BOOKING,
-                [
-                    current_user.email,
-                    current_user.email,
-                    restaurant_name,
-                    splitted_friends,
-                    new_reservation.reservation_date,
-                ],
+            .update(
+                {RestaurantTable.booking_version: RestaurantTable.booking_version + 1},
+                synchronize_session=False,
             )
-            return (new_reservation, restaurant_name, table_name)
-        else:
-            return (None, "no tables available")
+        )
+        return claimed == 1
 
     @staticmethod
     def delete_book(reservation_id: str, customer_id: str):
+        restaurant = (
+            db.session.query(RestaurantTable.restaurant_id)
+            .join(Reservation, Reservation.table_id == RestaurantTable.id)
+            .filter(Reservation.id == reservation_id)
+            .first()
+        )
         effected_rows = (
             db.session.query(Reservation)
             .filter_by(id=reservation_id)
@@ -200,34 +266,118 @@ class BookingServices:
             .delete()
         )
         db.session.commit()
+        if effected_rows > 0:
+            availability_index.remove_reservation(int(reservation_id))
+        if effected_rows > 0 and restaurant is not None:
+            RestaurantServices.invalidate_restaurant_people(restaurant.restaurant_id)
+            AvailabilitySearch.invalidate(restaurant.restaurant_id)
         return True if effected_rows > 0 else False
 
     @staticmethod
     def update_book(
         reservation_id, current_user, py_datetime, people_number, raw_friends
     ):
+        """
+        Move the reservation to the new date and people inside one transaction.
+        The reservation keeps its table when the table is still free, otherwise
+        it takes another free table, and the row is updated in place with only
+        the changes of the friends, so the old and the new reservation never
+        exist together.
+        :return: (reservation, restaurant name, table name) or (None, the error message)
+        """
+        # split friends mail and check if the number is correct
+        splitted_friends = raw_friends.split(";")
+        if len(splitted_friends) != (people_number - 1):
+            return (None, "You need to specify ONE mail for each person")
 
-        reservation = (
-            db.session.query(Reservation)
-            .filter_by(id=reservation_id)
-            .filter_by(customer_id=current_user.id)
+        row = (
+            db.session.query(Reservation, RestaurantTable.restaurant_id)
+            .join(RestaurantTable, RestaurantTable.id == Reservation.table_id)
+            .filter(
+                Reservation.id == reservation_id,
+                Reservation.customer_id == current_user.id,
+            )
             .first()
         )
-        if reservation is None:
+        if row is None:
             print("Reservation not found")
-            return False, "Reservation not found"
+            return (None, "Reservation not found")
+        reservation, restaurant_id = row
 
-        table = (
-            db.session.query(RestaurantTable).filter_by(id=reservation.table_id).first()
+        availability, opening_hour, error = BookingServices._check_request(
+            restaurant_id, current_user, py_datetime
+        )
+        if availability is None:
+            return (None, error)
+
+        # the current table is checked without the reservation itself
+        end_datetime = py_datetime + datetime.timedelta(minutes=availability.avg_time)
+        table_id = reservation.table_id
+        version = BookingServices._free_table_version(
+            restaurant_id,
+            table_id,
+            people_number,
+            py_datetime,
+            end_datetime,
+            exclude_reservation_id=reservation.id,
         )
+        if version is None or not BookingServices._claim_table(table_id, version):
+            availability, table_id, error = BookingServices._take_free_table(
+                availability, people_number, py_datetime, end_datetime
+            )
+            if table_id is None:
+                return (None, error)
 
-        if table is None:
-            print("Table not found")
-            return False, "Table not found"
+        reservation.reservation_date = py_datetime
+        reservation.reservation_end = end_datetime
+        reservation.table_id = table_id
+        reservation.people_number = people_number
+        reservation.service_slot = time_windows.service_slot(
+            restaurant_id, opening_hour, py_datetime
+        )
+        BookingServices._update_friends(reservation.id, splitted_friends)
+        NotificationOutbox.add(
+            CONFIRMATION_BOOKING,
+            [
+                current_user.email,
+                current_user.email,
+                availability.name,
+                splitted_friends,
+                py_datetime,
+            ],
+        )
+        db.session.commit()
+        availability_index.remove_reservation(reservation.id)
+        availability_index.add_reservation(restaurant_id, reservation)
+        AvailabilitySearch.invalidate(restaurant_id)
+        RestaurantServices.invalidate_restaurant_people(restaurant_id)
+        outbox_worker.wake()
+        return (reservation, availability.name, availability.table_names[table_id])
 
-        book = BookingServices.book(
-            table.restaurant_id, current_user, py_datetime, people_number, raw_friends
+    @staticmethod
+    def _update_friends(reservation_id: int, raw_friends):
+        """
+        Write only the changes of the friends of the reservation: the friends
+        that are still inside the reservation keep their rows
+        :param reservation_id: the reservation id
+        :param raw_friends: the list of the emails of the friends
+        """
+        added = [friend_mail.strip() for friend_mail in raw_friends]
+        removed = []
+        friends = db.session.query(Friend.id, Friend.email).filter(
+            Friend.reservation_id == reservation_id
         )
-        if book[0] is not None:
-            BookingServices.delete_book(reservation_id, current_user.id)
-        return book
+        for friend in friends:
+            if friend.email in added:
+                added.remove(friend.email)
+            else:
+                removed.append(friend.id)
+        if len(removed) > 0:
+            db.session.query(Friend).filter(Friend.id.in_(removed)).delete(
+                synchronize_session=False
+            )
+        for friend_mail in added:
+            new_friend = Friend()
+            new_friend.reservation_id = reservation_id
+            new_friend.email = friend_mail
+            db.session.add(new_friend)
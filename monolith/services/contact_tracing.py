@@ -0,0 +1,136 @@
+import itertools
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_
+
+from monolith.database import (
+    db,
+    Positive,
+    User,
+    RestaurantTable,
+    Reservation,
+)
+
+
+class ContactTracing:
+    """
+    This class contains the logic to resolve the contacts of a positive person.
+
+    All the past reservations of the person are resolved with two queries:
+    one for the reservations of the person and one for all the reservations
+    (with the user) in the same service slot, that is the same restaurant and the
+    same service (lunch or dinner) of the same day, see Reservation.service_slot.
+    """
+
+    @staticmethod
+    def past_reservations(user_id: int, days: int = 14):
+        """
+        Return the reservations of the user in the last days, with the restaurant id
+        :param user_id: the user id
+        :param days: how many days we want to look back
+        :return: list of rows (id, reservation_date, table_id, service_slot, restaurant_id)
+        """
+        return (
+            db.session.query(
+                Reservation.id,
+                Reservation.reservation_date,
+                Reservation.table_id,
+                Reservation.service_slot,
+                RestaurantTable.restaurant_id,
+            )
+            .join(RestaurantTable, RestaurantTable.id == Reservation.table_id)
+            .filter(
+                Reservation.reservation_date
+                >= (datetime.today() - timedelta(days=days)),
+                Reservation.reservation_date < datetime.now(),
+                Reservation.customer_id == user_id,
+            )
+            .order_by(Reservation.id)
+            .all()
+        )
+
+    @staticmethod
+    def service_slots(reservations):
+        """
+        Given the reservations, return the service slots (restaurant, day and
+        lunch or dinner) where the reservations were, tagged when the reservations
+        were written.
+        :param reservations: rows returned by ContactTracing.past_reservations
+        :return: list of slot keys without duplicates
+        """
+        slots = []
+        for reservation in reservations:
+            if reservation.service_slot is None or reservation.service_slot in slots:
+                continue
+            slots.append(reservation.service_slot)
+        return slots
+
+    @staticmethod
+    def contact_reservations(slots):
+        """
+        Return all the reservations inside one of the service slots, with the customer
+        and the positive status of the customer.
+        :param slots: slots returned by ContactTracing.service_slots
+        :return: list of rows ordered by reservation
+        """
+        if len(slots) == 0:
+            return []
+        return (
+            db.session.query(
+                Reservation.id,
+                Reservation.reservation_date,
+                Reservation.service_slot,
+                RestaurantTable.restaurant_id,
+                User.id.label("user_id"),
+                User.firstname,
+                User.lastname,
+                User.dateofbirth,
+                User.email,
+                User.phone,
+                Positive.id.label("positive_id"),
+            )
+            .join(RestaurantTable, RestaurantTable.id == Reservation.table_id)
+            .join(User, User.id == Reservation.customer_id)
+            .outerjoin(
+                Positive, and_(Positive.user_id == User.id, Positive.marked == True)
+            )
+            .filter(Reservation.service_slot.in_(slots))
+            .order_by(Reservation.id)
+            .all()
+        )
+
+    @staticmethod
+    def search_contacts(user_id: int):
+        """
+        Return the people that were in the same restaurant and in the same
+        service of the user in the last 14 days and that are not positive.
+        :param user_id: the user id of the positive person
+        :return: list of [id, name, date of birth, email, phone], in the order
+        of the reservations of the user and then of the reservations of the contacts
+        """
+        reservations = ContactTracing.past_reservations(user_id)
+        slots = ContactTracing.service_slots(reservations)
+
+        # the contacts are listed slot by slot, in the order of the reservations
+        # of the user, as they were found with a query for each reservation
+        contacts_of_slot = {slot: [] for slot in slots}
+        for contact in ContactTracing.contact_reservations(slots):
+            contacts_of_slot[contact.service_slot].append(contact)
+
+        contact_users = []
+        seen = set()
+        for contact in itertools.chain.from_iterable(contacts_of_slot.values()):
+            if contact.user_id in seen:
+                continue
+            seen.add(contact.user_id)
+            if contact.positive_id is None:
+                contact_users.append(
+                    [
+                        contact.user_id,
+                        contact.firstname + " " + contact.lastname,
+                        str(contact.dateofbirth).split()[0],
+                        contact.email,
+                        contact.phone,
+                    ]
+                )
+        return contact_users
@@ -0,0 +1,112 @@
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+from monolith.database import db, Restaurant, OpeningHours
+from monolith import geo
+
+
+class NearbyRestaurants:
+    """
+    This class contains the logic to search the restaurants near a position.
+
+    Each restaurant has the cell of the grid (see monolith/geo.py) where it is, so
+    the search reads only the cells around the position with range scans on the
+    index of the cells, and it computes the exact distance only for these restaurants.
+    """
+
+    @staticmethod
+    def within(lat: float, lon: float, radius_km: float, only_open: bool = False):
+        """
+        Return all the restaurants inside the radius from the position
+        :param lat: latitude of the position
+        :param lon: longitude of the position
+        :param radius_km: the radius in km
+        :param only_open: if True only the restaurants open now are returned
+        :return: list of (restaurant, distance in km) ordered by distance
+        """
+        candidates = NearbyRestaurants._candidates(
+            geo.cell_ranges(lat, lon, radius_km), only_open
+        )
+        result = NearbyRestaurants._with_distance(lat, lon, candidates)
+        result.sort(key=lambda item: item[1])
+        return [item for item in result if item[1] <= radius_km]
+
+    @staticmethod
+    def nearest(
+        lat: float,
+        lon: float,
+        k: int,
+        only_open: bool = True,
+        max_radius_km: float = 50.0,
+    ):
+        """
+        Return the k restaurants nearest to the position.
+        The cells are read ring by ring around the position, and we stop when
+        the restaurants outside the rings read can't be nearer than the k-th found.
+        :param lat: latitude of the position
+        :param lon: longitude of the position
+        :param k: number of restaurants
+        :param only_open: if True only the restaurants open now are returned
+        :param max_radius_km: the restaurants more distant are ignored
+        :return: list of (restaurant, distance in km) ordered by distance
+        """
+        found = []
+        ring = 0
+        while True:
+            candidates = NearbyRestaurants._candidates(
+                geo.ring_ranges(lat, lon, ring), only_open
+            )
+            found.extend(NearbyRestaurants._with_distance(lat, lon, candidates))
+            found.sort(key=lambda item: item[1])
+            # the restaurants outside the rings read are at least at this distance
+            bound = geo.ring_distance_km(lat, ring)
+            if len(found) >= k and found[k - 1][1] <= bound:
+                break
+            if bound > max_radius_km or ring >= geo.COLUMNS // 2:
+                break
+            ring += 1
+        return [item for item in found if item[1] <= max_radius_km][:k]
+
+    @staticmethod
+    def _candidates(ranges, only_open: bool):
+        """
+        Return the restaurants inside the cells
+        :param ranges: list of (first cell, last cell)
+        :param only_open: if True only the restaurants open now are returned
+        """
+        if len(ranges) == 0:
+            return []
+        query = db.session.query(
+            Restaurant.id, Restaurant.name, Restaurant.lat, Restaurant.lon
+        ).filter(
+            or_(*[Restaurant.geo_cell.between(first, last) for first, last in ranges])
+        )
+        if only_open:
+            now = datetime.now()
+            query = query.join(
+                OpeningHours, OpeningHours.restaurant_id == Restaurant.id
+            ).filter(
+                OpeningHours.week_day == now.weekday(),
+                or_(
+                    and_(
+                        OpeningHours.open_lunch <= now.time(),
+                        OpeningHours.close_lunch >= now.time(),
+                    ),
+                    and_(
+                        OpeningHours.open_dinner <= now.time(),
+                        OpeningHours.close_dinner >= now.time(),
+                    ),
+                ),
+            )
+        return query.all()
+
+    @staticmethod
+    def _with_distance(lat: float, lon: float, restaurants):
+        return [
+            (
+                restaurant,
+                geo.distance_km(lat, lon, restaurant.lat, restaurant.lon),
+            )
+            for restaurant in restaurants
+        ]
@@ -0,0 +1,189 @@
+from datetime import datetime
+
+from monolith.database import (
+    db,
+    User,
+    RestaurantTable,
+    Reservation,
+    Restaurant,
+    Friend,
+)
+from monolith.services.contact_tracing import ContactTracing
+from monolith.utils.dispaccer_events import DispatcherMessage
+from monolith.app_constant import *
+
+## max number of emails sent by one celery task
+_CHUNK_SIZE = 50
+
+
+class PositiveNotificationFanOut:
+    """
+    This class contains the logic to notify all the people involved by
+    a new positive person.
+
+    The recipients are computed with a constant number of bulk queries, deduplicated,
+    and grouped by (message type, restaurant) in batches of _CHUNK_SIZE, so we
+    enqueue only few celery tasks instead of one for each email.
+    """
+
+    @staticmethod
+    def recipients(positive_user: User):
+        """
+        Compute all the messages to send because the user is positive
+        :param positive_user: the user marked as positive
+        :return: list of (type_message, restaurant_name, params) without duplicates
+        """
+        messages = []
+        sent = set()
+
+        def add_message(type_message, restaurant_name, params):
+            # params[0] is always the recipient email
+            key = (type_message, restaurant_name, params[0])
+            if key in sent:
+                return
+            sent.add(key)
+            messages.append((type_message, restaurant_name, params))
+
+        # to notify restaurants with a future booking of the positive customer
+        future_restaurants = (
+            db.session.query(Restaurant.name, User.email, User.firstname)
+            .join(RestaurantTable, RestaurantTable.restaurant_id == Restaurant.id)
+            .join(Reservation, Reservation.table_id == RestaurantTable.id)
+            .join(User, User.id == Restaurant.owner_id)
+            .filter(
+                Reservation.reservation_date >= datetime.now(),
+                Reservation.customer_id == positive_user.id,
+            )
+            .distinct()
+        )
+        for restaurant in future_restaurants:
+            add_message(
+                NEW_COVID_TO_RESTAURANT_BOOKING,
+                restaurant.name,
+                [
+                    restaurant.email,
+                    restaurant.firstname,
+                    positive_user.email,
+                    restaurant.name,
+                ],
+            )
+
+        # to notify the restaurants, the friends and the contacts of the last 14 days
+        reservations = ContactTracing.past_reservations(positive_user.id)
+        if len(reservations) == 0:
+            return messages
+
+        restaurants_id = {reservation.restaurant_id for reservation in reservations}
+        restaurants = (
+            db.session.query(Restaurant.id, Restaurant.name, User.email, User.firstname)
+            .outerjoin(User, User.id == Restaurant.owner_id)
+            .filter(Restaurant.id.in_(restaurants_id))
+        )
+        restaurants = {restaurant.id: restaurant for restaurant in restaurants}
+        friends = PositiveNotificationFanOut._friends_of(
+            [reservation.id for reservation in reservations]
+        )
+
+        for reservation in reservations:
+            restaurant = restaurants[reservation.restaurant_id]
+            # Notify Restaurant for a positive that was inside
+            if restaurant.email is not None:
+                add_message(
+                    NEW_POSITIVE_WAS_IN_RESTAURANT,
+                    restaurant.name,
+                    [
+                        restaurant.email,
+                        restaurant.firstname,
+                        str(reservation.reservation_date),
+                        restaurant.name,
+                    ],
+                )
+            # notify friends of the positive customer
+            for friend in friends.get(reservation.id, []):
+                add_message(
+                    EMAIL_TO_FRIEND,
+                    restaurant.name,
+                    [friend, str(reservation.reservation_date), restaurant.name],
+                )
+
+        # send mail to contact, only the first reservation of each contact
+        slots = ContactTracing.service_slots(reservations)
+        contacts = []
+        contacts_id = set()
+        for contact in ContactTracing.contact_reservations(slots):
+            if contact.user_id == positive_user.id or contact.user_id in contacts_id:
+                continue
+            contacts_id.add(contact.user_id)
+            contacts.append(contact)
+        friends = PositiveNotificationFanOut._friends_of(
+            [contact.id for contact in contacts]
+        )
+
+        for contact in contacts:
+            restaurant = restaurants[contact.restaurant_id]
+            add_message(
+                NEW_POSITIVE_CONTACT,
+                restaurant.name,
+                [
+                    contact.email,
+                    contact.firstname,
+                    str(contact.reservation_date),
+                    restaurant.name,
+                ],
+            )
+            # Mail to friends of people with this reservation
+            for friend in friends.get(contact.id, []):
+                add_message(
+                    EMAIL_TO_FRIEND,
+                    restaurant.name,
+                    [friend, str(contact.reservation_date), restaurant.name],
+                )
+        return messages
+
+    @staticmethod
+    def batches(messages, chunk_size: int = _CHUNK_SIZE):
+        """
+        Group the messages by message type and restaurant, and split the groups
+        in batches with at most chunk_size messages.
+        :param messages: the messages returned by PositiveNotificationFanOut.recipients
+        :param chunk_size: max number of messages inside a batch
+        :return: list of (type_message, list of params)
+        """
+        groups = {}
+        for type_message, restaurant_name, params in messages:
+            groups.setdefault((type_message, restaurant_name), []).append(params)
+
+        batches = []
+        for (type_message, _), all_params in groups.items():
+            for index in range(0, len(all_params), chunk_size):
+                batches.append((type_message, all_params[index : index + chunk_size]))
+        return batches
+
+    @staticmethod
+    def notify(positive_user: User, chunk_size: int = _CHUNK_SIZE):
+        """
+        Send all the notifications about the positive user
+        :param positive_user: the user marked as positive
+        :param chunk_size: max number of messages sent by a single task
+        :return: the job id to poll the status of the notifications, None if
+        there is nothing to send
+        """
+        messages = PositiveNotificationFanOut.recipients(positive_user)
+        batches = PositiveNotificationFanOut.batches(messages, chunk_size)
+        return DispatcherMessage.send_batches(batches)
+
+    @staticmethod
+    def _friends_of(reservations_id):
+        """
+        Return the friends email of the reservations
+        :return: dictionary reservation_id -> list of emails
+        """
+        if len(reservations_id) == 0:
+            return {}
+        rows = db.session.query(Friend.reservation_id, Friend.email).filter(
+            Friend.reservation_id.in_(reservations_id)
+        )
+        friends = {}
+        for row in rows:
+            friends.setdefault(row.reservation_id, []).append(row.email)
+        return friends
@@ -0,0 +1,221 @@
+import json
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from monolith.database import db, Outbox
+from monolith.utils.dispaccer_events import DispatcherMessage
+
+## messages relayed with a single celery group
+BATCH_SIZE = 100
+## seconds that a relay owns the messages that it is sending, after that the
+## messages not confirmed are sent again
+LEASE = 60
+## attempts of a message before it is moved to the dead letters, the relay
+## doesn't send the dead letters anymore
+MAX_ATTEMPTS = 10
+## seconds between two relays of the local worker, when nobody wakes it
+RELAY_INTERVAL = 5.0
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationOutbox:
+    """
+    This class contains the logic of the transactional outbox of the notifications.
+
+    The messages are written inside the same transaction of the change that
+    generates them (e.g. the reservation and the friends of a booking), so a
+    message exists if and only if the change is committed, and the request
+    doesn't wait the broker.
+    The relay reads the messages in batches and sends them with the
+    DispatcherMessage, the messages are deleted only after they are sent,
+    so each message is delivered at least once: with celery a message is sent
+    when the broker has it, with the other backends when its handler is ended
+    without errors.
+    A message not sent after MAX_ATTEMPTS attempts is marked as dead and it
+    stays inside the outbox, so it doesn't block the relay.
+    """
+
+    @staticmethod
+    def add(type_message: str, params):
+        """
+        Write a message inside the current transaction, the caller commits it
+        :param type_message: the message type, defined inside the app_constant.py
+        :param params: the params of the message, the dates are sent in iso format
+        """
+        message = Outbox()
+        message.type_message = type_message
+        message.params = json.dumps(params, default=lambda value: value.isoformat())
+        db.session.add(message)
+
+    @staticmethod
+    def relay(batch_size: int = BATCH_SIZE) -> int:
+        """
+        Send a batch of messages, the oldest first
+        :param batch_size: max number of messages sent
+        :return: the number of messages sent
+        """
+        return NotificationOutbox._relay_batch(batch_size)[1]
+
+    @staticmethod
+    def relay_all(batch_size: int = BATCH_SIZE) -> int:
+        """
+        Send all the messages ready, batch by batch
+        :return: the number of messages sent
+        """
+        sent = 0
+        while True:
+            claimed, relayed = NotificationOutbox._relay_batch(batch_size)
+            sent += relayed
+            if claimed < batch_size:
+                return sent
+
+    @staticmethod
+    def _relay_batch(batch_size: int):
+        """
+        Send a batch of messages and delete the messages sent, the messages
+        not sent are sent again when the lease is expired, the messages not
+        sent at the attempt MAX_ATTEMPTS are moved to the dead letters
+        :return: (number of messages claimed, number of messages sent)
+        """
+        messages = NotificationOutbox._claim(batch_size)
+        if len(messages) == 0:
+            return 0, 0
+        if DispatcherMessage.backend.durable:
+            sent = NotificationOutbox._send_batches(messages)
+        else:
+            sent = NotificationOutbox._deliver(messages)
+        if len(sent) > 0:
+            db.session.query(Outbox).filter(Outbox.id.in_(sent)).delete(
+                synchronize_session=False
+            )
+        sent_ids = set(sent)
+        dead = [
+            message.id
+            for message in messages
+            if message.id not in sent_ids and message.attempts >= MAX_ATTEMPTS
+        ]
+        if len(dead) > 0:
+            logger.error("Outbox: messages %s moved to the dead letters", dead)
+            db.session.query(Outbox).filter(Outbox.id.in_(dead)).update(
+                {Outbox.dead: True}, synchronize_session=False
+            )
+        db.session.commit()
+        return len(messages), len(sent)
+
+    @staticmethod
+    def _send_batches(messages):
+        """
+        Send the messages to the broker, a batch for each message type
+        :return: the ids of the messages sent
+        """
+        batches = {}
+        for message in messages:
+            batches.setdefault(message.type_message, []).append(
+                json.loads(message.params)
+            )
+        try:
+            DispatcherMessage.send_batches(list(batches.items()))
+        except Exception as error:
+            logger.warning("Outbox: %d messages not sent %s", len(messages), error)
+            return []
+        return [message.id for message in messages]
+
+    @staticmethod
+    def _deliver(messages):
+        """
+        Run the handlers of the messages inside the relay, one by one
+        :return: the ids of the messages sent
+        """
+        sent = []
+        for message in messages:
+            try:
+                DispatcherMessage.deliver(
+                    message.type_message, json.loads(message.params)
+                )
+            except Exception as error:
+                logger.warning("Outbox: message %d not sent %s", message.id, error)
+                continue
+            sent.append(message.id)
+        return sent
+
+    @staticmethod
+    def _claim(batch_size: int):
+        """
+        Take the lease of the messages ready and not dead, so the relays of
+        the other workers don't send them in the same time
+        :return: list of Outbox
+        """
+        now = datetime.utcnow()
+        ready = [
+            row.id
+            for row in db.session.query(Outbox.id)
+            .filter(Outbox.next_attempt <= now, Outbox.dead.is_(False))
+            .order_by(Outbox.id)
+            .limit(batch_size)
+        ]
+        if len(ready) == 0:
+            return []
+        lease = now + timedelta(seconds=LEASE)
+        db.session.query(Outbox).filter(
+            Outbox.id.in_(ready), Outbox.next_attempt <= now
+        ).update(
+            {Outbox.attempts: Outbox.attempts + 1, Outbox.next_attempt: lease},
+            synchronize_session=False,
+        )
+        db.session.commit()
+        # the messages claimed by another relay have another lease
+        return (
+            db.session.query(Outbox)
+            .filter(Outbox.id.in_(ready), Outbox.next_attempt == lease)
+            .order_by(Outbox.id)
+            .all()
+        )
+
+
+class OutboxWorker:
+    """
+    Thread of the app that relays the outbox, it runs every RELAY_INTERVAL
+    seconds and when a request wakes it after a commit with new messages.
+    """
+
+    def __init__(self, interval: float = RELAY_INTERVAL) -> None:
+        self.interval = interval
+        self._app = None
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def start(self, app):
+        """
+        Start the thread, only once for each process
+        :param app: the flask app used to access to the database
+        """
+        self._app = app
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="outbox-relay", daemon=True
+        )
+        self._thread.start()
+
+    def wake(self):
+        """
+        Relay the new messages without waiting the interval, it doesn't block
+        """
+        if self._thread is not None:
+            self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                with self._app.app_context():
+                    NotificationOutbox.relay_all()
+                    db.session.remove()
+            except Exception as error:
+                logger.error("Outbox: relay failed %s", error)
+
+
+outbox_worker = OutboxWorker()
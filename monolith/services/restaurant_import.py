@@ -0,0 +1,237 @@
+import csv
+import itertools
+import json
+from datetime import time
+
+from monolith.database import db, Restaurant, User
+from monolith.geo import cell_of
+from monolith.principals import principal_cache
+from monolith.services.restaurant_services import RestaurantServices
+from monolith.services.availability_index import availability_index
+from monolith.services.availability_search import AvailabilitySearch
+
+## restaurants written inside a transaction
+BATCH_SIZE = 500
+## seats of the tables, when the row doesn't have max_seats
+DEFAULT_SEATS = 6
+## separator of the lists inside a field, e.g. "0;2;4" or "Italian food;Other"
+LIST_SEPARATOR = ";"
+## the opening hours, the same for each open day
+_HOURS_FIELDS = ["open_lunch", "close_lunch", "open_dinner", "close_dinner"]
+## the fields that each row must have
+_REQUIRED_FIELDS = [
+    "name",
+    "phone",
+    "lat",
+    "lon",
+    "n_tables",
+    "open_days",
+] + _HOURS_FIELDS
+
+
+class RestaurantImport:
+    """
+    This class contains the logic to onboard many restaurants from a CSV or
+    JSON file, e.g. with the command "flask import-restaurants".
+
+    The file is read row by row and the restaurants are written in batches,
+    each batch is a single transaction with bulk inserts of tables,
+    opening hours and cuisine types, so the memory does not grow with the file.
+
+    The fields of a row are:
+    name, phone, lat, lon, covid_measures, n_tables, max_seats (optional),
+    open_days ("0;2;4", 0 is Monday), open_lunch, close_lunch, open_dinner,
+    close_dinner ("12:00"), cuisine ("Italian food;Other"), avg_time (optional)
+    and owner_email (optional, the default owner is used without it).
+    """
+
+    @staticmethod
+    def read_rows(stream, file_format: str):
+        """
+        Read the rows of the file one at time
+        :param stream: the text stream of the file
+        :param file_format: "csv" or "json", the json file can be a list of objects
+        or an object for each line (JSON Lines)
+        :return: generator of dictionaries, or of the lines of a JSON Lines file
+        that are parsed by parse_row, so an error is reported only for its row
+        """
+        if file_format == "csv":
+            yield from csv.DictReader(stream)
+            return
+        if file_format != "json":
+            raise ValueError("Format {} not supported".format(file_format))
+        first = stream.read(1)
+        while first.isspace():
+            first = stream.read(1)
+        if first == "[":
+            # a list of objects can be read only all together
+            yield from json.loads(first + stream.read())
+            return
+        for line in itertools.chain([first + stream.readline()], stream):
+            if line.strip() != "":
+                yield line
+
+    @staticmethod
+    def parse_row(row) -> dict:
+        """
+        Validate a row of the file
+        :param row: the dictionary read from the file or a line of a JSON Lines file
+        :return: the values of the restaurant
+        :raise ValueError: if the row is not valid
+        """
+        if isinstance(row, str):
+            row = json.loads(row)
+        if not isinstance(row, dict):
+            raise ValueError("The row must be an object")
+        for field in _REQUIRED_FIELDS:
+            if row.get(field) in (None, ""):
+                raise ValueError("The field {} is required".format(field))
+        open_days = sorted({int(day) for day in _as_list(row["open_days"])})
+        if any(day < 0 or day > 6 for day in open_days):
+            raise ValueError("The open days must be between 0 and 6")
+        geo_cell = cell_of(row["lat"], row["lon"])
+        if geo_cell is None:
+            raise ValueError("The position is not valid")
+        n_tables = int(row["n_tables"])
+        if n_tables < 0:
+            raise ValueError("The number of tables must be positive")
+        return {
+            "name": str(row["name"]),
+            "phone": row["phone"],
+            "lat": float(row["lat"]),
+            "lon": float(row["lon"]),
+            "geo_cell": geo_cell,
+            "covid_measures": row.get("covid_measures") or "",
+            "avg_time": int(row.get("avg_time") or 30),
+            "owner_email": row.get("owner_email") or None,
+            "n_tables": n_tables,
+            "max_seats": int(row.get("max_seats") or DEFAULT_SEATS),
+            "open_days": open_days,
+            "hours": tuple(
+                _as_time(row.get(field))
+                for field in [
+                    "open_lunch",
+                    "close_lunch",
+                    "open_dinner",
+                    "close_dinner",
+                ]
+            ),
+            "cuisine": _as_list(row.get("cuisine") or ""),
+        }
+
+    @staticmethod
+    def import_rows(rows, owner_id: int = None, batch_size: int = BATCH_SIZE):
+        """
+        Write the restaurants of the rows inside the database
+        :param rows: iterable of dictionaries, e.g. RestaurantImport.read_rows
+        :param owner_id: the owner of the rows without owner_email
+        :param batch_size: restaurants written inside a transaction
+        :return: (number of restaurants imported, list of (row number, error))
+        """
+        owners = {}
+        imported = 0
+        errors = []
+        batch = []
+        for number, row in enumerate(rows, start=1):
+            try:
+                values = RestaurantImport.parse_row(row)
+                values["owner_id"] = RestaurantImport._owner_of(
+                    values.pop("owner_email"), owner_id, owners
+                )
+            except (ValueError, TypeError) as error:
+                errors.append((number, str(error)))
+                continue
+            batch.append(values)
+            if len(batch) >= batch_size:
+                imported += RestaurantImport._write_batch(batch)
+                batch = []
+        if len(batch) > 0:
+            imported += RestaurantImport._write_batch(batch)
+        return imported, errors
+
+    @staticmethod
+    def _owner_of(email, default_id, owners):
+        """
+        Return the id of the owner with the email, owners is the cache of the ids
+        """
+        if email is None:
+            if default_id is None:
+                raise ValueError("The owner is required")
+            return default_id
+        if email not in owners:
+            owner = db.session.query(User.id).filter_by(email=email).first()
+            owners[email] = None if owner is None else owner.id
+        if owners[email] is None:
+            raise ValueError("The owner {} is not registered".format(email))
+        return owners[email]
+
+    @staticmethod
+    def _write_batch(batch) -> int:
+        """
+        Write a batch of restaurants with a single transaction, the restaurants
+        are written with one INSERT and their ids are read back
+        """
+        restaurants = [
+            {
+                "name": values["name"],
+                "phone": values["phone"],
+                "lat": values["lat"],
+                "lon": values["lon"],
+                "geo_cell": values["geo_cell"],
+                "covid_measures": values["covid_measures"],
+                "avg_time": values["avg_time"],
+                "owner_id": values["owner_id"],
+                "likes": 0,
+            }
+            for values in batch
+        ]
+        # a single INSERT for the batch, with return_defaults SQLAlchemy runs an
+        # INSERT for each row to read its id
+        db.session.bulk_insert_mappings(Restaurant, restaurants)
+        # the ids are needed by the tables, opening hours and menus, the
+        # transaction holds the write lock since the insert and the new rows take
+        # the ids after the max, so the batch has the last ids in the insert order
+        ids = [
+            row.id
+            for row in db.session.query(Restaurant.id)
+            .order_by(Restaurant.id.desc())
+            .limit(len(restaurants))
+        ]
+        for restaurant, restaurant_id in zip(restaurants, reversed(ids)):
+            restaurant["id"] = restaurant_id
+        tables, openings, menus = [], [], []
+        for restaurant, values in zip(restaurants, batch):
+            details = RestaurantServices.restaurant_details(
+                restaurant["id"],
+                values["n_tables"],
+                values["max_seats"],
+                values["open_days"],
+                values["hours"],
+                values["cuisine"],
+            )
+            tables.extend(details[0])
+            openings.extend(details[1])
+            menus.extend(details[2])
+        RestaurantServices.insert_restaurant_details(tables, openings, menus)
+        db.session.commit()
+        # the ids could be used before by deleted restaurants
+        for restaurant in restaurants:
+            availability_index.invalidate(restaurant["id"])
+            AvailabilitySearch.invalidate(restaurant["id"])
+            RestaurantServices.invalidate_restaurant_info(restaurant["id"])
+        # the principal of the owner has the restaurant
+        for owner_id in {values["owner_id"] for values in batch}:
+            principal_cache.invalidate(owner_id)
+        return len(restaurants)
+
+
+def _as_list(value):
+    if isinstance(value, list):
+        return [str(item).strip() for item in value if str(item).strip() != ""]
+    return [item.strip() for item in str(value).split(LIST_SEPARATOR) if item.strip()]
+
+
+def _as_time(value):
+    if isinstance(value, time):
+        return value
+    return time.fromisoformat(str(value))
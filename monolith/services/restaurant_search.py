@@ -0,0 +1,91 @@
+import re
+
+from sqlalchemy import text
+
+from monolith.database import db, Restaurant
+
+## weight of the columns (name, cuisine, dishes) inside the ranking
+_WEIGHTS = (10.0, 5.0, 1.0)
+
+
+class RestaurantSearch:
+    """
+    This class contains the logic to search the restaurants by keywords.
+
+    The search use the FTS5 table restaurant_search, created by the migrations
+    and kept in sync by the triggers on restaurant, menu and menu_dish, so each
+    write of the restaurant (also from create_new_restaurant and the menu views)
+    updates the index without code inside the services.
+    Each word of the query is a prefix, and the result is ordered by bm25, where
+    a match on the name weighs more than a match on cuisine or dishes.
+    """
+
+    ## None until we check if the restaurant_search table exists
+    _available = None
+
+    @staticmethod
+    def is_available() -> bool:
+        """
+        Check if the database has the full text index
+        """
+        if RestaurantSearch._available is None:
+            if db.engine.dialect.name != "sqlite":
+                RestaurantSearch._available = False
+            else:
+                RestaurantSearch._available = (
+                    db.session.execute(
+                        text(
+                            "SELECT count(*) FROM sqlite_master "
+                            "WHERE type = 'table' AND name = 'restaurant_search'"
+                        )
+                    ).scalar()
+                    > 0
+                )
+        return RestaurantSearch._available
+
+    @staticmethod
+    def match_query(keywords: str):
+        """
+        Convert the keywords of the user in a FTS5 query, each word is a prefix
+        and all the words must be inside the document.
+        :param keywords: the text inserted by the user
+        :return: the FTS5 query or None if there aren't words
+        """
+        words = re.findall(r"\w+", keywords)
+        if len(words) == 0:
+            return None
+        return " ".join('"{}"*'.format(word) for word in words)
+
+    @staticmethod
+    def search(keywords: str, limit: int = None):
+        """
+        Search the restaurants by name, cuisine type and dishes.
+        :param keywords: the text inserted by the user
+        :param limit: max number of restaurants, None for all the restaurants
+        :return: list of Restaurant ordered by rank
+        """
+        if not RestaurantSearch.is_available():
+            return (
+                Restaurant.query.filter(Restaurant.name.ilike("%{}%".format(keywords)))
+                .limit(limit)
+                .all()
+            )
+        query = RestaurantSearch.match_query(keywords)
+        if query is None:
+            return []
+        rows = db.session.execute(
+            text(
+                "SELECT rowid FROM restaurant_search WHERE restaurant_search MATCH :query "
+                "ORDER BY bm25(restaurant_search, {}, {}, {}) LIMIT :limit".format(
+                    *_WEIGHTS
+                )
+            ),
+            {"query": query, "limit": -1 if limit is None else limit},
+        )
+        # restaurant id -> position inside the ranking
+        ranking = {row[0]: position for position, row in enumerate(rows)}
+        if len(ranking) == 0:
+            return []
+        restaurants = Restaurant.query.filter(Restaurant.id.in_(ranking.keys())).all()
+        restaurants.sort(key=lambda restaurant: ranking[restaurant.id])
+        return restaurants
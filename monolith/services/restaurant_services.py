@@ -1,5 +1,5 @@
 from datetime import datetime
-from decimal import Decimal
+from random import randint
 
 from flask import current_app
 from monolith.database import (
@@ -11,11 +11,56 @@ from monolith.database import (
     Reservation,
     PhotoGallery,
     MenuDish,
+    User,
+    ReconcileWatermark,
 )
 from monolith.forms import RestaurantForm
 from monolith.database import db
-from sqlalchemy.sql.expression import func, extract
-from monolith.model.restaurant_model import RestaurantModel
+from sqlalchemy.sql.expression import func, cast, literal
+from sqlalchemy import Float, and_, case
+from monolith.model.restaurant_model import (
+    RestaurantModel,
+    PhotoItem,
+    DishItem,
+    OpeningHoursItem,
+)
+from monolith.services.availability_index import availability_index
+from monolith.services.availability_search import AvailabilitySearch
+from monolith.services.restaurant_search import RestaurantSearch
+from monolith.cache import VersionedCache
+from monolith.principals import principal_cache
+from monolith.pagination import key_range, paginate, PAGE_SIZE
+from monolith import time_windows
+
+## the columns of the reservations of a restaurant, by name
+RESERVATION_COLUMNS = {
+    "id": Reservation.id,
+    "reservation_date": Reservation.reservation_date,
+    "people_number": Reservation.people_number,
+    "id_table": Reservation.table_id.label("id_table"),
+    "firstname": User.firstname,
+    "lastname": User.lastname,
+    "email": User.email,
+    "phone": User.phone,
+    "checkin": Reservation.checkin,
+}
+## the key of the pages of the reservations
+_RESERVATION_KEY = (Reservation.reservation_date, Reservation.id)
+## reservations read with a query by the export
+EXPORT_BATCH_SIZE = 1000
+## restaurant id -> RestaurantModel, used by the restaurant sheet
+_restaurant_info_cache = VersionedCache(ttl=300, max_size=512)
+## seconds before a new sample of reviews is shown on the restaurant sheet
+_REVIEWS_SAMPLE_TTL = 30
+## restaurant id -> the random reviews shown on the restaurant sheet
+_reviews_sample_cache = VersionedCache(ttl=_REVIEWS_SAMPLE_TTL, max_size=512)
+## seconds of life of the people inside a restaurant, it is the upper bound of
+## the people checked in that are gone, and of the bookings of the other workers
+_PEOPLE_TTL = 10
+## restaurant id -> (day, [people at lunch, people at dinner, people now])
+_restaurant_people_cache = VersionedCache(ttl=_PEOPLE_TTL, max_size=1024)
+## name of the watermark of the rating reconciliation, see ReconcileWatermark
+_RATING_WATERMARK = "rating"
 
 
 class RestaurantServices:
@@ -36,43 +81,84 @@ class RestaurantServices:
         restaurant.likes = 0
         restaurant.covid_measures = form.covid_measures.data
 
+        # all the restaurant is written with a single transaction
         db.session.add(restaurant)
+        db.session.flush()
+        details = RestaurantServices.restaurant_details(
+            restaurant.id,
+            int(form.n_tables.data),
+            max_sit,
+            [int(day) for day in form.open_days.data],
+            (
+                form.open_lunch.data,
+                form.close_lunch.data,
+                form.open_dinner.data,
+                form.close_dinner.data,
+            ),
+            form.cuisine.data,
+        )
+        RestaurantServices.insert_restaurant_details(*details)
         db.session.commit()
+        # the id could be used before by a deleted restaurant
+        availability_index.invalidate(restaurant.id)
+        AvailabilitySearch.invalidate(restaurant.id)
+        _restaurant_info_cache.invalidate(restaurant.id)
+        _restaurant_people_cache.invalidate(restaurant.id)
+        # the principal of the owner has the restaurant
+        principal_cache.invalidate(user_id)
+        return restaurant
 
-        for i in range(int(form.n_tables.data)):
-            new_table = RestaurantTable()
-            new_table.restaurant_id = restaurant.id
-            new_table.max_seats = max_sit
-            new_table.available = True
-            new_table.name = ""
-
-            db.session.add(new_table)
-            db.session.commit()
-
-        # inserimento orari di apertura
-        days = form.open_days.data
-        for i in range(len(days)):
-            new_opening = OpeningHours()
-            new_opening.restaurant_id = restaurant.id
-            new_opening.week_day = int(days[i])
-            new_opening.open_lunch = form.open_lunch.data
-            new_opening.close_lunch = form.close_lunch.data
-            new_opening.open_dinner = form.open_dinner.data
-            new_opening.close_dinner = form.close_dinner.data
-            db.session.add(new_opening)
-            db.session.commit()
-
-        # inserimento tipi di cucina
-        cuisin_type = form.cuisine.data
-        for i in range(len(cuisin_type)):
-            new_cuisine = Menu()
-            new_cuisine.restaurant_id = restaurant.id
-            new_cuisine.cusine = cuisin_type[i]
-            new_cuisine.description = ""
-            db.session.add(new_cuisine)
-            db.session.commit()
+    @staticmethod
+    def restaurant_details(
+        restaurant_id: int, n_tables: int, max_sit: int, open_days, hours, cuisines
+    ):
+        """
+        Return the rows of the tables, the opening hours and the cuisine types
+        of a new restaurant, to write them with RestaurantServices.insert_restaurant_details
+        :param restaurant_id: the id of the new restaurant
+        :param n_tables: number of tables
+        :param max_sit: seats of each table
+        :param open_days: list of week days (0 is Monday)
+        :param hours: (open lunch, close lunch, open dinner, close dinner), the same for each day
+        :param cuisines: list of cuisine types
+        :return: (tables, opening hours, menus) as lists of dictionaries
+        """
+        open_lunch, close_lunch, open_dinner, close_dinner = hours
+        tables = [
+            {
+                "restaurant_id": restaurant_id,
+                "max_seats": max_sit,
+                "available": True,
+                "name": "",
+            }
+            for _ in range(n_tables)
+        ]
+        openings = [
+            {
+                "restaurant_id": restaurant_id,
+                "week_day": day,
+                "open_lunch": open_lunch,
+                "close_lunch": close_lunch,
+                "open_dinner": open_dinner,
+                "close_dinner": close_dinner,
+            }
+            for day in open_days
+        ]
+        menus = [
+            {"restaurant_id": restaurant_id, "cusine": cuisine, "description": ""}
+            for cuisine in cuisines
+        ]
+        return tables, openings, menus
 
-        return restaurant
+    @staticmethod
+    def insert_restaurant_details(tables, openings, menus):
+        """
+        Insert the tables, the opening hours and the cuisine types of the new
+        restaurants with one bulk insert for each table, without commit.
+        """
+        db.session.bulk_insert_mappings(RestaurantTable, tables)
+        db.session.bulk_insert_mappings(OpeningHours, openings)
+        db.session.bulk_insert_mappings(Menu, menus)
 
     @staticmethod
     def get_all_restaurants():
@@ -86,42 +172,158 @@ class RestaurantServices:
     def get_reservation_rest(owner_id, restaurant_id, from_date, to_date, email):
         """
         This method contains the logic to find all reservation in the restaurant
-        with the filter on the date
+        with the filter on the date, the newest first.
+        The big restaurants should use get_reservations_page or export_reservations.
         """
+        keys = RestaurantServices._reservation_keys(
+            owner_id, restaurant_id, from_date, to_date, email
+        )
+        return (
+            RestaurantServices._reservation_rows(keys, list(RESERVATION_COLUMNS))
+            .order_by(Reservation.reservation_date.desc(), Reservation.id.desc())
+            .all()
+        )
 
-        queryString = (
-            "select reserv.id, reserv.reservation_date, reserv.people_number, tab.id as id_table, cust.firstname, cust.lastname, cust.email, cust.phone, reserv.checkin from reservation reserv "
-            "join user cust on cust.id = reserv.customer_id "
-            "join restaurant_table tab on reserv.table_id = tab.id "
-            "join restaurant rest on rest.id = tab.restaurant_id "
-            "where rest.owner_id = :owner_id "
-            "and rest.id = :restaurant_id "
+    @staticmethod
+    def get_reservations_page(
+        owner_id,
+        restaurant_id,
+        from_date=None,
+        to_date=None,
+        email=None,
+        cursor: str = None,
+        page_size: int = PAGE_SIZE,
+        columns=None,
+    ):
+        """
+        Return a page of the reservations of the restaurant, the newest first
+        :param owner_id: the owner of the restaurant
+        :param restaurant_id: the restaurant id
+        :param from_date: the first day, e.g. "2020-10-07", or None
+        :param to_date: the last day, e.g. "2020-11-07", or None
+        :param email: the email of the customer, or None
+        :param cursor: the token of the previous page, None for the first page
+        :param page_size: number of reservations inside a page
+        :param columns: the names of the columns inside RESERVATION_COLUMNS,
+        None for all the columns
+        :return: (list of reservations, token of the next page or None)
+        :raise ValueError: if a date or a column is not valid
+        """
+        columns = RestaurantServices._reservation_columns(columns)
+        keys = RestaurantServices._reservation_keys(
+            owner_id, restaurant_id, from_date, to_date, email
+        )
+        page, next_cursor = paginate(
+            keys, _RESERVATION_KEY, cursor, page_size, descending=True
         )
+        rows = RestaurantServices._reservation_page(keys, page, columns)
+        return rows, next_cursor
 
-        # add filters...
-        if from_date:
-            queryString = queryString + " and  reserv.reservation_date > :fromDate"
-        if to_date:
-            queryString = queryString + " and  reserv.reservation_date < :toDate"
-        if email:
-            queryString = queryString + " and  cust.email = :email"
-        queryString = queryString + " order by reserv.reservation_date desc"
+    @staticmethod
+    def export_reservations(
+        owner_id,
+        restaurant_id,
+        from_date=None,
+        to_date=None,
+        email=None,
+        columns=None,
+        batch_size: int = EXPORT_BATCH_SIZE,
+    ):
+        """
+        Read all the reservations of the restaurant page by page, so the memory
+        doesn't grow with the number of reservations, e.g. for the CSV export.
+        The params are the same of get_reservations_page, and they are checked
+        before the first reservation is read.
+        :return: generator of reservations, the newest first
+        :raise ValueError: if a date or a column is not valid
+        """
+        columns = RestaurantServices._reservation_columns(columns)
+        keys = RestaurantServices._reservation_keys(
+            owner_id, restaurant_id, from_date, to_date, email
+        )
 
-        stmt = db.text(queryString)
+        def pages():
+            cursor = None
+            while True:
+                page, cursor = paginate(
+                    keys, _RESERVATION_KEY, cursor, batch_size, descending=True
+                )
+                yield from RestaurantServices._reservation_page(keys, page, columns)
+                if cursor is None:
+                    return
 
-        # bind filter params...
-        params = {"owner_id": owner_id, "restaurant_id": restaurant_id}
-        if from_date:
-            params["fromDate"] = from_date + " 00:00:00.000"
-        if to_date:
-            params["toDate"] = to_date + " 23:59:59.999"
+        return pages()
+
+    @staticmethod
+    def _reservation_columns(columns):
+        """
+        Return the names of the columns to select, with the key of the pages
+        :raise ValueError: if a column is not inside RESERVATION_COLUMNS
+        """
+        if columns is None:
+            return list(RESERVATION_COLUMNS)
+        unknown = [name for name in columns if name not in RESERVATION_COLUMNS]
+        if len(unknown) > 0:
+            raise ValueError("Unknown columns {}".format(unknown))
+        selected = [name for name in ["id", "reservation_date"] if name not in columns]
+        return selected + list(columns)
+
+    @staticmethod
+    def _reservation_keys(owner_id, restaurant_id, from_date, to_date, email):
+        """
+        Return the query of the keys (date, id) of the reservations of the
+        restaurant with the filters, without order.
+        The keys are read from the index of the tables and the dates, and the
+        other columns are read only for the reservations of a page.
+        The days are the range [from_date, to_date + 1 day).
+        :raise ValueError: if a date is not valid
+        """
+        tables = (
+            db.session.query(RestaurantTable.id)
+            .join(Restaurant, Restaurant.id == RestaurantTable.restaurant_id)
+            .filter(Restaurant.owner_id == owner_id, Restaurant.id == restaurant_id)
+        )
+        query = db.session.query(*_RESERVATION_KEY).filter(
+            Reservation.table_id.in_(tables.subquery())
+        )
+        query = query.filter(
+            *time_windows.days_filter(Reservation.reservation_date, from_date, to_date)
+        )
         if email:
-            params["email"] = email
+            customers = db.session.query(User.id).filter(User.email == email)
+            query = query.filter(Reservation.customer_id.in_(customers.subquery()))
+        return query
 
-        # execute and retrive results...
-        result = db.engine.execute(stmt, params)
-        list_reservation = result.fetchall()
-        return list_reservation
+    @staticmethod
+    def _reservation_rows(keys, columns):
+        """
+        Return the query of the columns of the reservations selected by the
+        query of the keys, without order
+        :param keys: the query created by _reservation_keys
+        :param columns: the names of the columns inside RESERVATION_COLUMNS
+        """
+        return keys.with_entities(
+            *[RESERVATION_COLUMNS[name] for name in columns]
+        ).join(User, User.id == Reservation.customer_id)
+
+    @staticmethod
+    def _reservation_page(keys, page, columns):
+        """
+        Return the columns of the reservations of a page of keys, the newest first.
+        The reservations are read with the range of the keys of the page,
+        that uses the same index of the keys.
+        :param keys: the query created by _reservation_keys
+        :param page: the keys of the page, the newest first
+        :param columns: the names of the columns inside RESERVATION_COLUMNS
+        """
+        if len(page) == 0:
+            return []
+        return (
+            RestaurantServices._reservation_rows(keys, columns)
+            .filter(key_range(_RESERVATION_KEY, page[-1], page[0]))
+            .order_by(Reservation.reservation_date.desc(), Reservation.id.desc())
+            .all()
+        )
 
     @staticmethod
     def review_restaurant(restaurant_id, reviewer_id, stars, review):
@@ -140,24 +342,87 @@ class RestaurantServices:
         new_review.review = review
 
         db.session.add(new_review)
+        # update the running aggregates in the same transaction of the review
+        db.session.query(Restaurant).filter_by(id=restaurant_id).update(
+            {
+                Restaurant.review_count: func.coalesce(Restaurant.review_count, 0) + 1,
+                Restaurant.stars_sum: func.coalesce(Restaurant.stars_sum, 0.0)
+                + float(stars),
+                Restaurant.rating: (
+                    func.coalesce(Restaurant.stars_sum, 0.0) + float(stars)
+                )
+                / (func.coalesce(Restaurant.review_count, 0) + 1),
+            },
+            synchronize_session=False,
+        )
         db.session.commit()
+        _reviews_sample_cache.invalidate(int(restaurant_id))
 
         return new_review
 
     @staticmethod
     def get_three_reviews(restaurant_id):
         """
-        Given the restaurant_di return three random reviews
+        Given the restaurant_di return three random reviews.
+        The sample is cached for a short time, so the reviews change
+        only after _REVIEWS_SAMPLE_TTL seconds or after a new review.
         """
-        reviews = (
-            db.session.query(Review)
-            .filter_by(restaurant_id=restaurant_id)
-            .order_by(func.random())
-            .limit(3)
-            .all()
+        return _reviews_sample_cache.get(
+            int(restaurant_id),
+            lambda: RestaurantServices.sample_reviews(int(restaurant_id), 3),
         )
 
-        return reviews
+    @staticmethod
+    def sample_reviews(restaurant_id: int, size: int):
+        """
+        Return size random reviews of the restaurant without sort all the reviews.
+        We pick a random id between the first and the last review of the restaurant and
+        we take the first review with an id greater or equal, so each pick is a seek
+        on the index (restaurant_id, id). When the picks collide (or there are few reviews)
+        the sample is completed with the first reviews of the restaurant.
+        :param restaurant_id: the restaurant id
+        :param size: number of reviews
+        :return: list of rows with id, stars, review and data
+        """
+        columns = (Review.id, Review.stars, Review.review, Review.data)
+        # two subqueries because the database optimize only a single min or max
+        low, high = db.session.query(
+            db.session.query(func.min(Review.id))
+            .filter(Review.restaurant_id == restaurant_id)
+            .as_scalar(),
+            db.session.query(func.max(Review.id))
+            .filter(Review.restaurant_id == restaurant_id)
+            .as_scalar(),
+        ).one()
+        if low is None:
+            return []
+
+        reviews = {}
+        for _ in range(size):
+            pick = (
+                db.session.query(*columns)
+                .filter(
+                    Review.restaurant_id == restaurant_id,
+                    Review.id >= randint(low, high),
+                )
+                .order_by(Review.id)
+                .first()
+            )
+            reviews[pick.id] = pick
+
+        if len(reviews) < size:
+            others = (
+                db.session.query(*columns)
+                .filter(
+                    Review.restaurant_id == restaurant_id,
+                    Review.id.notin_(list(reviews.keys())),
+                )
+                .order_by(Review.id)
+                .limit(size - len(reviews))
+            )
+            for review in others:
+                reviews[review.id] = review
+        return list(reviews.values())
 
     @staticmethod
     def get_restaurant_name(restaurant_id):
@@ -167,141 +432,203 @@ class RestaurantServices:
         name = db.session.query(Restaurant.name).filter_by(id=restaurant_id).first()[0]
         return name
 
+    @staticmethod
+    def get_restaurants_page(cursor: str = None, page_size: int = PAGE_SIZE):
+        """
+        Return a page of restaurants ordered by id, with only the columns
+        used by the restaurants list (id, name, rating, lat and lon).
+        :param cursor: the token of the previous page, None for the first page
+        :param page_size: number of restaurants inside a page
+        :return: (list of restaurants, token of the next page or None)
+        """
+        query = db.session.query(
+            Restaurant.id,
+            Restaurant.name,
+            Restaurant.rating,
+            Restaurant.lat,
+            Restaurant.lon,
+        )
+        return paginate(query, (Restaurant.id,), cursor, page_size)
+
     @staticmethod
     def get_restaurants_by_keyword(name: str = None):
         """
         This method contains the logic to perform the search restaurant by keywords
+        The keywords are searched inside the name, the cuisine types and the dishes
+        of the restaurants, and the result is ordered by rank.
         The keywords supported are:
         :param name: is the name of restaurants
         """
         if name is None:
             raise Exception("Name is required to make this type of research")
-        return Restaurant.query.filter(Restaurant.name.ilike("%{}%".format(name))).all()
+        return RestaurantSearch.search(name)
 
     @staticmethod
     def get_restaurant_people(restaurant_id: int):
         """
         Given the id of the restaurant return the number of people at lunch and dinner
+        of today, and the number of people checked in now.
+        The counters are cached, and the cache is invalidated by the bookings,
+        the deletes and the check-in with RestaurantServices.invalidate_restaurant_people
+        :return: [people at lunch, people at dinner, people now]
         """
-        openings = (
-            db.session.query(OpeningHours)
-            .filter(
-                OpeningHours.week_day == datetime.today().weekday(),
-                OpeningHours.restaurant_id == restaurant_id,
-            )
-            .first()
+        today = datetime.today().date()
+        day, people = _restaurant_people_cache.get(
+            int(restaurant_id),
+            lambda: (today, RestaurantServices._load_restaurant_people(restaurant_id)),
         )
-        if openings is None:
-            return [0, 0, 0]
+        if day != today:
+            # the counters of yesterday
+            _restaurant_people_cache.invalidate(int(restaurant_id))
+            return RestaurantServices.get_restaurant_people(restaurant_id)
+        return list(people)
 
-        tables = (
-            db.session.query(RestaurantTable)
-            .filter_by(restaurant_id=restaurant_id)
-            .all()
-        )
-        tables_id = []
-        for table in tables:
-            tables_id.append(table.id)
-
-        reservations_l = (
-            db.session.query(Reservation)
-            .filter(
-                Reservation.table_id.in_(tables_id),
-                extract("day", Reservation.reservation_date)
-                == extract("day", datetime.today()),
-                extract("month", Reservation.reservation_date)
-                == extract("month", datetime.today()),
-                extract("year", Reservation.reservation_date)
-                == extract("year", datetime.today()),
-                extract("hour", Reservation.reservation_date)
-                >= extract("hour", openings.open_lunch),
-                extract("hour", Reservation.reservation_date)
-                <= extract("hour", openings.close_lunch),
-            )
-            .all()
-        )
+    @staticmethod
+    def invalidate_restaurant_people(restaurant_id: int):
+        """
+        Remove the people inside the restaurant from the cache, it must be called
+        after each booking, delete or check-in of a reservation of the restaurant.
+        :param restaurant_id: the restaurant id
+        """
+        _restaurant_people_cache.invalidate(int(restaurant_id))
 
-        reservations_d = (
-            db.session.query(Reservation)
-            .filter(
-                Reservation.table_id.in_(tables_id),
-                extract("day", Reservation.reservation_date)
-                == extract("day", datetime.today()),
-                extract("month", Reservation.reservation_date)
-                == extract("month", datetime.today()),
-                extract("year", Reservation.reservation_date)
-                == extract("year", datetime.today()),
-                extract("hour", Reservation.reservation_date)
-                >= extract("hour", openings.open_dinner),
-                extract("hour", Reservation.reservation_date)
-                <= extract("hour", openings.close_dinner),
-            )
-            .all()
+    @staticmethod
+    def _load_restaurant_people(restaurant_id: int):
+        """
+        Count the people of the lunch and the dinner of today with one GROUP BY
+        on the service slots, the people now are the reservations checked in
+        that are not ended.
+        """
+        today = datetime.today()
+        now = datetime.now()
+        lunch = time_windows.slot_key(restaurant_id, today, time_windows.LUNCH)
+        dinner = time_windows.slot_key(restaurant_id, today, time_windows.DINNER)
+        checked_in = case(
+            [
+                (
+                    and_(
+                        Reservation.checkin == True,
+                        Reservation.reservation_date <= now,
+                        Reservation.reservation_end >= now,
+                    ),
+                    1,
+                )
+            ],
+            else_=0,
         )
-
-        reservations_now = (
-            db.session.query(Reservation)
-            .filter(
-                Reservation.checkin is True,
-                Reservation.reservation_date <= datetime.now(),
-                Reservation.reservation_end >= datetime.now(),
+        people = {
+            row.service_slot: row
+            for row in db.session.query(
+                Reservation.service_slot,
+                func.count(Reservation.id).label("booked"),
+                func.sum(checked_in).label("now"),
             )
-            .all()
+            .filter(Reservation.service_slot.in_([lunch, dinner]))
+            .group_by(Reservation.service_slot)
+        }
+        return (
+            people[lunch].booked if lunch in people else 0,
+            people[dinner].booked if dinner in people else 0,
+            sum(row.now for row in people.values()),
         )
 
-        return [len(reservations_l), len(reservations_d), len(reservations_now)]
-
     @staticmethod
     def checkin_reservations(reservation_id: int):
-        reservation = db.session.query(Reservation).filter_by(id=reservation_id)
-        if reservation:
-            reservation.update({Reservation.checkin: True})
-            db.session.commit()
-            db.session.flush()
+        restaurant = (
+            db.session.query(RestaurantTable.restaurant_id)
+            .join(Reservation, Reservation.table_id == RestaurantTable.id)
+            .filter(Reservation.id == reservation_id)
+            .first()
+        )
+        if restaurant is None:
+            return
+        db.session.query(Reservation).filter_by(id=reservation_id).update(
+            {Reservation.checkin: True}
+        )
+        db.session.commit()
+        RestaurantServices.invalidate_restaurant_people(restaurant.restaurant_id)
 
     @staticmethod
     def get_all_restaurants_info(restaurant_id: int):
         """
         This method contains the logic to get all informations about the restaurants.
+        The model is cached, and the cache is invalidated by the operator changes
+        with RestaurantServices.invalidate_restaurant_info
         :return: RestaurantsModel
         """
-        model = RestaurantModel()
-        rest = db.session.query(Restaurant).filter_by(id=restaurant_id).all()
-        if rest is None:
-            return None
-        rest = rest[0]
-        model.bind_restaurant(rest)
-        q_cuisine = db.session.query(Menu).filter_by(restaurant_id=restaurant_id).all()
-        for cusine in q_cuisine:
-            model.bind_menu(cusine)
-        photos = (
-            db.session.query(PhotoGallery)
-            .filter_by(restaurant_id=int(restaurant_id))
-            .all()
+        return _restaurant_info_cache.get(
+            int(restaurant_id),
+            lambda: RestaurantServices._load_restaurant_info(int(restaurant_id)),
         )
-        for photo in photos:
-            model.bind_photo(photo)
 
-        dishes = db.session.query(MenuDish).filter_by(restaurant_id=restaurant_id).all()
-        for dish in dishes:
-            model.bind_dish(dish)
+    @staticmethod
+    def invalidate_restaurant_info(restaurant_id: int):
+        """
+        Remove the restaurant information from the cache, it must be called
+        after each change of the restaurant, dishes, photos or tables.
+        :param restaurant_id: the restaurant id
+        """
+        _restaurant_info_cache.invalidate(int(restaurant_id))
 
-        q_hours = (
-            db.session.query(OpeningHours)
-            .filter_by(restaurant_id=int(restaurant_id))
+    @staticmethod
+    def _load_restaurant_info(restaurant_id: int):
+        """
+        Load the RestaurantModel with two queries, one for the restaurant with the
+        opening hours and one for the cuisine types, photos and dishes together.
+        :return: RestaurantsModel or None if the restaurant doesn't exist
+        """
+        rows = (
+            db.session.query(Restaurant, OpeningHours)
+            .outerjoin(OpeningHours, OpeningHours.restaurant_id == Restaurant.id)
+            .filter(Restaurant.id == restaurant_id)
+            .order_by(OpeningHours.week_day)
             .all()
         )
-        for hour in q_hours:
-            model.bind_hours(hour)
-
+        if len(rows) == 0:
+            return None
+        model = RestaurantModel()
+        model.bind_restaurant(rows[0][0])
+        for _, hour in rows:
+            if hour is not None:
+                model.bind_hours(
+                    OpeningHoursItem(
+                        hour.week_day,
+                        hour.open_lunch,
+                        hour.close_lunch,
+                        hour.open_dinner,
+                        hour.close_dinner,
+                    )
+                )
+
+        # the rows have the same columns (kind, id, text, text, price)
+        menus = db.session.query(
+            literal("menu"), Menu.id, Menu.cusine, literal(None), literal(None)
+        ).filter(Menu.restaurant_id == restaurant_id)
+        photos = db.session.query(
+            literal("photo"),
+            PhotoGallery.id,
+            PhotoGallery.url,
+            PhotoGallery.caption,
+            literal(None),
+        ).filter(PhotoGallery.restaurant_id == restaurant_id)
+        dishes = db.session.query(
+            literal("dish"), MenuDish.id, MenuDish.name, literal(None), MenuDish.price
+        ).filter(MenuDish.restaurant_id == restaurant_id)
+        items = sorted(menus.union_all(photos, dishes).all(), key=lambda row: row[1])
+        for kind, item_id, text, caption, price in items:
+            if kind == "menu":
+                model.cusine.append(text)
+            elif kind == "photo":
+                model.bind_photo(PhotoItem(item_id, text, caption))
+            else:
+                model.bind_dish(DishItem(item_id, text, price))
         return model
 
     @staticmethod
     def get_rating_restaurant(restaurant_id: int) -> float:
         """
-        TODO(vincenzopalazzo) this function need more testing.
-        This method perform the request to calculate the rating of the restaurants
-        with the review.
+        This method recalculate the rating of the restaurants from all the reviews,
+        and it aligns the aggregates review_count and stars_sum.
         :param restaurant_id: the restaurant id
         :return: the rating value, as 0.0 or 5.0
         """
@@ -311,30 +638,83 @@ class RestaurantServices:
             raise Exception(
                 "Restaurant with id {} don't exist on database".format(restaurant_id)
             )
-        reviews_list = (
-            db.session.query(Review).filter_by(restaurant_id=restaurant_id).all()
+        review_count, stars_sum = (
+            db.session.query(func.count(Review.id), func.sum(cast(Review.stars, Float)))
+            .filter_by(restaurant_id=restaurant_id)
+            .one()
         )
-        if (reviews_list is None) or (len(reviews_list) == 0):
+        restaurant.review_count = review_count
+        restaurant.stars_sum = stars_sum if stars_sum is not None else 0.0
+        if review_count == 0:
+            db.session.commit()
             return rating_value
 
-        for review in reviews_list:
-            rating_value = rating_value + float(review.stars)
-
-        rating_value = rating_value / float(len(reviews_list))
+        rating_value = stars_sum / float(review_count)
         current_app.logger.debug(
             "Rating calculate for restaurant with name {} is {}".format(
                 restaurant.name, rating_value
             )
         )
-        restaurant.rating = Decimal(rating_value)
+        restaurant.rating = rating_value
         db.session.commit()
         return rating_value
 
     @staticmethod
     def calculate_rating_for_all():
         """
-        This method is used inside celery background task to calculate the rating for each restaurants
+        This method is used inside celery background task to reconcile the rating of the restaurants.
+        Only the restaurants that received a review after the last run are recalculated, with a
+        single GROUP BY on the reviews. The watermark is the last review id of the run, it is kept
+        inside the reconcile_watermark table and moved on only by the run that read it.
+        :return: the number of restaurants updated
         """
-        restaurants_list = db.session.query(Restaurant).all()
-        for restaurant in restaurants_list:
-            RestaurantServices.get_rating_restaurant(restaurant.id)
+        watermark = (
+            db.session.query(ReconcileWatermark.last_id)
+            .filter_by(name=_RATING_WATERMARK)
+            .scalar()
+        )
+        last_review = db.session.query(func.max(Review.id)).scalar()
+        if watermark is None or last_review is None or last_review <= watermark:
+            db.session.rollback()
+            return 0
+
+        reviewed = (
+            db.session.query(Review.restaurant_id)
+            .filter(Review.id > watermark, Review.id <= last_review)
+            .distinct()
+        )
+        aggregates = (
+            db.session.query(
+                Review.restaurant_id,
+                func.count(Review.id),
+                func.sum(cast(Review.stars, Float)),
+            )
+            .filter(Review.restaurant_id.in_(reviewed))
+            .group_by(Review.restaurant_id)
+            .all()
+        )
+        db.session.bulk_update_mappings(
+            Restaurant,
+            [
+                {
+                    "id": restaurant_id,
+                    "review_count": review_count,
+                    "stars_sum": stars_sum,
+                    "rating": stars_sum / float(review_count),
+                }
+                for restaurant_id, review_count, stars_sum in aggregates
+            ],
+        )
+        moved = (
+            db.session.query(ReconcileWatermark)
+            .filter_by(name=_RATING_WATERMARK, last_id=watermark)
+            .update(
+                {ReconcileWatermark.last_id: last_review}, synchronize_session=False
+            )
+        )
+        if moved == 0:
+            # another worker reconciled the same reviews
+            db.session.rollback()
+            return 0
+        db.session.commit()
+        return len(aggregates)
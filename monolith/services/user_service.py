@@ -1,7 +1,23 @@
+from datetime import datetime
+
 from flask_login import current_user
 
-from monolith.database import db, User, Positive, Reservation, Role
+from monolith.database import (
+    db,
+    User,
+    Positive,
+    Reservation,
+    Restaurant,
+    RestaurantTable,
+)
 from monolith.forms import UserForm
+from monolith.principals import principal_cache
+from monolith.roles import role_registry
+from monolith.pagination import paginate, PAGE_SIZE
+from monolith import time_windows
+
+## the key of the pages of the history of a customer
+_CUSTOMER_RESERVATION_KEY = (Reservation.reservation_date, Reservation.id)
 
 
 class UserService:
@@ -16,9 +32,9 @@ class UserService:
         """
         This method return the user role with id
         :param user_id:
-        :return: role value of the user
+        :return: role of the user, with id, value and label
         """
-        return db.session.query(Role).filter_by(id=user_id).first()
+        return role_registry.by_id(user_id)
 
     @staticmethod
     def user_is_present(email: str = None, phone: str = None):
@@ -61,6 +77,7 @@ class UserService:
 
         if role_id is None:
             role_id = current_user.role_id
+        user_id = current_user.id
         db.session.query(User).filter(User.email == current_user.email).update(
             {
                 "email": form.email.data,
@@ -71,17 +88,21 @@ class UserService:
             }
         )
         db.session.commit()
+        principal_cache.invalidate(user_id)
 
         user = db.session.query(User).filter_by(email=form.email.data).first()
         return user
 
     @staticmethod
     def delete_user(user_id: int = None, email: str = ""):
-        if user_id is not None:
-            db.session.query(User).filter_by(id=user_id).delete()
-        else:
-            db.session.query(User).filter_by(email=email).delete()
+        if user_id is None:
+            user = db.session.query(User.id).filter_by(email=email).first()
+            if user is None:
+                return
+            user_id = user.id
+        db.session.query(User).filter_by(id=user_id).delete()
         db.session.commit()
+        principal_cache.invalidate(user_id)
 
     @staticmethod
     def is_positive(user_id: int):
@@ -102,25 +123,77 @@ class UserService:
 
     @staticmethod
     def get_customer_reservation(fromDate: str, toDate: str, customer_id: str):
-        queryString = (
-            "select reserv.id, reserv.reservation_date, reserv.people_number, tab.id as id_table, rest.name, rest.id as rest_id "
-            "from reservation reserv "
-            "join user cust on cust.id = reserv.customer_id "
-            "join restaurant_table tab on reserv.table_id = tab.id "
-            "join restaurant rest on rest.id = tab.restaurant_id "
-            "where cust.id = :customer_id"
+        """
+        This method return all the reservations of the customer inside the days,
+        the newest first.
+        The history of a frequent customer should be read with
+        get_customer_reservations_page.
+        :param fromDate: the first day, e.g. "2020-10-07", or None
+        :param toDate: the last day, e.g. "2020-11-07", or None
+        :param customer_id: the customer id
+        :return: list of reservations with the restaurant
+        :raise ValueError: if a date is not valid
+        """
+        return (
+            UserService._customer_reservations(customer_id, fromDate, toDate)
+            .order_by(Reservation.reservation_date.desc(), Reservation.id.desc())
+            .all()
         )
 
-        stmt = db.text(queryString)
-
-        # bind filter params...
-        params = {"customer_id": customer_id}
-        if fromDate:
-            params["fromDate"] = fromDate + " 00:00:00.000"
-        if toDate:
-            params["toDate"] = toDate + " 23:59:59.999"
+    @staticmethod
+    def get_customer_reservations_page(
+        customer_id: int,
+        upcoming: bool = True,
+        from_date: str = None,
+        to_date: str = None,
+        cursor: str = None,
+        page_size: int = PAGE_SIZE,
+    ):
+        """
+        This method return a page of the history of the customer, the upcoming
+        reservations from the next one, and the past ones from the last one.
+        :param customer_id: the customer id
+        :param upcoming: True for the reservations from now, False for the past ones
+        :param from_date: the first day, e.g. "2020-10-07", or None
+        :param to_date: the last day, e.g. "2020-11-07", or None
+        :param cursor: the token of the previous page, None for the first page
+        :param page_size: number of reservations inside a page
+        :return: (list of reservations, token of the next page or None)
+        :raise ValueError: if a date is not valid
+        """
+        query = UserService._customer_reservations(customer_id, from_date, to_date)
+        now = datetime.now()
+        if upcoming:
+            query = query.filter(Reservation.reservation_date >= now)
+        else:
+            query = query.filter(Reservation.reservation_date < now)
+        return paginate(
+            query, _CUSTOMER_RESERVATION_KEY, cursor, page_size, descending=not upcoming
+        )
 
-        # execute and retrive results...
-        result = db.engine.execute(stmt, params)
-        reservations_as_list = result.fetchall()
-        return reservations_as_list
+    @staticmethod
+    def _customer_reservations(customer_id: int, from_date: str, to_date: str):
+        """
+        Return the query of the reservations of the customer inside the days,
+        with the restaurant, without order.
+        The reservations are read from the index of the customer and the dates,
+        and the restaurant is joined only for the rows returned.
+        """
+        return (
+            db.session.query(
+                Reservation.id,
+                Reservation.reservation_date,
+                Reservation.people_number,
+                Reservation.table_id.label("id_table"),
+                Restaurant.name,
+                Restaurant.id.label("rest_id"),
+            )
+            .join(RestaurantTable, RestaurantTable.id == Reservation.table_id)
+            .join(Restaurant, Restaurant.id == RestaurantTable.restaurant_id)
+            .filter(Reservation.customer_id == customer_id)
+            .filter(
+                *time_windows.days_filter(
+                    Reservation.reservation_date, from_date, to_date
+                )
+            )
+        )
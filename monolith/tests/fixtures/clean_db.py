@@ -13,9 +13,15 @@ def del_db():
     Del db before run the tests
     :return:
     """
+    my_path = os.path.abspath(os.path.dirname(__file__))
+    path = os.path.join(my_path, "../")
     try:
-        my_path = os.path.abspath(os.path.dirname(__file__))
-        path = os.path.join(my_path, "../")
         os.remove("{}/gooutsafe.db".format(path))
     except OSError:
         assert False
+    # the files of the WAL journal, if there are connections still open
+    for suffix in ["-wal", "-shm"]:
+        try:
+            os.remove("{}/gooutsafe.db{}".format(path, suffix))
+        except OSError:
+            pass
@@ -1,8 +1,31 @@
 import pytest
 
 import datetime
-from monolith.database import db, User, Restaurant, Reservation, Positive
+import multiprocessing
+from collections import namedtuple
+from monolith.app_constant import CONFIRMATION_BOOKING
+from monolith.database import (
+    db,
+    User,
+    Restaurant,
+    Reservation,
+    Positive,
+    Outbox,
+    Friend,
+    RestaurantTable,
+)
 from monolith.services import BookingServices
+from monolith.services.availability_index import (
+    RestaurantAvailability,
+    availability_index,
+)
+from monolith.services.availability_search import (
+    AvailabilitySearch,
+    _generations,
+    _key,
+)
+from monolith.services.outbox import MAX_ATTEMPTS, NotificationOutbox
+from monolith.utils.dispaccer_events import DispatcherMessage
 from monolith.tests.utils import (
     get_user_with_email,
     create_restaurants_on_db,
@@ -14,7 +37,29 @@ from monolith.tests.utils import (
     del_time_for_rest,
     del_booking_services,
 )
-from sqlalchemy import func
+from sqlalchemy import event, func
+from sqlalchemy.orm import aliased
+
+## the customer inside the processes of the parallel bookings
+Customer = namedtuple("Customer", ["id", "email"])
+
+
+def _book_in_process(restaurant_id, customer, dates, attempts, results):
+    """
+    Book the same dates many times from a new process, with a new app
+    """
+    from monolith.app import create_app
+
+    app = create_app(tests=True)
+    booked = 0
+    with app.app_context():
+        for _ in range(attempts):
+            for date in dates:
+                book = BookingServices.book(restaurant_id, customer, date, 2, "a@a.com")
+                if book[0] is not None:
+                    booked += 1
+        db.session.remove()
+    results.put(booked)
 
 
 class Test_BookServices:
@@ -304,3 +349,491 @@ class Test_BookServices:
         # AT THE END THERE MUST TO BE ONLY ONE RESERVATION
         q = db.session.query(func.count(Reservation.id)).scalar()
         assert q == 1
+
+    def test_update_booking_in_place(self):
+        """
+        The update moves the reservation inside one transaction, without a
+        new reservation
+
+        Test flow
+        - new booking with two friends
+        - move it to a moment that overlaps itself, it keeps the table
+        and the row of the friend that stays
+        - move it to a moment where the table is taken, it changes table
+        - a change without free tables doesn't touch the reservation
+        """
+        user = create_user_on_db(787591)
+        rest_owner = create_user_on_db(787592)
+        restaurant = create_restaurants_on_db(user_id=rest_owner.id, tables=2)
+        date = datetime.datetime(year=2120, month=11, day=25, hour=13)
+        book = BookingServices.book(restaurant.id, user, date, 3, "a@a.com;b@b.com")
+        assert book[0] is not None
+        reservation_id, table_id = book[0].id, book[0].table_id
+        friend_a = db.session.query(Friend).filter_by(
+            reservation_id=reservation_id, email="a@a.com"
+        )
+        friend_a_id = friend_a.one().id
+
+        date = date + datetime.timedelta(minutes=15)
+        book = BookingServices.update_book(
+            reservation_id, user, date, 3, "a@a.com;d@d.com"
+        )
+        assert book[0] is not None
+        assert (book[0].id, book[0].table_id) == (reservation_id, table_id)
+        assert book[0].reservation_date == date
+        friends = db.session.query(Friend).filter_by(reservation_id=reservation_id)
+        assert sorted(friend.email for friend in friends) == ["a@a.com", "d@d.com"]
+        assert friend_a.one().id == friend_a_id
+        assert db.session.query(Reservation).filter_by(customer_id=user.id).count() == 1
+
+        # the table is taken at the new moment
+        date = date.replace(hour=20)
+        other = Reservation()
+        other.reservation_date = date
+        other.reservation_end = date + datetime.timedelta(minutes=30)
+        other.customer_id = rest_owner.id
+        other.table_id = table_id
+        other.people_number = 1
+        db.session.add(other)
+        db.session.commit()
+        availability_index.invalidate(restaurant.id)
+        book = BookingServices.update_book(reservation_id, user, date, 2, "a@a.com")
+        assert book[0] is not None
+        assert book[0].id == reservation_id
+        assert book[0].table_id != table_id
+        assert friend_a.one().id == friend_a_id
+        assert friends.count() == 1
+
+        party = ";".join("{}@a.com".format(friend) for friend in range(9))
+        book = BookingServices.update_book(reservation_id, user, date, 10, party)
+        assert book == (None, "no tables available")
+        reservation = db.session.query(Reservation).filter_by(id=reservation_id).one()
+        assert (reservation.reservation_date, reservation.people_number) == (date, 2)
+        book = BookingServices.update_book(
+            reservation_id, rest_owner, date, 2, "a@a.com"
+        )
+        assert book == (None, "Reservation not found")
+
+        del_friends_of_reservation(reservation_id)
+        del_restaurant_on_db(restaurant.id)
+        del_user_on_db(user.id)
+        del_user_on_db(rest_owner.id)
+
+    def test_reservation_service_slot_written(self):
+        """
+        The service slot is computed by all the writers of the reservations,
+        also without the BookingServices
+
+        Test flow
+        - a reservation written with the session, at lunch of monday
+        - it is moved at dinner, and on tuesday when the restaurant is closed
+        """
+        user = create_user_on_db(787611)
+        rest_owner = create_user_on_db(787612)
+        restaurant = create_restaurants_on_db(user_id=rest_owner.id, tables=1)
+        table = db.session.query(RestaurantTable).filter_by(restaurant_id=restaurant.id)
+        date = datetime.datetime(year=2120, month=11, day=25, hour=13)
+        reservation = Reservation()
+        reservation.reservation_date = date
+        reservation.reservation_end = date + datetime.timedelta(minutes=30)
+        reservation.customer_id = user.id
+        reservation.table_id = table.one().id
+        reservation.people_number = 2
+        db.session.add(reservation)
+        db.session.commit()
+        assert reservation.service_slot == "{}:2120-11-25:lunch".format(restaurant.id)
+
+        reservation.reservation_date = date.replace(hour=20)
+        db.session.commit()
+        assert reservation.service_slot == "{}:2120-11-25:dinner".format(restaurant.id)
+        reservation.people_number = 3
+        db.session.commit()
+        assert reservation.service_slot == "{}:2120-11-25:dinner".format(restaurant.id)
+        reservation.reservation_date = date + datetime.timedelta(days=1)
+        db.session.commit()
+        assert reservation.service_slot is None
+        # the seed reservation is written after the migrations
+        assert db.session.query(Reservation).get(1).service_slot is not None
+
+        del_booking_services(reservation.id)
+        del_restaurant_on_db(restaurant.id)
+        del_user_on_db(user.id)
+        del_user_on_db(rest_owner.id)
+
+    def test_booking_after_delete_frees_table(self):
+        """
+        The table released by a deleted reservation must be bookable again
+        test flow
+        - Create a new customer
+        - Create a new restaurant with only one table
+        - book the table and delete the reservation
+        - book again the same table at the same time
+        """
+        user = create_user_on_db()
+        rest_owner = create_user_on_db(ran=2)
+        restaurant = create_restaurants_on_db(user_id=rest_owner.id, tables=1)
+
+        book = BookingServices.book(
+            restaurant.id,
+            user,
+            datetime.datetime(year=2120, month=11, day=25, hour=13),
+            4,
+            "a@a.com;b@b.com;c@c.com",
+        )
+        assert book[0] is not None
+        assert BookingServices.delete_book(book[0].id, user.id)
+
+        book2 = BookingServices.book(
+            restaurant.id,
+            user,
+            datetime.datetime(year=2120, month=11, day=25, hour=13),
+            4,
+            "a@a.com;b@b.com;c@c.com",
+        )
+        assert book2[0] is not None
+
+        del_friends_of_reservation(book[0].id)
+        del_friends_of_reservation(book2[0].id)
+        del_booking_services(book2[0].id)
+        del_restaurant_on_db(restaurant.id)
+        del_user_on_db(user.id)
+        del_user_on_db(rest_owner.id)
+
+        # AT THE END THERE MUST TO BE ONLY ONE RESERVATION
+        q = db.session.query(func.count(Reservation.id)).scalar()
+        assert q == 1
+
+    def test_booking_with_reservation_deleted_outside(self):
+        """
+        If a reservation is deleted without the BookingServices
+        the availability index is reloaded from the database
+        """
+        user = create_user_on_db()
+        rest_owner = create_user_on_db(ran=2)
+        restaurant = create_restaurants_on_db(user_id=rest_owner.id, tables=1)
+
+        book = BookingServices.book(
+            restaurant.id,
+            user,
+            datetime.datetime(year=2120, month=11, day=25, hour=13),
+            4,
+            "a@a.com;b@b.com;c@c.com",
+        )
+        assert book[0] is not None
+        del_friends_of_reservation(book[0].id)
+        del_booking_services(book[0].id)
+
+        book2 = BookingServices.book(
+            restaurant.id,
+            user,
+            datetime.datetime(year=2120, month=11, day=25, hour=13),
+            4,
+            "a@a.com;b@b.com;c@c.com",
+        )
+        assert book2[0] is not None
+
+        del_friends_of_reservation(book2[0].id)
+        del_booking_services(book2[0].id)
+        del_restaurant_on_db(restaurant.id)
+        del_user_on_db(user.id)
+        del_user_on_db(rest_owner.id)
+
+        # AT THE END THERE MUST TO BE ONLY ONE RESERVATION
+        q = db.session.query(func.count(Reservation.id)).scalar()
+        assert q == 1
+
+    def test_booking_smallest_table(self):
+        """
+        The index must return the smallest free table that fits the people
+        """
+        availability = RestaurantAvailability(1, "Trial", 30)
+        availability.add_table(1, "big", 8)
+        availability.add_table(2, "small", 2)
+        availability.add_table(3, "medium", 4)
+        start = datetime.datetime(year=2120, month=11, day=25, hour=13)
+        end = start + datetime.timedelta(minutes=30)
+
+        assert availability.find_table(2, start, end) == 2
+        assert availability.find_table(3, start, end) == 3
+
+        availability.add_slot(3, 10, start, end)
+        assert availability.find_table(3, start, end) == 1
+        # overlapped on the bounds
+        assert (
+            availability.find_table(3, end, end + datetime.timedelta(minutes=30)) == 1
+        )
+        assert availability.find_table(9, start, end) is None
+
+        availability.remove_slot(3, 10, start)
+        assert availability.find_table(3, start, end) == 3
+
+        # the parallel bookings start from a random table with the same seats
+        availability.add_table(4, "medium too", 4)
+        for _ in range(10):
+            assert availability.find_table(3, start, end, spread=True) in (3, 4)
+        availability.remove_table(3)
+        assert availability.find_table(3, start, end, spread=True) == 4
+
+    def test_booking_overlap_mixed_durations(self):
+        """
+        A long slot that starts earlier overlaps the booking also when a
+        shorter slot starts after it
+        """
+        availability = RestaurantAvailability(1, "Trial", 30)
+        availability.add_table(1, "only", 4)
+        day = datetime.datetime(year=2120, month=11, day=25)
+        availability.add_slot(1, 10, day.replace(hour=20), day.replace(hour=22))
+        availability.add_slot(
+            1, 11, day.replace(hour=20, minute=30), day.replace(hour=20, minute=45)
+        )
+
+        start = day.replace(hour=21)
+        end = day.replace(hour=21, minute=30)
+        assert not availability.is_free(1, start, end)
+        assert availability.find_table(2, start, end) is None
+
+        # without the long slot the table is free after the short one
+        availability.remove_slot(1, 10, day.replace(hour=20))
+        assert availability.is_free(1, start, end)
+        assert not availability.is_free(
+            1, day.replace(hour=20, minute=40), day.replace(hour=21)
+        )
+        assert availability.is_free(1, day.replace(hour=22), day.replace(hour=23))
+
+    def test_availability_search(self):
+        """
+        The slots of the search are the moments where the booking is accepted,
+        they are cached and updated after the bookings
+
+        Test flow
+        - new restaurant with one table, open at lunch and dinner on monday
+        - all the moments of the services are free
+        - a booking takes the slots that overlap it, until it is deleted
+        """
+        user = create_user_on_db(787601)
+        rest_owner = create_user_on_db(787602)
+        restaurant = create_restaurants_on_db(user_id=rest_owner.id, tables=1)
+        monday = datetime.date(year=2120, month=11, day=25)
+
+        slots = AvailabilitySearch.search(restaurant.id, 2, monday.isoformat())
+        starts = [slot.start for slot in slots]
+        # 12:00 - 15:00 and 19:00 - 22:00, every 15 minutes
+        assert len(starts) == 26
+        assert starts[0] == datetime.datetime.combine(monday, datetime.time(12))
+        assert starts[-1] == datetime.datetime.combine(monday, datetime.time(22))
+        assert {slot.free_tables for slot in slots} == {1}
+
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", capture)
+        try:
+            assert AvailabilitySearch.search(restaurant.id, 2, monday) == slots
+        finally:
+            event.remove(db.engine, "before_cursor_execute", capture)
+        assert statements == []
+
+        book = BookingServices.book(restaurant.id, user, starts[4], 2, "a@a.com")
+        assert book[0] is not None
+        slots = AvailabilitySearch.search(restaurant.id, 2, monday)
+        # the slots that start from 30 minutes before the booking to its end
+        assert [slot.start for slot in slots] == starts[:2] + starts[7:]
+        for slot in slots:
+            assert not (book[0].reservation_date <= slot.start <= starts[6])
+        assert AvailabilitySearch.search(restaurant.id, 7, monday) == []
+        # only monday is open
+        tuesday = monday + datetime.timedelta(days=1)
+        slots = AvailabilitySearch.search(restaurant.id, 2, monday, tuesday)
+        assert len(slots) == 21
+
+        assert BookingServices.delete_book(book[0].id, user.id)
+        assert len(AvailabilitySearch.search(restaurant.id, 2, monday)) == 26
+        # a generation removed from the cache is replaced by a new one,
+        # so the old slots of the restaurant are not used again
+        key = _key(restaurant.id, monday, 2)
+        _generations.invalidate()
+        assert _key(restaurant.id, monday, 2)[1] > key[1]
+        with pytest.raises(ValueError):
+            AvailabilitySearch.search(restaurant.id, 0, monday)
+        with pytest.raises(ValueError):
+            AvailabilitySearch.search(restaurant.id, 2, tuesday, monday)
+        with pytest.raises(ValueError):
+            AvailabilitySearch.search(restaurant.id, 2, "monday")
+
+        del_friends_of_reservation(book[0].id)
+        del_restaurant_on_db(restaurant.id)
+        del_user_on_db(user.id)
+        del_user_on_db(rest_owner.id)
+
+    def test_parallel_bookings_no_double_booking(self):
+        """
+        Many processes book the same tables at the same time, each table
+        must be booked only once for each date.
+
+        Test flow
+        - new restaurant with 3 tables
+        - 4 processes book the same 2 dates many times
+        - check the number of reservations and that no reservation overlaps
+        - del reservations and restaurant
+        """
+        user = create_user_on_db(787521)
+        rest_owner = create_user_on_db(787522)
+        restaurant = create_restaurants_on_db(user_id=rest_owner.id, tables=3)
+        dates = [
+            datetime.datetime(year=2120, month=11, day=25, hour=13),
+            datetime.datetime(year=2120, month=11, day=25, hour=20),
+        ]
+        restaurant_id = restaurant.id
+        customer = Customer(user.id, user.email)
+        owner_id = rest_owner.id
+        # the processes must not share the connections of the pool
+        db.session.remove()
+        db.engine.dispose()
+
+        context = multiprocessing.get_context("fork")
+        results = context.Queue()
+        processes = [
+            context.Process(
+                target=_book_in_process,
+                args=(restaurant_id, customer, dates, 5, results),
+            )
+            for _ in range(4)
+        ]
+        for process in processes:
+            process.start()
+        booked = sum(results.get(timeout=120) for _ in processes)
+        for process in processes:
+            process.join()
+
+        reservations = db.session.query(Reservation).filter_by(customer_id=customer.id)
+        assert booked == 6
+        assert reservations.count() == 6
+        other = aliased(Reservation)
+        overlaps = (
+            db.session.query(Reservation.id)
+            .join(
+                other,
+                (other.table_id == Reservation.table_id)
+                & (other.id != Reservation.id)
+                & (other.reservation_date <= Reservation.reservation_end)
+                & (other.reservation_end >= Reservation.reservation_date),
+            )
+            .filter(Reservation.customer_id == customer.id)
+            .count()
+        )
+        assert overlaps == 0
+
+        for reservation in reservations.all():
+            del_friends_of_reservation(reservation.id)
+        del_restaurant_on_db(restaurant_id)
+        del_user_on_db(customer.id)
+        del_user_on_db(owner_id)
+
+    def test_booking_confirmation_outbox(self, monkeypatch):
+        """
+        The confirmation of the booking is written with the reservation,
+        and it is deleted only after the relay sends it
+
+        Test flow
+        - new booking, the confirmation is inside the outbox
+        - the SMTP server fails, the message stays inside the outbox
+        - the lease expires, the message is sent and deleted
+        - with celery the message is deleted when the broker has it
+        """
+        user = create_user_on_db(787551)
+        rest_owner = create_user_on_db(787552)
+        restaurant = create_restaurants_on_db(user_id=rest_owner.id, tables=1)
+        NotificationOutbox.relay_all()
+
+        date = datetime.datetime(year=2120, month=11, day=25, hour=13)
+        book = BookingServices.book(restaurant.id, user, date, 2, "a@a.com")
+        assert book[0] is not None
+        message = db.session.query(Outbox).one()
+        assert message.type_message == CONFIRMATION_BOOKING
+        params = [user.email, user.email, restaurant.name, ["a@a.com"]]
+        params.append(date.isoformat())
+
+        def smtp_down(type_message, params):
+            raise ConnectionError("SMTP server down")
+
+        # the handlers run inside the relay, without celery
+        monkeypatch.setattr(DispatcherMessage, "deliver", smtp_down)
+        assert NotificationOutbox.relay() == 0
+        message = db.session.query(Outbox).one()
+        assert message.attempts == 1
+        assert message.next_attempt > datetime.datetime.utcnow()
+        # the messages of a running relay are not sent again
+        assert NotificationOutbox.relay() == 0
+
+        sent = []
+        monkeypatch.setattr(
+            DispatcherMessage, "deliver", lambda *message: sent.append(message)
+        )
+        message.next_attempt = datetime.datetime.utcnow()
+        db.session.commit()
+        assert NotificationOutbox.relay() == 1
+        assert sent == [(CONFIRMATION_BOOKING, params)]
+        assert db.session.query(Outbox).count() == 0
+
+        NotificationOutbox.add(CONFIRMATION_BOOKING, params)
+        db.session.commit()
+        batches = []
+        monkeypatch.setattr(DispatcherMessage, "send_batches", batches.extend)
+        DispatcherMessage.configure("celery")
+        try:
+            assert NotificationOutbox.relay() == 1
+        finally:
+            DispatcherMessage.configure("sync")
+        assert batches == [(CONFIRMATION_BOOKING, [params])]
+        assert db.session.query(Outbox).count() == 0
+
+        del_friends_of_reservation(book[0].id)
+        del_booking_services(book[0].id)
+        del_restaurant_on_db(restaurant.id)
+        del_user_on_db(user.id)
+        del_user_on_db(rest_owner.id)
+
+    def test_outbox_dead_letter(self, monkeypatch):
+        """
+        A message not sent after MAX_ATTEMPTS attempts is moved to the
+        dead letters and the relay doesn't claim it anymore
+
+        Test flow
+        - a message fails MAX_ATTEMPTS - 1 times, it is still alive
+        - it fails the last attempt, it is dead and it stays inside the outbox
+        - the relay sends the next message, the dead one is skipped
+        """
+        NotificationOutbox.relay_all()
+        params = ["a@a.com", "a@a.com", "Dead letter", [], "2120-11-25T13:00:00"]
+        NotificationOutbox.add(CONFIRMATION_BOOKING, params)
+        db.session.commit()
+
+        def smtp_down(type_message, params):
+            raise ConnectionError("SMTP server down")
+
+        monkeypatch.setattr(DispatcherMessage, "deliver", smtp_down)
+        message = db.session.query(Outbox).one()
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            assert NotificationOutbox.relay() == 0
+            db.session.refresh(message)
+            assert message.attempts == attempt
+            assert message.dead == (attempt == MAX_ATTEMPTS)
+            # the lease is expired
+            message.next_attempt = datetime.datetime.utcnow()
+            db.session.commit()
+
+        sent = []
+        monkeypatch.setattr(
+            DispatcherMessage, "deliver", lambda *message: sent.append(message)
+        )
+        NotificationOutbox.add(CONFIRMATION_BOOKING, params)
+        db.session.commit()
+        assert NotificationOutbox.relay_all() == 1
+        assert sent == [(CONFIRMATION_BOOKING, params)]
+        dead = db.session.query(Outbox).one()
+        assert dead.id == message.id and dead.attempts == MAX_ATTEMPTS
+
+        db.session.delete(dead)
+        db.session.commit()
@@ -0,0 +1,139 @@
+import datetime
+import threading
+
+import pytest
+from flask import current_app
+
+from monolith.app_constant import CONFIRMATION_BOOKING, EMAIL_TO_FRIEND
+from monolith.utils import dispaccer_events
+from monolith.utils.dispaccer_events import (
+    DispatcherMessage,
+    send_booking_confirmation_to_friends_celery,
+)
+from monolith.tests.utils import login
+
+
+@pytest.fixture
+def received(monkeypatch):
+    """
+    Replace the handler of the booking confirmation with one that store the calls
+    """
+    calls = []
+
+    def handler(*params):
+        calls.append((threading.current_thread().name, current_app.name, params))
+
+    monkeypatch.setitem(
+        dispaccer_events._HANDLERS,
+        CONFIRMATION_BOOKING,
+        (handler, send_booking_confirmation_to_friends_celery),
+    )
+    yield calls
+    DispatcherMessage.configure("sync")
+
+
+class Test_Dispatcher:
+    """
+    This test suite test the backends of the DispatcherMessage.
+    All the code tested inside this class is inside the utils/dispaccer_events.py
+    """
+
+    def test_sync_backend(self, received):
+        date = datetime.datetime(year=2120, month=11, day=25, hour=13)
+        DispatcherMessage.send_message(
+            CONFIRMATION_BOOKING, ["a@a.com", "A", "Trial", ["b@b.com"], date]
+        )
+        # the params are the same received by celery
+        assert received == [
+            (
+                threading.current_thread().name,
+                current_app.name,
+                ("a@a.com", "A", "Trial", ["b@b.com"], date.isoformat()),
+            )
+        ]
+
+    def test_thread_backend(self, received):
+        DispatcherMessage.configure("thread")
+        batch = [["a@a.com"], ["b@b.com"], ["c@c.com"]]
+        job_id = DispatcherMessage.send_batches([(CONFIRMATION_BOOKING, batch)])
+        assert job_id is not None
+        DispatcherMessage.backend.shutdown()
+
+        assert sorted(params for _, _, params in received) == [
+            ("a@a.com",),
+            ("b@b.com",),
+            ("c@c.com",),
+        ]
+        # the messages run outside the request, with the app of the request
+        for thread_name, app_name, _ in received:
+            assert thread_name.startswith("dispatcher")
+            assert app_name == current_app.name
+        # the job is polled as the jobs of celery
+        assert DispatcherMessage.job_status(job_id) == {
+            "job_id": job_id,
+            "tasks": 1,
+            "completed": 1,
+            "failed": False,
+            "ready": True,
+        }
+        assert DispatcherMessage.job_status("a job") is None
+
+    def test_local_job_failed(self, received, monkeypatch):
+        def broken(*params):
+            raise ConnectionError("SMTP server down")
+
+        monkeypatch.setitem(
+            dispaccer_events._HANDLERS,
+            EMAIL_TO_FRIEND,
+            (broken, send_booking_confirmation_to_friends_celery),
+        )
+        assert DispatcherMessage.send_batches([]) is None
+        job_id = DispatcherMessage.send_batches(
+            [
+                (CONFIRMATION_BOOKING, [["a@a.com"]]),
+                (EMAIL_TO_FRIEND, [["b@b.com"], ["c@c.com"]]),
+            ]
+        )
+        # the batch that fails doesn't stop the other batches
+        assert len(received) == 1
+        status = DispatcherMessage.job_status(job_id)
+        assert status["tasks"] == 2
+        assert status["completed"] == 1
+        assert status["failed"]
+        assert status["ready"]
+
+        # the oldest jobs are dropped
+        monkeypatch.setattr(dispaccer_events.local_jobs, "max_jobs", 1)
+        DispatcherMessage.send_batches([(CONFIRMATION_BOOKING, [["d@d.com"]])])
+        assert DispatcherMessage.job_status(job_id) is None
+
+    def test_notification_job_view(self, client, received):
+        job_id = DispatcherMessage.send_batches([(CONFIRMATION_BOOKING, [["a@a.com"]])])
+        login(client, "health_authority@gov.com", "nocovid")
+        response = client.get("/health/notification_job/{}".format(job_id))
+        assert response.status_code == 200
+        assert response.json["ready"]
+        response = client.get("/health/notification_job/a job")
+        assert response.status_code == 404
+
+    def test_celery_backend(self, received, monkeypatch):
+        tasks = []
+        monkeypatch.setattr(
+            send_booking_confirmation_to_friends_celery,
+            "apply_async",
+            lambda args: tasks.append(args),
+        )
+        DispatcherMessage.configure("celery")
+        DispatcherMessage.send_message(CONFIRMATION_BOOKING, ["a@a.com"])
+        assert tasks == [["a@a.com"]]
+        assert received == []
+
+    def test_unknown_backend(self):
+        with pytest.raises(ValueError):
+            DispatcherMessage.configure("carrier pigeon")
+        with pytest.raises(KeyError):
+            DispatcherMessage.send_message("UNKNOWN", [])
+        # the real handlers compose the emails, they are not sent inside the tests
+        DispatcherMessage.send_message(
+            EMAIL_TO_FRIEND, ["a@a.com", "2120-11-25", "Trial"]
+        )
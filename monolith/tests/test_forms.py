@@ -1,6 +1,8 @@
 """
 This test case covered all simple action that we can do from the UI
 """
+import json
+
 from monolith.database import Review
 from monolith.tests.utils import *
 from datetime import datetime, timedelta
@@ -411,6 +413,54 @@ class Test_GoOutSafeForm:
         assert response.status_code == 200
         assert "not_logged_test" not in response.data.decode("utf-8")
 
+    def test_export_reservations(self, client):
+        """
+        This test unit, tests the export of the reservations of the restaurant
+        as operator
+        """
+        response = login(client, "ham.burger@email.com", "operator")
+        assert response.status_code == 200
+
+        response = client.get(
+            "/restaurant/reservations/export?format=json&columns=id,email"
+        )
+        assert response.status_code == 200
+        reservations = json.loads(response.data.decode("utf-8"))
+        for reservation in reservations:
+            assert set(reservation.keys()) == {"id", "email"}
+
+        response = client.get("/restaurant/reservations/export?fromDate=2013-10-07")
+        assert response.status_code == 200
+        assert response.data.decode("utf-8").startswith("id,reservation_date,")
+
+        response = client.get("/restaurant/reservations/export?format=xml")
+        assert response.status_code == 400
+        response = client.get("/restaurant/reservations/export?columns=password")
+        assert response.status_code == 400
+        response = visit_reservation(client, "yesterday", "2014-10-07", "")
+        assert response.status_code == 400
+
+    def test_restaurant_availability(self, client):
+        """
+        This test unit, tests the search of the free slots of a restaurant
+        """
+        restaurant = db.session.query(Restaurant).all()[0]
+        url = "/restaurant/{}/availability".format(restaurant.id)
+        response = client.get(url + "?people=2&fromDate=2120-11-25&toDate=2120-11-27")
+        assert response.status_code == 200
+        availability = json.loads(response.data.decode("utf-8"))
+        assert availability["people_number"] == 2
+        for slot in availability["slots"]:
+            assert slot["free_tables"] > 0
+            assert slot["start"].startswith("2120-11-2")
+
+        response = client.get(url + "?people=0")
+        assert response.status_code == 400
+        response = client.get(url + "?fromDate=2120-11-25&toDate=2120-12-25")
+        assert response.status_code == 400
+        response = client.get("/restaurant/999999/availability")
+        assert response.status_code == 404
+
     def test_make_review_ko(self, client):
         """
         This test unit, tests the use case to perform the request to make a new review
@@ -1147,6 +1197,18 @@ class Test_GoOutSafeForm:
 
         response = client.get("/customer/reservations")
         assert response.status_code == 200
+        response = client.get("/customer/reservations?history=past")
+        assert response.status_code == 200
+
+        response = client.get("/customer/reservations/history?history=past")
+        assert response.status_code == 200
+        history = json.loads(response.data.decode("utf-8"))
+        dates = [row["reservation_date"] for row in history["reservations"]]
+        assert dates == sorted(dates, reverse=True)
+        response = client.get("/customer/reservations/history?history=soon")
+        assert response.status_code == 400
+        response = client.get("/customer/reservations/history?fromDate=yesterday")
+        assert response.status_code == 400
 
     def test_create_restaurant_form(self, client):
         """
@@ -1466,7 +1528,8 @@ class Test_GoOutSafeForm:
         mark.phone = customer1.phone
         response = mark_people_for_covid19(client, mark)
         assert response.status_code == 200
-        assert "logged_test" in response.data.decode("utf-8")
+        # the health authority polls the job of the notifications
+        assert response.json["ready"] and not response.json["failed"]
 
         q_already_positive = (
             db.session.query(Positive)
@@ -1549,7 +1612,8 @@ class Test_GoOutSafeForm:
         mark.phone = ""
         response = mark_people_for_covid19(client, mark)
         assert response.status_code == 200
-        assert "logged_test" in response.data.decode("utf-8")
+        # the health authority polls the job of the notifications
+        assert response.json["ready"] and not response.json["failed"]
 
         q_already_positive = (
             db.session.query(Positive)
@@ -1632,7 +1696,8 @@ class Test_GoOutSafeForm:
         mark.phone = customer1.phone
         response = mark_people_for_covid19(client, mark)
         assert response.status_code == 200
-        assert "logged_test" in response.data.decode("utf-8")
+        # the health authority polls the job of the notifications
+        assert response.json["ready"] and not response.json["failed"]
 
         q_already_positive = (
             db.session.query(Positive)
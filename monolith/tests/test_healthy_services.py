@@ -1,8 +1,10 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import pytest
-from monolith.database import db, Positive
-from monolith.services import HealthyServices, User, timedelta
+from monolith.database import db, Positive, User
+from monolith.services import HealthyServices
+from monolith.services.notification_fanout import PositiveNotificationFanOut
+from monolith.app_constant import *
 from monolith.tests.utils import (
     create_user_on_db,
     del_user_on_db,
@@ -314,3 +316,149 @@ class Test_HealthyServices:
         del_user_on_db(customer2.id)
         del_restaurant_on_db(restaurant.id)
         ## TODO
+
+    def test_search_contacts_only_same_service(self):
+        """
+        Only the people in the same restaurant during the same service (lunch or dinner)
+        are contacts of the positive customer
+        """
+        owner = create_user_on_db(787446)
+        restaurant = create_restaurants_on_db("Pepperwood Lunch", user_id=owner.id)
+        customer1 = create_user_on_db(787447)
+        customer2 = create_user_on_db(787448)
+        customer3 = create_user_on_db(787449)
+
+        # the monday of the last week, the restaurant is open only on monday
+        last_monday = get_today_midnight() - timedelta(
+            days=datetime.today().weekday() + 7
+        )
+        create_random_booking(
+            1, restaurant.id, customer1, last_monday + timedelta(hours=13), "a@aa.com"
+        )
+        create_random_booking(
+            1, restaurant.id, customer2, last_monday + timedelta(hours=14), "b@b.com"
+        )
+        create_random_booking(
+            1, restaurant.id, customer3, last_monday + timedelta(hours=20), "c@c.com"
+        )
+
+        message = HealthyServices.mark_positive(user_phone=customer1.phone)
+        assert len(message) == 0
+
+        contacts = HealthyServices.search_contacts(customer1.id)
+        assert len(contacts) == 1
+        assert contacts[0][0] == customer2.id
+        assert contacts[0][3] == customer2.email
+
+        message = HealthyServices.unmark_positive("", customer1.phone)
+        assert len(message) == 0
+
+        delete_was_positive_with_user_id(customer1.id)
+        del_user_on_db(customer1.id)
+        del_user_on_db(customer2.id)
+        del_user_on_db(customer3.id)
+        del_restaurant_on_db(restaurant.id)
+        del_user_on_db(owner.id)
+
+    def test_search_contacts_order(self):
+        """
+        The contacts are listed in the order of the reservations of the positive
+        customer, and then in the order of the reservations of the contacts
+        """
+        owner = create_user_on_db(787621)
+        restaurant = create_restaurants_on_db("Pepperwood Order", user_id=owner.id)
+        customer1 = create_user_on_db(787622)
+        customer2 = create_user_on_db(787623)
+        customer3 = create_user_on_db(787624)
+
+        last_monday = get_today_midnight() - timedelta(
+            days=datetime.today().weekday() + 7
+        )
+        create_random_booking(
+            1, restaurant.id, customer1, last_monday + timedelta(hours=13), "a@aa.com"
+        )
+        # the contact at dinner books before the contact at lunch
+        create_random_booking(
+            1, restaurant.id, customer3, last_monday + timedelta(hours=20), "c@c.com"
+        )
+        create_random_booking(
+            1, restaurant.id, customer2, last_monday + timedelta(hours=14), "b@b.com"
+        )
+        create_random_booking(
+            1, restaurant.id, customer1, last_monday + timedelta(hours=21), "a@aa.com"
+        )
+
+        message = HealthyServices.mark_positive(user_phone=customer1.phone)
+        assert len(message) == 0
+
+        contacts = HealthyServices.search_contacts(customer1.id)
+        assert [contact[0] for contact in contacts] == [customer2.id, customer3.id]
+
+        message = HealthyServices.unmark_positive("", customer1.phone)
+        assert len(message) == 0
+
+        delete_was_positive_with_user_id(customer1.id)
+        del_user_on_db(customer1.id)
+        del_user_on_db(customer2.id)
+        del_user_on_db(customer3.id)
+        del_restaurant_on_db(restaurant.id)
+        del_user_on_db(owner.id)
+
+    def test_notification_recipients_positive(self):
+        """
+        The notifications of a new positive are computed without duplicates for:
+        the restaurants with a future booking, the restaurants with a past booking,
+        the friends of the positive, the contacts and their friends.
+        """
+        owner = create_user_on_db(787456)
+        restaurant = create_restaurants_on_db("Pepperwood Notify", user_id=owner.id)
+        customer1 = create_user_on_db(787457)
+        customer2 = create_user_on_db(787458)
+
+        last_monday = get_today_midnight() - timedelta(
+            days=datetime.today().weekday() + 7
+        )
+        create_random_booking(
+            1, restaurant.id, customer1, last_monday + timedelta(hours=13), "a@aa.com"
+        )
+        create_random_booking(
+            1, restaurant.id, customer2, last_monday + timedelta(hours=14), "b@b.com"
+        )
+        create_random_booking(
+            1,
+            restaurant.id,
+            customer1,
+            last_monday + timedelta(days=14, hours=13),
+            "a@aa.com",
+        )
+
+        messages = PositiveNotificationFanOut.recipients(customer1)
+        recipients = sorted(
+            (message[0], message[2][0])
+            for message in messages
+            if message[0] != EMAIL_TO_FRIEND
+        )
+        assert recipients == sorted(
+            [
+                (NEW_COVID_TO_RESTAURANT_BOOKING, owner.email),
+                (NEW_POSITIVE_WAS_IN_RESTAURANT, owner.email),
+                (NEW_POSITIVE_CONTACT, customer2.email),
+            ]
+        )
+        friends = [
+            message[2][0] for message in messages if message[0] == EMAIL_TO_FRIEND
+        ]
+        assert "a@aa.com" in friends
+        assert "b@b.com" in friends
+        assert len(friends) == len(set(friends))
+
+        # the friends are in the same batch, one batch for each type
+        batches = PositiveNotificationFanOut.batches(messages)
+        assert len(batches) == 4
+        batches = PositiveNotificationFanOut.batches(messages, chunk_size=1)
+        assert len(batches) == len(messages)
+
+        del_user_on_db(customer1.id)
+        del_user_on_db(customer2.id)
+        del_restaurant_on_db(restaurant.id)
+        del_user_on_db(owner.id)
@@ -0,0 +1,121 @@
+import re
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from monolith.database import db
+from monolith.services import (
+    BookingServices,
+    RestaurantServices,
+    UserService,
+    HealthyServices,
+)
+from monolith.services.availability_index import availability_index
+from monolith.services.notification_fanout import PositiveNotificationFanOut
+from monolith.tests.utils import (
+    create_user_on_db,
+    create_restaurants_on_db,
+    create_random_booking,
+    get_today_midnight,
+    del_user_on_db,
+    del_restaurant_on_db,
+    del_booking_with_user_id,
+)
+
+## a step of the plan that reads all the rows of a table, the older versions
+## of SQLite write "SCAN TABLE user" and the newer ones "SCAN user"
+_FULL_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)")
+
+
+def _capture_selects(calls):
+    """
+    Run the calls and return all the SELECT statements executed, with the params
+    """
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, "before_cursor_execute", capture)
+    try:
+        for call in calls:
+            call()
+    finally:
+        event.remove(db.engine, "before_cursor_execute", capture)
+    return statements
+
+
+def _full_scans(statements):
+    """
+    Return the (statement, plan step) of the statements that read a whole table
+    """
+    scans = []
+    steps = 0
+    with db.engine.connect() as connection:
+        for statement, parameters in statements:
+            plan = connection.execute(
+                "EXPLAIN QUERY PLAN " + statement, parameters
+            ).fetchall()
+            steps += len(plan)
+            for step in plan:
+                if _FULL_SCAN.match(step[-1]):
+                    scans.append((" ".join(statement.split()), step[-1]))
+    # without steps the check would pass with any plan
+    assert steps > 0
+    return scans
+
+
+class Test_QueryPlans:
+    """
+    This test suite check with EXPLAIN QUERY PLAN that the queries of the hot paths
+    (booking, contact tracing and reservation lists) use the indexes,
+    and they don't read the whole tables.
+    """
+
+    def test_hot_paths_use_indexes(self):
+        owner = create_user_on_db(787466)
+        restaurant = create_restaurants_on_db("Pepperwood Plans", user_id=owner.id)
+        customer1 = create_user_on_db(787467)
+        customer2 = create_user_on_db(787468)
+
+        last_monday = get_today_midnight() - timedelta(
+            days=datetime.today().weekday() + 7
+        )
+        create_random_booking(
+            1, restaurant.id, customer1, last_monday + timedelta(hours=13), "a@aa.com"
+        )
+        create_random_booking(
+            1, restaurant.id, customer2, last_monday + timedelta(hours=14), "b@b.com"
+        )
+        start = datetime.now() + timedelta(days=1)
+        availability_index.invalidate(restaurant.id)
+
+        statements = _capture_selects(
+            [
+                lambda: availability_index.get(restaurant.id),
+                lambda: BookingServices._free_table_version(
+                    restaurant.id, 1, 2, start, start + timedelta(minutes=30)
+                ),
+                lambda: HealthyServices.search_contacts(customer1.id),
+                lambda: PositiveNotificationFanOut.recipients(customer1),
+                lambda: RestaurantServices.get_reservation_rest(
+                    owner.id, restaurant.id, "2020-01-01", "2120-01-01", None
+                ),
+                lambda: RestaurantServices.get_reservation_rest(
+                    owner.id, restaurant.id, None, None, customer2.email
+                ),
+                lambda: UserService.get_customer_reservation(None, None, customer1.id),
+            ]
+        )
+        # the contacts and the friends are resolved too
+        assert any("JOIN user" in statement for statement, _ in statements)
+        assert any("FROM friend" in statement for statement, _ in statements)
+        assert _full_scans(statements) == []
+
+        del_booking_with_user_id(customer1.id)
+        del_booking_with_user_id(customer2.id)
+        del_user_on_db(customer1.id)
+        del_user_on_db(customer2.id)
+        del_restaurant_on_db(restaurant.id)
+        del_user_on_db(owner.id)
@@ -1,9 +1,27 @@
+import io
 from random import random, randrange
 
-from monolith.database import db, User, Restaurant, Review, MenuDish, Reservation
+import pytest
+from sqlalchemy import event, extract
+
+from monolith.database import (
+    db,
+    User,
+    Restaurant,
+    Review,
+    MenuDish,
+    Reservation,
+    OpeningHours,
+    RestaurantTable,
+    ReconcileWatermark,
+)
 from monolith.forms import RestaurantForm
+from monolith import time_windows
 from monolith.services.restaurant_services import RestaurantServices
-from datetime import datetime
+from monolith.services.nearby_restaurants import NearbyRestaurants
+from monolith.services.restaurant_import import RestaurantImport
+from monolith.principals import principal_cache
+from datetime import datetime, time, timedelta
 
 from monolith.tests.utils import (
     get_user_with_email,
@@ -16,6 +34,7 @@ from monolith.tests.utils import (
     create_review_for_restaurants,
     get_rest_with_name,
     del_all_review_for_rest,
+    get_today_midnight,
 )
 
 
@@ -177,6 +196,41 @@ class Test_RestaurantServices:
 
         db.session.commit()
 
+    def test_sample_reviews(self):
+        """
+        check the random sample of the reviews
+
+        Test flow:
+        - Create owner
+        - Create restaurant1 and binding owner
+        - Sample without reviews
+        - Sample with less reviews than requested
+        - Sample with more reviews than requested
+        - erase all data create inside the test
+        """
+        owner_one = create_user_on_db(randrange(100000))
+        assert owner_one is not None
+        restaurant_one = create_restaurants_on_db(name="First", user_id=owner_one.id)
+        assert restaurant_one is not None
+
+        assert RestaurantServices.sample_reviews(restaurant_one.id, 3) == []
+
+        create_review_for_restaurants(starts=3.0, rest_id=restaurant_one.id)
+        create_review_for_restaurants(starts=4.0, rest_id=restaurant_one.id)
+        reviews = RestaurantServices.sample_reviews(restaurant_one.id, 3)
+        assert len(reviews) == 2
+
+        for _ in range(20):
+            create_review_for_restaurants(starts=5.0, rest_id=restaurant_one.id)
+        for _ in range(10):
+            reviews = RestaurantServices.sample_reviews(restaurant_one.id, 3)
+            assert len(reviews) == 3
+            assert len({review.id for review in reviews}) == 3
+
+        del_all_review_for_rest(restaurant_one.id)
+        del_restaurant_on_db(restaurant_one.id)
+        del_user_on_db(owner_one.id)
+
     def test_search_restaurant_by_key_ok_complete_name(self):
         """
         This test unit test the service to perform the search by keyword of the restaurants
@@ -212,6 +266,207 @@ class Test_RestaurantServices:
         for rest in rest_by_name:
             del_restaurant_on_db(rest.id)
 
+    def test_search_restaurant_cuisine_and_dishes(self):
+        """
+        This test unit test the full text search of the restaurants by name, cuisine
+        and dishes, with the index updated on each change
+
+        Test flow:
+        - Create two restaurants, one with a name and one with a dish that match the search
+        - Search with a prefix, the match of the name comes first
+        - Search by cuisine
+        - Delete the dish and rename the restaurant, the search is updated
+        - erase all data create inside the test
+        """
+        owner = create_user_on_db(randrange(100000))
+        assert owner is not None
+        by_name = create_restaurants_on_db("Zucchetto Trattoria", owner.id)
+        by_dish = create_restaurants_on_db("Da Mario", owner.id)
+        dish = MenuDish()
+        dish.name = "Zucchetto fritto"
+        dish.price = 4.0
+        dish.restaurant_id = by_dish.id
+        db.session.add(dish)
+        db.session.commit()
+
+        result = RestaurantServices.get_restaurants_by_keyword(name="zucch")
+        assert [rest.id for rest in result] == [by_name.id, by_dish.id]
+        result = RestaurantServices.get_restaurants_by_keyword(name="zucch fritt")
+        assert [rest.id for rest in result] == [by_dish.id]
+        result = RestaurantServices.get_restaurants_by_keyword(name="Italian")
+        assert by_name.id in [rest.id for rest in result]
+
+        db.session.query(MenuDish).filter_by(id=dish.id).delete()
+        db.session.query(Restaurant).filter_by(id=by_name.id).update(
+            {"name": "Trattoria Verde"}
+        )
+        db.session.commit()
+        result = RestaurantServices.get_restaurants_by_keyword(name="zucch")
+        assert len(result) == 0
+        result = RestaurantServices.get_restaurants_by_keyword(name="verd")
+        assert [rest.id for rest in result] == [by_name.id]
+
+        del_restaurant_on_db(by_name.id)
+        del_restaurant_on_db(by_dish.id)
+        del_user_on_db(owner.id)
+
+    def test_near_restaurants(self, client):
+        """
+        This test unit test the search of the restaurants near a position
+
+        Test flow:
+        - Create three restaurants at 0.1 km, 3.3 km and 33 km from the position
+        - Search the 2 nearest restaurants
+        - Search the restaurants inside 10 km, also with the API
+        - erase all data create inside the test
+        """
+        owner = create_user_on_db(randrange(100000))
+        assert owner is not None
+        positions = [(45.0, 9.001), (45.03, 9.0), (45.3, 9.0)]
+        near = []
+        for lat, lon in positions:
+            rest = create_restaurants_on_db("Near", owner.id)
+            rest.lat = lat
+            rest.lon = lon
+            near.append(rest)
+        db.session.commit()
+
+        result = NearbyRestaurants.nearest(45.0, 9.0, 2, only_open=False)
+        assert [rest.id for rest, _ in result] == [near[0].id, near[1].id]
+        assert abs(result[1][1] - 3.336) < 0.01
+
+        result = NearbyRestaurants.within(45.0, 9.0, 10)
+        assert [rest.id for rest, _ in result] == [near[0].id, near[1].id]
+        response = client.get("/restaurant/near?lat=45.0&lon=9.0&radius=40")
+        assert [rest["id"] for rest in response.json] == [rest.id for rest in near]
+        response = client.get("/restaurant/near?lat=45.0")
+        assert response.status_code == 400
+
+        for rest in near:
+            del_restaurant_on_db(rest.id)
+        del_user_on_db(owner.id)
+
+    def test_import_restaurants(self):
+        """
+        The restaurants inside a CSV and a JSON Lines file are written in batches
+        with their tables, opening hours and cuisine types, the rows not valid are
+        reported and skipped.
+
+        Test flow
+        - import a CSV with two valid rows and one without position,
+          the valid rows are written with one INSERT
+        - import a JSON Lines file with an owner email, a line not valid
+          and a line that is not an object
+        - check the restaurants and their details
+        - del restaurants
+        """
+        owner = create_user_on_db(787531)
+        assert principal_cache.get(owner.id).restaurant_id is None
+        csv_file = io.StringIO(
+            "name,phone,lat,lon,n_tables,max_seats,open_days,open_lunch,"
+            "close_lunch,open_dinner,close_dinner,cuisine\n"
+            "Imported One,050123456,43.7,10.4,3,4,0;2,12:00,15:00,19:00,22:00,"
+            "Italian food;Other\n"
+            "Imported Two,050123457,43.8,10.5,2,,1,12:00,15:00,19:00,22:00,Other\n"
+            "Imported Bad,050123458,,10.5,2,,1,12:00,15:00,19:00,22:00,Other\n"
+        )
+        inserts = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith("INSERT INTO restaurant "):
+                inserts.append(executemany)
+
+        event.listen(db.engine, "before_cursor_execute", capture)
+        try:
+            imported, errors = RestaurantImport.import_rows(
+                RestaurantImport.read_rows(csv_file, "csv"), owner.id, batch_size=2
+            )
+        finally:
+            event.remove(db.engine, "before_cursor_execute", capture)
+        # the two restaurants of the batch are written with one INSERT
+        assert inserts == [True]
+        assert imported == 2
+        assert errors == [(3, "The field lat is required")]
+
+        json_file = io.StringIO(
+            '{"name": "Imported Three", "phone": "050123459", "lat": 43.9, '
+            '"lon": 10.6, "n_tables": 1, "open_days": [5, 6], "cuisine": ["Other"], '
+            '"open_lunch": "12:00", "close_lunch": "15:00", "open_dinner": "19:00", '
+            '"close_dinner": "22:00", "owner_email": "%s"}\n\n'
+            '{"name": "Imported Broken", \n'
+            '["Imported List"]\n' % owner.email
+        )
+        imported, errors = RestaurantImport.import_rows(
+            RestaurantImport.read_rows(json_file, "json")
+        )
+        assert imported == 1
+        assert [number for number, _ in errors] == [2, 3]
+        assert errors[1] == (3, "The row must be an object")
+
+        restaurants = (
+            db.session.query(Restaurant)
+            .filter_by(owner_id=owner.id)
+            .order_by(Restaurant.id)
+            .all()
+        )
+        assert [restaurant.name for restaurant in restaurants] == [
+            "Imported One",
+            "Imported Two",
+            "Imported Three",
+        ]
+        first = restaurants[0]
+        assert first.geo_cell is not None
+        # the principal of the owner has the first restaurant
+        assert principal_cache.get(owner.id).restaurant_id == first.id
+        tables = db.session.query(RestaurantTable).filter_by(restaurant_id=first.id)
+        assert [table.max_seats for table in tables] == [4, 4, 4]
+        info = RestaurantServices.get_all_restaurants_info(first.id)
+        assert sorted(info.cusine) == ["Italian food", "Other"]
+        assert len(info.opening_hours) == 2
+        assert len(RestaurantServices.get_restaurants_by_keyword("Imported")) == 3
+
+        for restaurant in restaurants:
+            del_restaurant_on_db(restaurant.id)
+        del_user_on_db(owner.id)
+
+    def test_restaurants_page(self, client):
+        """
+        This test unit test the keyset pagination of the restaurants list
+
+        Test flow:
+        - Create three restaurants
+        - Read all the pages with two restaurants for page
+        - Read the home page as stream
+        - erase all data create inside the test
+        """
+        owner = create_user_on_db(randrange(100000))
+        assert owner is not None
+        created = [create_restaurants_on_db("Paged", owner.id).id for _ in range(3)]
+
+        restaurants_id = []
+        restaurants, cursor = RestaurantServices.get_restaurants_page(page_size=2)
+        assert len(restaurants) == 2
+        restaurants_id.extend(rest.id for rest in restaurants)
+        while cursor is not None:
+            restaurants, cursor = RestaurantServices.get_restaurants_page(cursor, 2)
+            assert len(restaurants) <= 2
+            restaurants_id.extend(rest.id for rest in restaurants)
+        assert restaurants_id == sorted(restaurants_id)
+        assert set(created).issubset(restaurants_id)
+        total = db.session.query(Restaurant).count()
+        assert len(restaurants_id) == total
+
+        client.application.config["STREAM_TEMPLATES"] = True
+        response = client.get("/")
+        assert response.is_streamed
+        assert "logged_test" in response.data.decode("utf-8")
+        response = client.get("/?cursor=not-valid")
+        assert response.status_code == 200
+
+        for rest_id in created:
+            del_restaurant_on_db(rest_id)
+        del_user_on_db(owner.id)
+
     def test_delete_dish_menu(self, client):
         """
         check if dish get deletedS
@@ -348,6 +603,103 @@ class Test_RestaurantServices:
         del_restaurant_on_db(restaurant_one.id)
         del_user_on_db(owner_one.id)
 
+    def test_rating_incremental_and_reconcile(self):
+        """
+        This method test that the rating is updated with the new review and
+        that the reconciliation realign the reviews inserted outside the services
+
+        Test flow:
+        - Create owner
+        - Create restaurant1 and binding owner
+        - Make two reviews with the services and check the aggregates
+        - Make a review directly on db
+        - Run the reconciliation and check the rating
+        - Run it again, nothing to update
+        - Drift the stars sum and make a review directly on db, the rating is
+          realigned and the watermark on db is moved on
+        - erase all data create inside the test
+        """
+        owner_one = create_user_on_db(randrange(100000))
+        assert owner_one is not None
+        restaurant_one = create_restaurants_on_db(name="First", user_id=owner_one.id)
+        assert restaurant_one is not None
+
+        RestaurantServices.review_restaurant(restaurant_one.id, owner_one.id, 3, "ok")
+        RestaurantServices.review_restaurant(restaurant_one.id, owner_one.id, 4, "ok")
+        rest = get_rest_with_name(restaurant_one.name)
+        db.session.refresh(rest)
+        assert rest.review_count == 2
+        assert rest.stars_sum == 7.0
+        assert rest.rating == 3.5
+
+        review = create_review_for_restaurants(starts=5.0, rest_id=restaurant_one.id)
+        assert review is not None
+        assert RestaurantServices.calculate_rating_for_all() >= 1
+        rest = get_rest_with_name(restaurant_one.name)
+        db.session.refresh(rest)
+        assert rest.review_count == 3
+        assert rest.rating == 4.0
+        assert RestaurantServices.calculate_rating_for_all() == 0
+
+        rest.stars_sum = 100.0
+        db.session.commit()
+        review = create_review_for_restaurants(starts=1.0, rest_id=restaurant_one.id)
+        assert RestaurantServices.calculate_rating_for_all() == 1
+        db.session.refresh(rest)
+        assert rest.review_count == 4
+        assert rest.stars_sum == 13.0
+        assert rest.rating == 3.25
+        # the watermark is on the database, it survives the restarts
+        watermark = db.session.query(ReconcileWatermark).filter_by(name="rating")
+        assert watermark.one().last_id == review.id
+
+        del_all_review_for_rest(restaurant_one.id)
+        del_restaurant_on_db(restaurant_one.id)
+        del_user_on_db(owner_one.id)
+
+    def test_restaurant_info_cached(self):
+        """
+        This method test the restaurant sheet loader and its cache
+
+        Test flow:
+        - Create owner
+        - Create restaurant1 and binding owner
+        - Load the info of the restaurant
+        - Add a dish and check that the cached info is returned
+        - Invalidate the cache and check the new dish
+        - erase all data create inside the test
+        """
+        owner_one = create_user_on_db(randrange(100000))
+        assert owner_one is not None
+        restaurant_one = create_restaurants_on_db(name="First", user_id=owner_one.id)
+        assert restaurant_one is not None
+
+        model = RestaurantServices.get_all_restaurants_info(restaurant_one.id)
+        assert model.name == restaurant_one.name
+        assert len(model.opening_hours) == 1
+        assert model.cusine == ["Italian food"]
+        assert len(model.dishes) == 0
+
+        dish = MenuDish()
+        dish.name = "Pizza"
+        dish.price = 6.5
+        dish.restaurant_id = restaurant_one.id
+        db.session.add(dish)
+        db.session.commit()
+        model = RestaurantServices.get_all_restaurants_info(str(restaurant_one.id))
+        assert len(model.dishes) == 0
+
+        RestaurantServices.invalidate_restaurant_info(restaurant_one.id)
+        model = RestaurantServices.get_all_restaurants_info(restaurant_one.id)
+        assert len(model.dishes) == 1
+        assert model.dishes[0].name == "Pizza"
+        assert model.dishes[0].price == 6.5
+
+        db.session.query(MenuDish).filter_by(id=dish.id).delete()
+        db.session.commit()
+        del_restaurant_on_db(restaurant_one.id)
+        del_user_on_db(owner_one.id)
+
     def test_get_restaurant_people_none(self):
         """
         The method test the function inside the RestaurantServices to search all the people
@@ -374,6 +726,195 @@ class Test_RestaurantServices:
         del_restaurant_on_db(restaurant_one.id)
         del_user_on_db(owner_one.id)
 
+    def test_get_restaurant_people_windows(self):
+        """
+        The reservations are tagged with the service slot of the windows
+        [open hour, close hour + 1), and the people at lunch and at dinner of today
+        are the same of the old filters with extract on the date of the reservations.
+
+        Test flow
+        - new restaurant open today
+        - bookings inside, on the borders and outside the services
+        - compare the people with the extract filters
+        - del restaurant
+        """
+        owner = create_user_on_db(787501)
+        restaurant = create_restaurants_on_db(name="Windows", user_id=owner.id)
+        customer = create_user_on_db(787502)
+        today = get_today_midnight()
+        db.session.merge(
+            OpeningHours(
+                restaurant_id=restaurant.id,
+                week_day=today.weekday(),
+                open_lunch=time(hour=12),
+                close_lunch=time(hour=15),
+                open_dinner=time(hour=19),
+                close_dinner=time(hour=22),
+            )
+        )
+        db.session.commit()
+        for moment in [
+            today + timedelta(hours=11, minutes=59),
+            today + timedelta(hours=12),
+            today + timedelta(hours=15, minutes=59),
+            today + timedelta(hours=16),
+            today + timedelta(hours=19, minutes=30),
+            today + timedelta(hours=22, minutes=45),
+            today + timedelta(hours=23),
+            today - timedelta(hours=12),
+            today + timedelta(days=1, hours=13),
+        ]:
+            create_random_booking(1, restaurant.id, customer, moment, "a@a.com")
+
+        def old_people(open_hour: int, close_hour: int):
+            return (
+                db.session.query(Reservation)
+                .join(RestaurantTable, RestaurantTable.id == Reservation.table_id)
+                .filter(
+                    RestaurantTable.restaurant_id == restaurant.id,
+                    extract("day", Reservation.reservation_date) == today.day,
+                    extract("month", Reservation.reservation_date) == today.month,
+                    extract("year", Reservation.reservation_date) == today.year,
+                    extract("hour", Reservation.reservation_date) >= open_hour,
+                    extract("hour", Reservation.reservation_date) <= close_hour,
+                )
+                .count()
+            )
+
+        lunch = time_windows.slot_key(restaurant.id, today, time_windows.LUNCH)
+        slots = [
+            reservation.service_slot
+            for reservation in db.session.query(Reservation).filter_by(
+                customer_id=customer.id
+            )
+        ]
+        assert slots.count(lunch) == 2
+        assert slots[0] is None
+
+        all_people = RestaurantServices.get_restaurant_people(restaurant.id)
+        assert all_people[0] == 2
+        assert all_people[1] == 2
+        assert all_people[:2] == [old_people(12, 15), old_people(19, 22)]
+
+        del_user_on_db(customer.id)
+        del_restaurant_on_db(restaurant.id)
+        del_user_on_db(owner.id)
+
+    def test_get_restaurant_people_counters(self):
+        """
+        The people inside the restaurant are cached, and the cache is
+        invalidated by the check-in and by the bookings
+
+        Test flow
+        - new restaurant open all the day
+        - a booking at lunch and a booking now, that is not checked in
+        - the check-in of the booking now
+        - a new booking without event is not counted until the invalidation
+        - del restaurant
+        """
+        owner = create_user_on_db(787561)
+        restaurant = create_restaurants_on_db(name="Counters", user_id=owner.id)
+        customer = create_user_on_db(787562)
+        today = get_today_midnight()
+        # the lunch is [0, 12) and the dinner is [12, 24)
+        db.session.merge(
+            OpeningHours(
+                restaurant_id=restaurant.id,
+                week_day=today.weekday(),
+                open_lunch=time(hour=0),
+                close_lunch=time(hour=11),
+                open_dinner=time(hour=12),
+                close_dinner=time(hour=23),
+            )
+        )
+        db.session.commit()
+        now = datetime.now()
+        start = max(now - timedelta(minutes=10), today)
+        # the other booking is in the other service of the booking now
+        other = today + timedelta(hours=6 if start.hour >= 12 else 18)
+        create_random_booking(1, restaurant.id, customer, other, "a@a.com")
+        reservation = create_random_booking(
+            1, restaurant.id, customer, start, "a@a.com"
+        )[0]
+        reservation.reservation_end = now + timedelta(minutes=20)
+        db.session.commit()
+
+        assert RestaurantServices.get_restaurant_people(restaurant.id) == [1, 1, 0]
+        RestaurantServices.checkin_reservations(reservation.id)
+        assert RestaurantServices.get_restaurant_people(restaurant.id) == [1, 1, 1]
+
+        create_random_booking(1, restaurant.id, customer, other, "a@a.com")
+        assert RestaurantServices.get_restaurant_people(restaurant.id) == [1, 1, 1]
+        RestaurantServices.invalidate_restaurant_people(restaurant.id)
+        people = RestaurantServices.get_restaurant_people(restaurant.id)
+        assert sorted(people[:2]) == [1, 2]
+        assert people[2] == 1
+
+        del_user_on_db(customer.id)
+        del_restaurant_on_db(restaurant.id)
+        del_user_on_db(owner.id)
+
+    def test_get_reservations_page(self):
+        """
+        The reservations of the restaurant are read page by page, the newest first,
+        with the filters applied by the database and only the columns requested
+
+        Test flow
+        - new restaurant with 6 bookings, two in the same moment
+        - read all the pages and the export
+        - filter the days and project the columns
+        - del restaurant
+        """
+        owner = create_user_on_db(787571)
+        restaurant = create_restaurants_on_db(name="Pages", user_id=owner.id)
+        customer = create_user_on_db(787572)
+        dates = [datetime(2020, 10, day, 13) for day in [1, 2, 3, 3, 4, 5]]
+        for date_time in dates:
+            create_random_booking(1, restaurant.id, customer, date_time, "a@a.com")
+
+        seen = []
+        cursor = None
+        while True:
+            page, cursor = RestaurantServices.get_reservations_page(
+                owner.id, restaurant.id, cursor=cursor, page_size=4
+            )
+            seen.extend(page)
+            if cursor is None:
+                break
+        keys = [(row.reservation_date, row.id) for row in seen]
+        assert keys == sorted(keys, reverse=True)
+        assert len(set(keys)) == 6
+        assert seen[0].email == customer.email
+        exported = RestaurantServices.export_reservations(
+            owner.id, restaurant.id, batch_size=2
+        )
+        assert [row.id for row in exported] == [row.id for row in seen]
+
+        page, cursor = RestaurantServices.get_reservations_page(
+            owner.id,
+            restaurant.id,
+            "2020-10-02",
+            "2020-10-03",
+            customer.email,
+            columns=["email"],
+        )
+        assert cursor is None
+        assert len(page) == 3
+        assert set(page[0].keys()) == {"id", "reservation_date", "email"}
+        # only the owner can read the reservations
+        page, _ = RestaurantServices.get_reservations_page(customer.id, restaurant.id)
+        assert page == []
+        with pytest.raises(ValueError):
+            RestaurantServices.export_reservations(
+                owner.id, restaurant.id, columns=["password"]
+            )
+        with pytest.raises(ValueError):
+            RestaurantServices.get_reservations_page(owner.id, restaurant.id, "soon")
+
+        del_user_on_db(customer.id)
+        del_restaurant_on_db(restaurant.id)
+        del_user_on_db(owner.id)
+
 
 """
           The method test the function inside the RestaurantServices to search all the people
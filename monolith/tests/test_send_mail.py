@@ -0,0 +1,114 @@
+import socket
+
+import pytest
+from aiosmtpd.controller import Controller
+from aiosmtpd.handlers import Message as MessageHandler
+
+from monolith.utils import send_mail
+from monolith.utils.send_mail import (
+    SMTPConnectionPool,
+    compose_email,
+    send_booking_confirmation_to_friends,
+)
+
+
+class _Inbox(MessageHandler):
+    """
+    SMTP stand-in that store the received messages and count the sessions
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+        self.sessions = set()
+
+    def handle_message(self, message):
+        self.messages.append(message)
+
+    async def handle_DATA(self, server, session, envelope):
+        self.sessions.add(id(session))
+        return await super().handle_DATA(server, session, envelope)
+
+
+def _free_port() -> int:
+    """
+    Ask to the OS a free port of the loopback
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def smtp_server():
+    """
+    Start a local SMTP server and configure the flask mail to use it
+    """
+    inbox = _Inbox()
+    port = _free_port()
+    controller = Controller(inbox, hostname="127.0.0.1", port=port)
+    controller.start()
+    old_config = dict(send_mail.app.config)
+    send_mail.app.config["MAIL_SERVER"] = "127.0.0.1"
+    send_mail.app.config["MAIL_PORT"] = port
+    send_mail.app.config["MAIL_USE_SSL"] = False
+    send_mail.app.config["MAIL_USE_TLS"] = False
+    send_mail.app.config["MAIL_USERNAME"] = None
+    send_mail.mail.init_app(send_mail.app)
+    yield inbox
+    send_mail.smtp_pool.close()
+    controller.stop()
+    send_mail.app.config.update(old_config)
+    send_mail.mail.init_app(send_mail.app)
+
+
+class Test_SendMail:
+    """
+    This test suite test the bulk send of emails with the pooled SMTP connection.
+    All the code tested inside this class is inside the utils/send_mail.py
+    """
+
+    def test_bulk_send_one_connection(self, smtp_server):
+        """
+        A batch of emails is sent with only one SMTP session,
+        all the messages are delivered in order over that connection.
+        """
+        inbox = smtp_server
+        recipients = ["user{}@gooutsafe.com".format(i) for i in range(200)]
+        messages = [compose_email("Test", "Hi", recipient) for recipient in recipients]
+        sent = send_mail.send_emails(messages)
+
+        assert sent == 200
+        assert [message["To"] for message in inbox.messages] == recipients
+        assert len(inbox.sessions) == 1
+
+    def test_booking_confirmation_to_friends(self, smtp_server):
+        """
+        The owner of the reservation and all the friends receive the confirmation
+        """
+        inbox = smtp_server
+        send_booking_confirmation_to_friends(
+            "john.doe@email.com",
+            "John",
+            "Trial Restaurant",
+            ["a@a.com", "b@b.com"],
+            "2120-11-25 13:00",
+        )
+        recipients = [message["To"] for message in inbox.messages]
+        assert recipients == ["john.doe@email.com", "a@a.com", "b@b.com"]
+
+    def test_reconnect_after_connection_lost(self, smtp_server):
+        """
+        If the connection with the server is lost the pool reconnect and send the email
+        """
+        inbox = smtp_server
+        pool = SMTPConnectionPool(send_mail.mail, backoff=0.01)
+        pool.send([compose_email("Test", "Hi", "first@gooutsafe.com")])
+
+        # the connection is dropped, e.g. for a timeout of the server
+        pool._connection.host.sock.close()
+        pool.send([compose_email("Test", "Hi", "second@gooutsafe.com")])
+        pool.close()
+
+        recipients = [message["To"] for message in inbox.messages]
+        assert recipients == ["first@gooutsafe.com", "second@gooutsafe.com"]
@@ -1,10 +1,25 @@
 import os
+from datetime import datetime, timedelta
 
 import pytest
+from flask import session
+from sqlalchemy import event
+from werkzeug.exceptions import Unauthorized
 from monolith.database import db, User, Reservation
 from monolith.forms import UserForm
 from monolith.services.user_service import UserService
-from monolith.tests.utils import get_user_with_email, login
+from monolith.auth import roles_allowed
+from monolith.principals import principal_cache
+from monolith.roles import role_registry
+from monolith.tests.utils import (
+    get_user_with_email,
+    login,
+    create_user_on_db,
+    create_restaurants_on_db,
+    create_random_booking,
+    del_restaurant_on_db,
+    del_user_on_db,
+)
 
 
 class Test_UserServices:
@@ -153,3 +168,104 @@ class Test_UserServices:
         reservations_as_list = UserService.get_customer_reservation(None, None, user.id)
 
         assert len(raw_list) == len(reservations_as_list)
+
+    def test_principal_cache(self, client):
+        """
+        Test the principal of the logged user: it is loaded once with the role
+        and the restaurant, and it is removed after the changes of the user
+        """
+        owner = create_user_on_db(787541)
+        restaurant = create_restaurants_on_db("Pepperwood Principal", user_id=owner.id)
+        principal = principal_cache.get(owner.id)
+        assert principal.email == owner.email
+        assert principal.role == "CUSTOMER"
+        assert principal.restaurant_id == restaurant.id
+        assert principal.restaurant_name == "Pepperwood Principal"
+
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", capture)
+        try:
+            assert principal_cache.get(owner.id) is principal
+        finally:
+            event.remove(db.engine, "before_cursor_execute", capture)
+        assert statements == []
+
+        response = login(client, owner.email, "Alibaba787541")
+        assert response.status_code == 200
+        form = UserForm(obj=owner)
+        UserService.modify_user(form, 2)
+        assert principal_cache.get(owner.id).role == "OPERATOR"
+
+        del_restaurant_on_db(restaurant.id)
+        UserService.delete_user(email=owner.email)
+        assert principal_cache.get(owner.id) is None
+
+    def test_role_registry(self, client):
+        """
+        Test the roles read once from the database, and the check of the
+        roles of the views
+        """
+        role = UserService.get_user_role(2)
+        assert role.value == "OPERATOR"
+        assert role_registry.by_value("CUSTOMER").id == 3
+        assert role_registry.value_of(42) is None
+
+        view = roles_allowed(roles=["OPERATOR", "HEALTH"])(lambda: "allowed")
+        with client.application.test_request_context():
+            session["ROLE"] = "HEALTH"
+            assert view() == "allowed"
+            session["ROLE"] = "CUSTOMER"
+            with pytest.raises(Unauthorized):
+                view()
+        with pytest.raises(ValueError):
+            roles_allowed(roles=["OPERATORS"])(lambda: "allowed")
+
+    def test_customer_reservations_page(self, client):
+        """
+        Test the history of the customer: the days are filtered by the database,
+        the upcoming reservations start from the next one and the past ones
+        from the last one, page by page
+        """
+        customer = create_user_on_db(787581)
+        restaurant = create_restaurants_on_db("History", user_id=customer.id)
+        now = datetime.now().replace(microsecond=0)
+        past = [now - timedelta(days=days) for days in [1, 2, 30]]
+        upcoming = [now + timedelta(days=days) for days in [1, 1, 5]]
+        for date_time in past + upcoming:
+            create_random_booking(1, restaurant.id, customer, date_time, "a@a.com")
+
+        page, cursor = UserService.get_customer_reservations_page(
+            customer.id, page_size=2
+        )
+        assert [row.reservation_date for row in page] == upcoming[:2]
+        assert page[0].id < page[1].id
+        assert page[0].name == "History"
+        page, cursor = UserService.get_customer_reservations_page(
+            customer.id, cursor=cursor, page_size=2
+        )
+        assert [row.reservation_date for row in page] == upcoming[2:]
+        assert cursor is None
+
+        page, cursor = UserService.get_customer_reservations_page(
+            customer.id, upcoming=False
+        )
+        assert [row.reservation_date for row in page] == past
+        assert cursor is None
+
+        # the days are inclusive
+        day = (now - timedelta(days=2)).date().isoformat()
+        page, _ = UserService.get_customer_reservations_page(
+            customer.id, upcoming=False, from_date=day, to_date=day
+        )
+        assert [row.reservation_date for row in page] == past[1:2]
+        reservations = UserService.get_customer_reservation(day, None, customer.id)
+        assert len(reservations) == 5
+        with pytest.raises(ValueError):
+            UserService.get_customer_reservation("tomorrow", None, customer.id)
+
+        del_restaurant_on_db(restaurant.id)
+        del_user_on_db(customer.id)
@@ -9,8 +9,10 @@ from monolith.forms import (
     DishForm,
     ReservationForm,
     PhotoGalleryForm,
+    UserForm,
 )
 from monolith.services import *
+from monolith import time_windows
 
 
 def login(client, username, password):
@@ -546,6 +548,14 @@ def create_random_booking(num: int, rest_id: int, user: User, date_time, friends
         new_reservation.reservation_end = date_time + timedelta(hours=i)
         new_reservation.customer_id = user.id
         new_reservation.table_id = table.id
+        opening = (
+            db.session.query(OpeningHours)
+            .filter_by(restaurant_id=rest_id, week_day=date_time.weekday())
+            .first()
+        )
+        new_reservation.service_slot = time_windows.service_slot(
+            rest_id, opening, date_time
+        )
         friends = friends.split(";")
         new_reservation.people_number = len(friends) + 1
         db.session.add(new_reservation)
@@ -0,0 +1,166 @@
+"""
+Time windows of the services of the restaurants.
+
+The reservations of a day, or of a service (lunch or dinner) of a day, are
+selected with a half-open range [start, end) on Reservation.reservation_date,
+so the database can use the indexes on the date, instead of extracting the
+day, the month, the year and the hour of each row.
+The reservations are also tagged with the service slot where they are, so the
+reservations of the same service are found with an equality on the slot.
+"""
+from datetime import date, datetime, time, timedelta
+
+from sqlalchemy import and_
+
+## the services of a day
+LUNCH = "lunch"
+DINNER = "dinner"
+
+
+def midnight(day) -> datetime:
+    """
+    Return the first instant of the day
+    :param day: a date or a datetime
+    """
+    if isinstance(day, datetime):
+        day = day.date()
+    return datetime.combine(day, time.min)
+
+
+def day_window(day):
+    """
+    Return the window with all the day
+    :param day: a date or a datetime
+    :return: (start, end)
+    """
+    start = midnight(day)
+    return start, start + timedelta(days=1)
+
+
+def hours_window(day, open_time: time, close_time: time):
+    """
+    Return the window with all the hours of a service of the day, from the hour
+    of open to the end of the hour of close, so [open hour, close hour + 1)
+    :param day: a date or a datetime
+    :param open_time: the open time of the service
+    :param close_time: the close time of the service
+    :return: (start, end)
+    """
+    start = midnight(day)
+    return (
+        start + timedelta(hours=open_time.hour),
+        start + timedelta(hours=close_time.hour + 1),
+    )
+
+
+def lunch_window(opening, day):
+    """
+    Return the window of the lunch of the day
+    :param opening: the OpeningHours of the restaurant in the week day of the day
+    :param day: a date or a datetime
+    :return: (start, end)
+    """
+    return hours_window(day, opening.open_lunch, opening.close_lunch)
+
+
+def dinner_window(opening, day):
+    """
+    Return the window of the dinner of the day
+    :param opening: the OpeningHours of the restaurant in the week day of the day
+    :param day: a date or a datetime
+    :return: (start, end)
+    """
+    return hours_window(day, opening.open_dinner, opening.close_dinner)
+
+
+def service_window(opening, moment: datetime):
+    """
+    Return the window of the service (lunch or dinner) of the moment,
+    it is the dinner if the moment is after the open of the dinner.
+    :param opening: the OpeningHours of the restaurant in the week day of the moment
+    :param moment: the datetime, e.g. the date of a reservation
+    :return: (start, end)
+    """
+    if opening.open_dinner <= moment.time():
+        return dinner_window(opening, moment)
+    return lunch_window(opening, moment)
+
+
+def inside(column, window):
+    """
+    Return the condition start <= column < end
+    :param column: a datetime column, e.g. Reservation.reservation_date
+    :param window: (start, end)
+    """
+    start, end = window
+    return and_(column >= start, column < end)
+
+
+def days_filter(column, from_day=None, to_day=None):
+    """
+    Return the conditions from_day <= column < to_day + 1 day, e.g. for the
+    filters of the pages, without a day that side of the range is open
+    :param column: a datetime column, e.g. Reservation.reservation_date
+    :param from_day: the first day, a date or an iso string e.g. "2020-10-07", or None
+    :param to_day: the last day, a date or an iso string, or None
+    :return: list of conditions, empty without days
+    :raise ValueError: if a day is not a valid iso date
+    """
+    conditions = []
+    if from_day:
+        if isinstance(from_day, str):
+            from_day = date.fromisoformat(from_day)
+        conditions.append(column >= midnight(from_day))
+    if to_day:
+        if isinstance(to_day, str):
+            to_day = date.fromisoformat(to_day)
+        conditions.append(column < day_window(to_day)[1])
+    return conditions
+
+
+def service_of(opening, moment: datetime):
+    """
+    Return the service (LUNCH or DINNER) that contains the moment
+    :param opening: the OpeningHours of the restaurant in the week day of the moment
+    :param moment: the datetime, e.g. the date of a reservation
+    :return: LUNCH, DINNER or None if the moment is outside the services
+    """
+    if opening is None:
+        return None
+    services = [
+        (DINNER, opening.open_dinner, opening.close_dinner),
+        (LUNCH, opening.open_lunch, opening.close_lunch),
+    ]
+    for service, open_time, close_time in services:
+        if open_time is None or close_time is None:
+            continue
+        start, end = hours_window(moment, open_time, close_time)
+        if start <= moment < end:
+            return service
+    return None
+
+
+def slot_key(restaurant_id: int, day, service: str) -> str:
+    """
+    Return the key of the service of the restaurant in the day,
+    e.g. "12:2020-11-05:dinner"
+    :param restaurant_id: the restaurant id
+    :param day: a date or a datetime
+    :param service: LUNCH or DINNER
+    """
+    return "{}:{}:{}".format(restaurant_id, midnight(day).date().isoformat(), service)
+
+
+def service_slot(restaurant_id: int, opening, moment: datetime):
+    """
+    Return the key of the service slot of a reservation, stored inside
+    Reservation.service_slot when the reservation is written
+    :param restaurant_id: the restaurant id
+    :param opening: the OpeningHours of the restaurant in the week day of the moment
+    :param moment: the date of the reservation
+    :return: the key or None if the moment is outside the services
+    """
+    service = service_of(opening, moment)
+    if service is None:
+        return None
+    return slot_key(restaurant_id, moment, service)
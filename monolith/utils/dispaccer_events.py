@@ -1,41 +1,338 @@
+import json
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from celery import group
+from celery.result import GroupResult
+from flask import current_app, has_app_context
+
 from monolith.background import *
 from monolith.app_constant import *
 
 _CELERY = False
 
+## backend used when the app doesn't configure one, see DispatcherMessage.configure
+## "celery", "thread" or "sync", it can be changed with GOOUTSAFE_DISPATCHER
+DEFAULT_BACKEND = "celery" if _CELERY else "thread"
+## threads that send the emails inside the app, with the thread backend
+THREAD_WORKERS = 2
+## jobs of the local backends kept for the polling, the oldest are dropped
+MAX_LOCAL_JOBS = 1024
 
-class DispatcherMessage:
+logger = logging.getLogger(__name__)
+
+
+def _calculate_rating():
+    RestaurantServices.calculate_rating_for_all()
+
+
+## message type -> (function that runs the message inside the process, celery task)
+_HANDLERS = {
+    REGISTRATION_EMAIL: (send_registration_confirm, send_email_to_confirm_registration),
+    NEW_COVID_TO_RESTAURANT_BOOKING: (
+        send_positive_booking_in_restaurant,
+        send_alert_new_covid19_about_previous_booking,
+    ),
+    NEW_POSITIVE_WAS_IN_RESTAURANT: (
+        send_positive_in_restaurant,
+        send_positive_in_restaurant_celery,
+    ),
+    EMAIL_TO_FRIEND: (
+        send_possible_positive_contact_to_friend,
+        send_possible_positive_contact_to_friend_celery,
+    ),
+    NEW_POSITIVE_CONTACT: (
+        send_possible_positive_contact,
+        send_possible_positive_contact_celery,
+    ),
+    CONFIRMATION_BOOKING: (
+        send_booking_confirmation_to_friends,
+        send_booking_confirmation_to_friends_celery,
+    ),
+    CALCULATE_RATING_RESTAURANTS: (_calculate_rating, calculate_rating_for_all_celery),
+}
+
+
+def _as_message(params):
+    """
+    Return the params as celery receives them, e.g. the dates in iso format,
+    so a message runs in the same way with all the backends
+    """
+    return json.loads(json.dumps(params, default=lambda value: value.isoformat()))
+
+
+class LocalJobs:
+    """
+    The jobs of the batches sent by the sync and the thread backends, with the
+    batches completed and failed, so the status of the notifications is polled
+    as the group of tasks of celery.
+    The jobs live inside the process, as the threads that run them.
+    """
+
+    def __init__(self, max_jobs: int = MAX_LOCAL_JOBS) -> None:
+        self.max_jobs = max_jobs
+        self._lock = threading.Lock()
+        ## job id -> [batches, batches completed, batches failed]
+        self._jobs = OrderedDict()
+
+    def create(self, tasks: int) -> str:
+        """
+        Register a new job
+        :param tasks: the number of batches of the job
+        :return: the job id
+        """
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._jobs[job_id] = [tasks, 0, 0]
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+        return job_id
+
+    def finish(self, job_id: str, failed: bool = False):
+        """
+        Register the end of a batch of the job
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job[2 if failed else 1] += 1
+
+    def status(self, job_id: str):
+        """
+        :return: the status of the job as DispatcherMessage.job_status,
+        None if the job doesn't exist
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            tasks, completed, failed = job
+        return {
+            "job_id": job_id,
+            "tasks": tasks,
+            "completed": completed,
+            "failed": failed > 0,
+            "ready": completed + failed == tasks,
+        }
+
+
+local_jobs = LocalJobs()
+
+
+def _run_batch(job_id: str, type_message: str, batch_params):
+    """
+    Run the handler of the messages of a batch of a local job, as the batch
+    task of celery the batch fails at the first message that fails
+    """
+    handler = _HANDLERS[type_message][0]
+    try:
+        for params in batch_params:
+            handler(*params)
+    except Exception as error:
+        logger.error("Dispatcher: batch of %s failed %s", type_message, error)
+        local_jobs.finish(job_id, failed=True)
+        return
+    local_jobs.finish(job_id)
+
+
+class CeleryBackend:
+    """
+    Send the messages to the celery workers with redis
+    """
+
+    name = "celery"
+    ## the broker keeps the messages once they are sent
+    durable = True
+
+    def send(self, type_message: str, params):
+        _HANDLERS[type_message][1].apply_async(args=params)
+
+    def send_batches(self, batches):
+        job = group(
+            send_notification_batch_celery.s(type_message, params)
+            for type_message, params in batches
+        ).apply_async()
+        job.save()
+        return job.id
+
+
+class SyncBackend:
     """
-    This class using a mediator patter to decide if the status of app admit
-    the celery message.
-    The celery message are available for the moment only in release and in some debug cases
-    otherwise it is disabled.
+    Run the messages inside the request, e.g. for the tests
+    """
+
+    name = "sync"
+    durable = False
+
+    def send(self, type_message: str, params):
+        _HANDLERS[type_message][0](*_as_message(params))
+
+    def send_batches(self, batches):
+        job_id = local_jobs.create(len(batches))
+        for type_message, batch_params in batches:
+            _run_batch(job_id, type_message, _as_message(batch_params))
+        return job_id
+
+
+class ThreadPoolBackend:
+    """
+    Run the messages inside a pool of threads of the app, so a single node
+    sends the emails outside the requests without redis.
+    The messages in the queue are lost if the process stops.
+    """
+
+    name = "thread"
+    ## the queue of the threads is lost if the process stops
+    durable = False
+
+    def __init__(self, max_workers: int = THREAD_WORKERS) -> None:
+        self.max_workers = max_workers
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def send(self, type_message: str, params):
+        handler = _HANDLERS[type_message][0]
+        # e.g. the rating calculation needs the app to access to the database
+        app = current_app._get_current_object() if has_app_context() else None
+        self._get_executor().submit(self._run, app, handler, _as_message(params))
+
+    def send_batches(self, batches):
+        job_id = local_jobs.create(len(batches))
+        app = current_app._get_current_object() if has_app_context() else None
+        for type_message, batch_params in batches:
+            self._get_executor().submit(
+                self._run,
+                app,
+                _run_batch,
+                [job_id, type_message, _as_message(batch_params)],
+            )
+        return job_id
+
+    def shutdown(self, wait: bool = True):
+        """
+        Wait the messages in the queue and stop the threads
+        """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            # a forked worker can't use the threads of the parent process
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="dispatcher"
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    @staticmethod
+    def _run(app, handler, params):
+        try:
+            if app is None:
+                handler(*params)
+            else:
+                with app.app_context():
+                    handler(*params)
+        except Exception as error:
+            logger.error("Dispatcher: %s failed %s", handler.__name__, error)
+
+
+## name of the backend -> class
+BACKENDS = {
+    CeleryBackend.name: CeleryBackend,
+    SyncBackend.name: SyncBackend,
+    ThreadPoolBackend.name: ThreadPoolBackend,
+}
 
-    For instance, for the testing it is disabled.
+
+class DispatcherMessage:
+    """
+    This class using a mediator patter to decide how the messages are dispatched,
+    each message type has a handler inside _HANDLERS and the backend decides
+    where the handler runs:
+    - celery: inside the celery workers (the release)
+    - thread: inside a pool of threads of the app, a single node without redis
+    - sync: inside the request (the tests)
 
     @author Vincenzo Palazzo v.palazzo1@studenti.unipi.it
     """
 
+    ## the backend in use
+    backend = BACKENDS[os.environ.get("GOOUTSAFE_DISPATCHER", DEFAULT_BACKEND)]()
+
+    @staticmethod
+    def configure(name: str = None):
+        """
+        Change the backend of the messages
+        :param name: "celery", "thread" or "sync", without name the
+        backend is read from GOOUTSAFE_DISPATCHER
+        :raise ValueError: if the backend doesn't exist
+        """
+        if name is None:
+            name = os.environ.get("GOOUTSAFE_DISPATCHER", DEFAULT_BACKEND)
+        if name not in BACKENDS:
+            raise ValueError("Dispatcher backend {} not supported".format(name))
+        if DispatcherMessage.backend.name != name:
+            DispatcherMessage.backend = BACKENDS[name]()
+
     @staticmethod
     def send_message(type_message: str, params):
         """
         This static method take and string that usually is defined inside the
-        file app_constant.py and check if there is condition to dispatc the test
+        file app_constant.py and dispatch the message with the backend
+        :raise KeyError: if the message type doesn't exist
         :return: nothings
         """
-        if _CELERY is False:
-            if type_message == CALCULATE_RATING_RESTAURANTS:
-                RestaurantServices.calculate_rating_for_all()
-            return
-        if type_message == REGISTRATION_EMAIL:
-            send_email_to_confirm_registration.apply_async(args=params)
-        elif type_message == NEW_COVID_TO_RESTAURANT_BOOKING:
-            send_alert_new_covid19_about_previous_booking.apply_async(args=params)
-        elif type_message == NEW_POSITIVE_WAS_IN_RESTAURANT:
-            send_positive_in_restaurant.apply_async(args=params)
-        elif type_message == EMAIL_TO_FRIEND:
-            send_possible_positive_contact_to_friend.apply_async(args=params)
-        elif type_message == NEW_POSITIVE_CONTACT:
-            send_possible_positive_contact_celery.apply_async(args=params)
-        elif type_message == CONFIRMATION_BOOKING:
-            send_booking_confirmation_to_friends_celery.apply_async(args=params)
+        DispatcherMessage.backend.send(type_message, params)
+
+    @staticmethod
+    def deliver(type_message: str, params):
+        """
+        This static method runs the handler of the message inside the current
+        thread, without the backend, so the caller knows if the message is sent,
+        e.g. the relay of the outbox when the backend is not durable
+        :raise KeyError: if the message type doesn't exist
+        :raise Exception: the error of the handler, e.g. the SMTP server is down
+        """
+        _HANDLERS[type_message][0](*_as_message(params))
+
+    @staticmethod
+    def send_batches(batches):
+        """
+        This static method dispatch the batches of messages, with celery
+        each batch is a task and all the tasks are inside a group that is
+        used as job to poll the status, with the other backends the job is
+        kept inside the process, see LocalJobs.
+        :param batches: list of (type_message, list of params)
+        :return: the job id or None if there is nothing to send
+        """
+        if len(batches) == 0:
+            return None
+        return DispatcherMessage.backend.send_batches(batches)
+
+    @staticmethod
+    def job_status(job_id: str):
+        """
+        This static method return the status of a job created with send_batches
+        :param job_id: the job id
+        :return: a dictionary with the status, None if the job doesn't exist
+        """
+        if DispatcherMessage.backend.name != CeleryBackend.name:
+            return local_jobs.status(job_id)
+        job = GroupResult.restore(job_id, app=celery)
+        if job is None:
+            return None
+        return {
+            "job_id": job_id,
+            "tasks": len(job.results),
+            "completed": job.completed_count(),
+            "failed": job.failed(),
+            "ready": job.ready(),
+        }
@@ -2,5 +2,9 @@ from datetime import datetime
 
 
 def my_date_formatter(text):
-    date_dt2 = datetime.strptime(text, "%Y-%m-%d %H:%M:%S.%f")
+    # the raw queries return the dates as text, the ORM as datetime
+    if isinstance(text, datetime):
+        date_dt2 = text
+    else:
+        date_dt2 = datetime.strptime(text, "%Y-%m-%d %H:%M:%S.%f")
     return date_dt2.strftime("%d/%m/%Y %H:%M:%S")
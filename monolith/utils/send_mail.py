@@ -1,6 +1,9 @@
 from flask import Flask
 from flask_mail import Mail, Message
 import os
+import smtplib
+import threading
+import time
 
 # Methods and configuration for send email
 app = Flask(__name__)
@@ -15,6 +18,97 @@ app.config["MAIL_USE_TLS"] = app.config.get("MAIL_USE_TLS")
 app.config["MAIL_USE_SSL"] = app.config.get("MAIL_USE_SSL")
 mail = Mail(app)
 
+## errors of the connection with the SMTP server, where we can reconnect and retry
+_RECONNECT_ERRORS = (
+    smtplib.SMTPServerDisconnected,
+    smtplib.SMTPConnectError,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+class SMTPConnectionPool:
+    """
+    This class keep one long lived SMTP connection for each process (e.g. a celery worker),
+    so a batch of emails is sent with the same connection instead of opening a new
+    connection for each email.
+    If the server close the connection we reconnect with an exponential backoff.
+    """
+
+    def __init__(self, mail_ext: Mail, max_retries: int = 3, backoff: float = 0.5):
+        """
+        :param mail_ext: the flask mail extension used to open the connection
+        :param max_retries: how many times we try to send an email
+        :param backoff: seconds to wait before the first retry, doubled at each retry
+        """
+        self.mail = mail_ext
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._connection = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def send(self, messages: []) -> int:
+        """
+        Send all the messages with the pooled connection
+        :param messages: list of flask mail Message
+        :return: the number of emails sent
+        """
+        with self._lock:
+            with app.app_context():
+                for message in messages:
+                    self._send_with_retry(message)
+        return len(messages)
+
+    def close(self):
+        """
+        Close the connection with the SMTP server, if it is open
+        """
+        with self._lock:
+            self._close()
+
+    def _send_with_retry(self, message: Message):
+        for attempt in range(self.max_retries):
+            try:
+                self._get_connection().send(message)
+                return
+            except _RECONNECT_ERRORS:
+                self._close()
+                if attempt + 1 == self.max_retries:
+                    raise
+                time.sleep(self.backoff * (2 ** attempt))
+
+    def _get_connection(self):
+        # a forked worker can't use the connection of the parent process
+        if self._pid != os.getpid():
+            self._connection = None
+            self._pid = os.getpid()
+        if self._connection is None:
+            connection = self.mail.connect()
+            self._connection = connection.__enter__()
+        return self._connection
+
+    def _close(self):
+        if self._connection is None:
+            return
+        try:
+            self._connection.__exit__(None, None, None)
+        except (smtplib.SMTPException, OSError):
+            pass
+        self._connection = None
+
+
+smtp_pool = SMTPConnectionPool(mail)
+
+
+def suppress_emails(suppress: bool = True):
+    """
+    Compose the emails without sending them, e.g. inside the tests
+    """
+    app.extensions["mail"].suppress = suppress
+    # the open connection is made with the old setting
+    smtp_pool.close()
+
 
 def send_possible_positive_contact(
     to_email, to_name, date_possible_contact, restaurant_name
@@ -104,19 +198,33 @@ def send_registration_confirm(to_email, to_name, token):
     send_email(subject, body, to_email)
 
 
-def send_email(subject, body, recipient):
+def compose_email(subject, body, recipient) -> Message:
     """
-    Internal method for send email
+    Internal method to build the email message
     """
     subject = "[GoOutSafe] " + subject
-    msg = Message(
+    return Message(
         recipients=[recipient],
         sender="greyteam2020@gmail.com",
         html=body,
         subject=subject,
     )
-    with app.app_context():
-        mail.send(msg)
+
+
+def send_email(subject, body, recipient):
+    """
+    Internal method for send email
+    """
+    send_emails([compose_email(subject, body, recipient)])
+
+
+def send_emails(messages: []) -> int:
+    """
+    Internal method for send a batch of emails with the same SMTP connection
+    :param messages: list of messages created with compose_email
+    :return: the number of emails sent
+    """
+    return smtp_pool.send(messages)
 
 
 def send_positive_booking_in_restaurant(to_email, to_name, email_user, restaurant_name):
@@ -170,12 +278,12 @@ def send_positive_in_restaurant(
     send_email(subject, body, to_email)
 
 
-def _send_booking_confirmation_to_owner_table(
+def _compose_booking_confirmation_to_owner_table(
     to_email: str, to_name: str, to_restaurants: str, date_time
-):
+) -> Message:
     """
     TODO add the position on the map
-    This method send the confirmation email to the owner of reservation
+    This method compose the confirmation email to the owner of reservation
     :param to_email: The owner email
     :param to_name: The name of owner
     :param to_restaurants: Tha name of restaurant
@@ -192,15 +300,15 @@ def _send_booking_confirmation_to_owner_table(
     body = body.replace("{toName}", to_name)
     body = body.replace("{toRestaurants}", to_restaurants)
     body = body.replace("{toDate}", str(date_time))
-    send_email(subject, body, to_email)
+    return compose_email(subject, body, to_email)
 
 
-def _send_booking_confirmation_to_friend(
+def _compose_booking_confirmation_to_friend(
     to_friend: str, to_name: str, to_restaurants: str, date_time
-):
+) -> Message:
     """
     TODO add the position on the map
-    This method send the confirmation email to a email friend with the name of the
+    This method compose the confirmation email to a email friend with the name of the
     :param to_friend:
     :param to_name:
     :param date_time:
@@ -218,7 +326,7 @@ def _send_booking_confirmation_to_friend(
     body = body.replace("{toName}", to_name)
     body = body.replace("{toRestaurants}", to_restaurants)
     body = body.replace("{toDate}", str(date_time))
-    send_email(subject, body, to_friend)
+    return compose_email(subject, body, to_friend)
 
 
 def send_booking_confirmation_to_friends(
@@ -232,16 +340,21 @@ def send_booking_confirmation_to_friends(
     :param to_friend_list:
     :param date_time:
     """
-    _send_booking_confirmation_to_owner_table(
-        to_email=to_email,
-        to_name=to_name,
-        to_restaurants=to_restaurants,
-        date_time=date_time,
-    )
-    for friend in to_friend_list:
-        _send_booking_confirmation_to_friend(
+    messages = [
+        _compose_booking_confirmation_to_owner_table(
+            to_email=to_email,
             to_name=to_name,
-            to_friend=friend,
             to_restaurants=to_restaurants,
             date_time=date_time,
         )
+    ]
+    for friend in to_friend_list:
+        messages.append(
+            _compose_booking_confirmation_to_friend(
+                to_name=to_name,
+                to_friend=friend,
+                to_restaurants=to_restaurants,
+                date_time=date_time,
+            )
+        )
+    send_emails(messages)
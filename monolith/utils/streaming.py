@@ -0,0 +1,102 @@
+import csv
+import io
+import json
+
+from flask import Response, current_app, render_template, stream_with_context
+
+## rows written inside a chunk of the streamed exports
+EXPORT_CHUNK_ROWS = 500
+
+
+def render_template_streamed(template_name: str, **context):
+    """
+    Render the template as a stream, so the first part of the page is sent
+    to the client before the template is rendered completely.
+    :param template_name: the name of the template
+    :param context: the variables of the template
+    :return: the flask Response
+    """
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    return Response(stream_with_context(template.generate(context)))
+
+
+def render_page(template_name: str, **context):
+    """
+    Render the template as stream if STREAM_TEMPLATES is True inside the app config,
+    otherwise with the flask render_template.
+    """
+    if current_app.config.get("STREAM_TEMPLATES", False):
+        return render_template_streamed(template_name, **context)
+    return render_template(template_name, **context)
+
+
+def _export_value(value):
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return value
+
+
+def stream_csv(columns, rows):
+    """
+    Return the rows as a CSV stream, with the columns as header
+    :param columns: the names of the columns, each row has them as attributes
+    :param rows: iterable of rows, e.g. a generator that reads the database
+    :return: generator of chunks of text
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for number, row in enumerate(rows, start=1):
+        writer.writerow([_export_value(getattr(row, name)) for name in columns])
+        if number % EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue()
+
+
+def stream_json(columns, rows):
+    """
+    Return the rows as a stream of a JSON list of objects
+    :param columns: the names of the columns, each row has them as attributes
+    :param rows: iterable of rows, e.g. a generator that reads the database
+    :return: generator of chunks of text
+    """
+    chunk = ["["]
+    for number, row in enumerate(rows):
+        values = {name: _export_value(getattr(row, name)) for name in columns}
+        chunk.append(("," if number > 0 else "") + json.dumps(values))
+        if len(chunk) >= EXPORT_CHUNK_ROWS:
+            yield "".join(chunk)
+            chunk = []
+    chunk.append("]")
+    yield "".join(chunk)
+
+
+def export_response(columns, rows, file_format: str, filename: str):
+    """
+    Return the response that streams the rows as a file to download
+    :param columns: the names of the columns
+    :param rows: iterable of rows
+    :param file_format: "csv" or "json"
+    :param filename: the name of the file without extension
+    :return: the flask Response
+    :raise ValueError: if the format is not supported
+    """
+    if file_format == "csv":
+        chunks, mimetype = stream_csv(columns, rows), "text/csv"
+    elif file_format == "json":
+        chunks, mimetype = stream_json(columns, rows), "application/json"
+    else:
+        raise ValueError("Format {} not supported".format(file_format))
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetype,
+        headers={
+            "Content-Disposition": "attachment; filename={}.{}".format(
+                filename, file_format
+            )
+        },
+    )
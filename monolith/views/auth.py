@@ -1,7 +1,8 @@
 from flask import Blueprint, render_template, redirect, session
 from flask_login import login_user, logout_user
 
-from monolith.database import db, User, Role, Restaurant
+from monolith.database import db, User
+from monolith.principals import principal_cache
 from monolith.forms import LoginForm
 
 auth = Blueprint("auth", __name__)
@@ -16,19 +17,14 @@ def login():
         user = q.first()
         if user is not None and user.authenticate(password):
             login_user(user)
-            q = db.session.query(Role).filter(Role.id == user.role_id)
-            role = q.first()
-            if role is not None:
-                session["ROLE"] = role.value
+            # the role and the restaurant are loaded with the user of the next requests
+            principal = principal_cache.get(user.id)
+            if principal.role is not None:
+                session["ROLE"] = principal.role
                 # if is operator, load restaurant information and load in session
-                if role.value == "OPERATOR":
-                    q = db.session.query(Restaurant).filter(
-                        Restaurant.owner_id == user.id
-                    )
-                    restaurant = q.first()
-                    if restaurant is not None:
-                        session["RESTAURANT_ID"] = restaurant.id
-                        session["RESTAURANT_NAME"] = restaurant.name
+                if principal.role == "OPERATOR" and principal.restaurant_id is not None:
+                    session["RESTAURANT_ID"] = principal.restaurant_id
+                    session["RESTAURANT_NAME"] = principal.restaurant_name
             return redirect("/")
         else:
             return render_template(
@@ -41,4 +37,4 @@ def login():
 def logout():
     logout_user()
     session.clear()  # remove all session objects, like role
-    return redirect("/")
\ No newline at end of file
+    return redirect("/")
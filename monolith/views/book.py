@@ -1,4 +1,4 @@
-from flask import Blueprint, render_template, request
+from flask import Blueprint, render_template, request, abort, jsonify
 from monolith.forms import ReservationForm
 from monolith.auth import current_user
 from monolith.services.user_service import UserService
@@ -10,6 +10,7 @@ from flask_login import login_required
 from monolith.auth import roles_allowed
 
 from monolith.services import BookingServices
+from monolith.services.availability_search import AvailabilitySearch
 
 book = Blueprint("book", __name__)
 
@@ -87,6 +88,48 @@ def index():
         return render_template("booking.html", success=False, error="not logged in")
 
 
+@book.route("/restaurant/<int:restaurant_id>/availability", methods=["GET"])
+def availability(restaurant_id):
+    """
+    Return the moments where a party can book in the restaurant as json,
+    with the free tables of each moment, the params are:
+    - people: the people of the party, 2 by default
+    - fromDate: the first day, e.g. 2020-11-25, today by default
+    - toDate: the last day, fromDate by default
+    """
+    # http://localhost:5000/restaurant/1/availability?people=4&fromDate=2020-11-25&toDate=2020-11-27
+    people_number = request.args.get("people", default=2, type=int)
+    from_date = request.args.get("fromDate", type=str)
+    if from_date is None or from_date == "":
+        from_date = datetime.date.today()
+    to_date = request.args.get("toDate", type=str)
+    if to_date == "":
+        to_date = None
+    try:
+        slots = AvailabilitySearch.search(
+            restaurant_id, people_number, from_date, to_date
+        )
+    except ValueError:
+        abort(400)
+    if slots is None:
+        abort(404)
+    return jsonify(
+        {
+            "restaurant_id": restaurant_id,
+            "people_number": people_number,
+            "slots": [
+                {
+                    "start": slot.start.isoformat(),
+                    # the format of the booking form
+                    "reservation_date": slot.start.strftime("%d/%m/%Y %H:%M"),
+                    "free_tables": slot.free_tables,
+                }
+                for slot in slots
+            ],
+        }
+    )
+
+
 @book.route("/restaurant/book_update", methods=["GET", "POST"])
 @login_required
 def update_book():
@@ -107,8 +150,8 @@ def update_book():
             people_number,
             request.form.get("friends"),
         )
-        reservations_as_list = UserService.get_customer_reservation(
-            None, None, current_user.id
+        reservations_as_list, _ = UserService.get_customer_reservations_page(
+            current_user.id
         )
 
         form = ReservationForm()
@@ -1,10 +1,11 @@
-from flask import Blueprint, redirect, render_template, request
+from flask import Blueprint, redirect, render_template, request, jsonify, abort
 
 from monolith.auth import roles_allowed
 from monolith.database import db, User, Positive
 from monolith.forms import SearchUserForm
 
 from monolith.services import HealthyServices, RestaurantServices
+from monolith.utils.dispaccer_events import DispatcherMessage
 
 health = Blueprint("health", __name__)
 
@@ -33,8 +34,10 @@ def mark_positive():
         if form.validate_on_submit():
             email = form.email.data
             phone = form.phone.data
-            message = HealthyServices.mark_positive(email, phone)
+            message, job_id = HealthyServices.mark_positive_with_job(email, phone)
             if len(message) == 0:
+                if job_id is not None:
+                    return redirect("/health/notification_job/{}".format(job_id))
                 return redirect("/")
             return render_template(
                 "mark_positive.html",
@@ -46,6 +49,19 @@ def mark_positive():
     return render_template("mark_positive.html", form=form)
 
 
+@health.route("/health/notification_job/<job_id>")
+@roles_allowed(roles=["HEALTH"])
+def notification_job(job_id):
+    """
+    This API give the possibility to the health authority to poll the status
+    of the notifications sent after a new positive
+    """
+    status = DispatcherMessage.job_status(job_id)
+    if status is None:
+        abort(404)
+    return jsonify(status)
+
+
 @health.route("/search_contacts", methods=["POST", "GET"])
 @roles_allowed(roles=["HEALTH"])
 def search_contacts():
@@ -1,4 +1,4 @@
-from flask import Blueprint, render_template, session, redirect, abort
+from flask import Blueprint, render_template, session, redirect, abort, request
 from flask_login import current_user
 
 from monolith.database import (
@@ -11,19 +11,16 @@ from monolith.database import (
     MenuDish,
 )
 from monolith.forms import ReservationForm
-from monolith.services import (
-    UserService,
-    RestaurantServices,
-    DispatcherMessage,
-    CALCULATE_RATING_RESTAURANTS,
-)
+from monolith.services import UserService, RestaurantServices
+from monolith.utils.dispaccer_events import DispatcherMessage
+from monolith.app_constant import CALCULATE_RATING_RESTAURANTS
+from monolith.utils.streaming import render_page
 
 home = Blueprint("home", __name__)
 
 
 @home.route("/")
 def index():
-    restaurants = db.session.query(Restaurant).all()
     if current_user is None:
         _test = "anonymous_test"
     else:
@@ -104,12 +101,21 @@ def index():
         elif session["ROLE"] == "CUSTOMER":
             form = ReservationForm()
             is_positive = UserService.is_positive(current_user.id)
-            return render_template(
+            restaurants, next_cursor = RestaurantServices.get_restaurants_page(
+                request.args.get("cursor", type=str)
+            )
+            return render_page(
                 "index_customer.html",
                 _test=_test,
                 restaurants=restaurants,
+                next_cursor=next_cursor,
                 form=form,
                 is_positive=is_positive,
             )
 
-    return render_template("index.html", _test=_test, restaurants=restaurants)
+    restaurants, next_cursor = RestaurantServices.get_restaurants_page(
+        request.args.get("cursor", type=str)
+    )
+    return render_page(
+        "index.html", _test=_test, restaurants=restaurants, next_cursor=next_cursor
+    )
@@ -6,6 +6,8 @@ from flask import (
     session,
     current_app,
     abort,
+    jsonify,
+    url_for,
 )
 from monolith.database import (
     db,
@@ -18,11 +20,16 @@ from monolith.database import (
     MenuDish,
 )
 from monolith.forms import PhotoGalleryForm, ReviewForm, ReservationForm, DishForm
-from monolith.services import RestaurantServices
+from monolith.services import RestaurantServices, NearbyRestaurants
+from monolith.services.restaurant_services import RESERVATION_COLUMNS
+from monolith.services.availability_index import availability_index
+from monolith.services.availability_search import AvailabilitySearch
 from monolith.auth import roles_allowed
 from flask_login import current_user, login_required
 from monolith.forms import RestaurantForm, RestaurantTableForm
 from monolith.utils.formatter import my_date_formatter
+from monolith.utils.streaming import export_response
+from monolith.geo import cell_of
 
 restaurants = Blueprint("restaurants", __name__)
 
@@ -141,19 +148,56 @@ def my_reservations():
     toDate = request.args.get("toDate", type=str)
     email = request.args.get("email", type=str)
 
-    reservations_as_list = RestaurantServices.get_reservation_rest(
-        owner_id, restaurant_id, fromDate, toDate, email
-    )
-    print(RestaurantServices.get_restaurant_people(restaurant_id))
+    filters = {"fromDate": fromDate, "toDate": toDate, "email": email}
+
+    try:
+        reservations_as_list, next_cursor = RestaurantServices.get_reservations_page(
+            owner_id,
+            restaurant_id,
+            fromDate,
+            toDate,
+            email,
+            request.args.get("cursor", type=str),
+        )
+    except ValueError:
+        abort(400)
+    next_url = None
+    if next_cursor is not None:
+        next_url = url_for("restaurants.my_reservations", cursor=next_cursor, **filters)
     return render_template(
         "reservations.html",
         _test="restaurant_reservations_test",
         reservations_as_list=reservations_as_list,
         my_date_formatter=my_date_formatter,
         reservations_n=RestaurantServices.get_restaurant_people(restaurant_id),
+        next_url=next_url,
+        export_url=url_for("restaurants.export_reservations", **filters),
     )
 
 
+@restaurants.route("/restaurant/reservations/export")
+@login_required
+@roles_allowed(roles=["OPERATOR"])
+def export_reservations():
+    # http://localhost:5000/restaurant/reservations/export?format=json&columns=id,email&fromDate=2013-10-07
+    columns = request.args.get("columns", type=str)
+    columns = list(RESERVATION_COLUMNS) if not columns else columns.split(",")
+    try:
+        rows = RestaurantServices.export_reservations(
+            current_user.id,
+            session["RESTAURANT_ID"],
+            request.args.get("fromDate", type=str),
+            request.args.get("toDate", type=str),
+            request.args.get("email", type=str),
+            columns,
+        )
+        return export_response(
+            columns, rows, request.args.get("format", "csv", type=str), "reservations"
+        )
+    except ValueError:
+        abort(400)
+
+
 @restaurants.route("/restaurant/data", methods=["GET", "POST"])
 @login_required
 @roles_allowed(roles=["OPERATOR"])
@@ -170,6 +214,7 @@ def my_data():
                 "name": request.form.get("name"),
                 "lat": request.form.get("lat"),
                 "lon": request.form.get("lon"),
+                "geo_cell": cell_of(request.form.get("lat"), request.form.get("lon")),
                 "covid_measures": request.form.get("covid_measures"),
             }
         )
@@ -178,6 +223,8 @@ def my_data():
             message = "Some Errors occurs"
         else:
             db.session.commit()
+            availability_index.invalidate(session["RESTAURANT_ID"])
+            RestaurantServices.invalidate_restaurant_info(session["RESTAURANT_ID"])
             message = "Restaurant data has been modified."
 
     # get the resturant info and fill the form
@@ -211,6 +258,9 @@ def my_tables():
         table.name = request.form.get("name")
         db.session.add(table)
         db.session.commit()
+        availability_index.invalidate(session["RESTAURANT_ID"])
+        AvailabilitySearch.invalidate(session["RESTAURANT_ID"])
+        RestaurantServices.invalidate_restaurant_info(session["RESTAURANT_ID"])
         ##
         return redirect("/restaurant/data")
 
@@ -218,6 +268,9 @@ def my_tables():
         # delete the table specified by the get request
         RestaurantTable.query.filter_by(id=request.args.get("id")).delete()
         db.session.commit()
+        availability_index.invalidate(session["RESTAURANT_ID"])
+        AvailabilitySearch.invalidate(session["RESTAURANT_ID"])
+        RestaurantServices.invalidate_restaurant_info(session["RESTAURANT_ID"])
         return redirect("/restaurant/data")
 
 
@@ -240,6 +293,7 @@ def my_menu():
             dish.restaurant_id = session["RESTAURANT_ID"]
             db.session.add(dish)
             db.session.commit()
+            RestaurantServices.invalidate_restaurant_info(session["RESTAURANT_ID"])
             dishes.append(dish)
             _test = "menu_ok_test"
         else:
@@ -267,6 +321,7 @@ def my_menu():
 def delete_dish(dish_id):
     db.session.query(MenuDish).filter_by(id=dish_id).delete()
     db.session.commit()
+    RestaurantServices.invalidate_restaurant_info(session["RESTAURANT_ID"])
     return redirect("/restaurant/menu")
 
 
@@ -284,6 +339,7 @@ def my_photogallery():
             photo_gallery.restaurant_id = session["RESTAURANT_ID"]
             db.session.add(photo_gallery)
             db.session.commit()
+            RestaurantServices.invalidate_restaurant_info(session["RESTAURANT_ID"])
 
         return redirect("/restaurant/photogallery")
     else:
@@ -341,6 +397,43 @@ def search_restaurant(name_rest):
     )
 
 
+@restaurants.route("/restaurant/near", methods=["GET"])
+def near_restaurants():
+    """
+    Return the restaurants near a position as json, the params are:
+    - lat, lon: the position
+    - radius: if present all the restaurants inside the radius in km,
+    otherwise the k nearest restaurants
+    - k: number of restaurants, 10 by default
+    - open: 1 to have only the restaurants open now, 0 for all
+    """
+    lat = request.args.get("lat", type=float)
+    lon = request.args.get("lon", type=float)
+    radius = request.args.get("radius", type=float)
+    k = request.args.get("k", default=10, type=int)
+    if lat is None or lon is None or k <= 0 or (radius is not None and radius <= 0):
+        abort(400)
+
+    if radius is not None:
+        only_open = request.args.get("open", default=0, type=int) == 1
+        near = NearbyRestaurants.within(lat, lon, radius, only_open)
+    else:
+        only_open = request.args.get("open", default=1, type=int) == 1
+        near = NearbyRestaurants.nearest(lat, lon, k, only_open)
+    return jsonify(
+        [
+            {
+                "id": restaurant.id,
+                "name": restaurant.name,
+                "lat": restaurant.lat,
+                "lon": restaurant.lon,
+                "distance": round(distance, 3),
+            }
+            for restaurant, distance in near
+        ]
+    )
+
+
 @restaurants.route("/restaurant/checkinreservations/<reservation_id>")
 @login_required
 @roles_allowed(roles=["OPERATOR"])
@@ -1,4 +1,14 @@
-from flask import Blueprint, redirect, render_template, request, current_app, session
+from flask import (
+    Blueprint,
+    redirect,
+    render_template,
+    request,
+    current_app,
+    session,
+    abort,
+    jsonify,
+    url_for,
+)
 from monolith.database import db, User, Like, Role
 from monolith.forms import UserForm, UserEditForm
 from monolith.forms import ReservationForm
@@ -9,6 +19,11 @@ from monolith.services.booking_services import BookingServices
 from monolith.auth import roles_allowed
 from monolith.utils.formatter import my_date_formatter
 from flask_login import current_user, login_user, login_required
+from monolith.principals import principal_cache
+from monolith.pagination import PAGE_SIZE
+
+## max number of reservations inside a page of the history api
+MAX_PAGE_SIZE = 100
 
 users = Blueprint("users", __name__)
 
@@ -73,7 +88,10 @@ def user_data():
     if request.method == "POST":
         form = UserEditForm()
         if form.validate_on_submit():
-            UserService.modify_user(form)
+            user = UserService.modify_user(form)
+            if user is not None:
+                # the current user of the request is the principal before the change
+                login_user(principal_cache.get(user.id))
             return render_template("user_data.html", form=form)
         print(form.errors.items())
         return render_template("user_data.html", form=form, error="Error in the data")
@@ -99,16 +117,81 @@ def myreservation():
     # filter params
     fromDate = request.args.get("fromDate", type=str)
     toDate = request.args.get("toDate", type=str)
-
-    reservations_as_list = UserService.get_customer_reservation(
-        fromDate, toDate, current_user.id
-    )
+    upcoming = request.args.get("history", type=str) != "past"
+
+    try:
+        reservations_as_list, next_cursor = UserService.get_customer_reservations_page(
+            current_user.id,
+            upcoming,
+            fromDate,
+            toDate,
+            request.args.get("cursor", type=str),
+        )
+    except ValueError:
+        abort(400)
+    filters = {"fromDate": fromDate, "toDate": toDate}
+    next_url = None
+    if next_cursor is not None:
+        next_url = url_for(
+            "users.myreservation",
+            history="upcoming" if upcoming else "past",
+            cursor=next_cursor,
+            **filters
+        )
     form = ReservationForm()
     return render_template(
         "user_reservations.html",
         reservations_as_list=reservations_as_list,
         my_date_formatter=my_date_formatter,
         form=form,
+        upcoming=upcoming,
+        next_url=next_url,
+        upcoming_url=url_for("users.myreservation", history="upcoming", **filters),
+        past_url=url_for("users.myreservation", history="past", **filters),
+    )
+
+
+@users.route("/customer/reservations/history", methods=["GET"])
+@login_required
+@roles_allowed(roles=["CUSTOMER"])
+def reservation_history():
+    """
+    Return a page of the reservations of the customer as json, the params are:
+    - history: "upcoming" (default) for the next reservations, "past" for the
+    previous ones, the newest first
+    - fromDate, toDate: the days, e.g. 2020-10-07
+    - cursor: the next_cursor of the previous page
+    - page_size: number of reservations, 30 by default
+    """
+    history = request.args.get("history", default="upcoming", type=str)
+    page_size = request.args.get("page_size", default=PAGE_SIZE, type=int)
+    if history not in ["upcoming", "past"] or not 0 < page_size <= MAX_PAGE_SIZE:
+        abort(400)
+    try:
+        reservations, next_cursor = UserService.get_customer_reservations_page(
+            current_user.id,
+            history == "upcoming",
+            request.args.get("fromDate", type=str),
+            request.args.get("toDate", type=str),
+            request.args.get("cursor", type=str),
+            page_size,
+        )
+    except ValueError:
+        abort(400)
+    return jsonify(
+        {
+            "reservations": [
+                {
+                    "id": reservation.id,
+                    "reservation_date": reservation.reservation_date.isoformat(),
+                    "people_number": reservation.people_number,
+                    "restaurant_id": reservation.rest_id,
+                    "restaurant_name": reservation.name,
+                }
+                for reservation in reservations
+            ],
+            "next_cursor": next_cursor,
+        }
     )
 
 
@@ -119,8 +202,8 @@ def delete_reservation(reservation_id):
 
     deleted = BookingServices.delete_book(reservation_id, current_user.id)
 
-    reservations_as_list = UserService.get_customer_reservation(
-        None, None, current_user.id
+    reservations_as_list, _ = UserService.get_customer_reservations_page(
+        current_user.id
     )
     form = ReservationForm()
     return render_template(